@@ -13,16 +13,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
 import logging
+import time
+from hashlib import md5
 
 from mediacore.model.meta import DBSession
 from mediacore.plugin import events
 from mediacore.plugin.events import observes
 
-from mediacore_panda.lib.storage import PandaStorage
+from mediacore_panda.lib import PandaUnavailable
+from mediacore_panda.lib.metrics import measure_page
+from mediacore_panda.lib.storage import PandaStorage, configure_panda, start_job_workers
+from mediacore_panda.model import DONE, PandaEncodingState, PandaJob
 
 log = logging.getLogger(__name__)
 
+#: Whether loading the app starts the background threads (the job
+#: workers). The paster commands turn this off before loading
+#: the app, since they do their work in the foreground.
+start_threads = True
+
+# MediaCore 0.9.0 has no event for when the database is ready, but the
+# routes are set up during the same load.
+_app_loaded = getattr(events.Environment, 'init_model', events.Environment.routes)
+
+@observes(_app_loaded)
+def init_panda(*args):
+    configure_panda()
+    if start_threads:
+        start_job_workers()
+
 @observes(events.Environment.routes)
 def add_routes(mapper):
     mapper.connect('/admin/plugins/panda',
@@ -31,29 +52,151 @@ def add_routes(mapper):
     mapper.connect('/admin/plugins/panda/save',
         controller='panda/admin/settings',
         action='panda_save')
+    mapper.connect('/admin/plugins/panda/metrics',
+        controller='panda/admin/media',
+        action='panda_metrics')
 
 @observes(events.Admin.MediaController.edit)
-def add_panda_vars(**result):
+@measure_page('admin/media/edit')
+def add_panda_vars(refresh=False, fetch=True, **result):
+    # Panda data is read from the local mirror, and only fetched from Panda
+    # for videos that haven't been mirrored yet, or if refresh is true.
+    # If fetch is false, Panda isn't asked at all, and the profile names
+    # are left out.
     media = result['media']
-    result['encoding_dicts'] = encoding_dicts = {}
-    result['video_dicts'] = video_dicts = {}
+    result['encoding_dicts'] = {}
+    result['video_dicts'] = {}
     result['profile_names'] = {}
+    result['panda_jobs'] = []
+    result['panda_unavailable'] = False
     result['display_panda_refresh_message'] = False
 
     if not media.files:
         return result
 
+    result['panda_jobs'] = PandaJob.query\
+        .filter(PandaJob.media_file_id.in_([file.id for file in media.files]))\
+        .filter(PandaJob.state != DONE)\
+        .order_by(PandaJob.id)\
+        .all()
+
     storage = DBSession.query(PandaStorage).first()
     if not storage:
         return result
 
-    for file in media.files:
-        encoding_dicts[file.id] = \
-            storage.panda_helper().get_associated_encoding_dicts(file)
-        video_dicts[file.id] = \
-            storage.panda_helper().get_associated_video_dicts(file)
+    # If Panda is down, show whatever has been mirrored rather than
+    # holding up the page.
+    panda_helper = storage.panda_helper()
+    try:
+        encoding_dicts, video_dicts = panda_helper.get_mirrored_dicts(media.files,
+            refresh=refresh, fetch=fetch)
+    except PandaUnavailable, e:
+        log.warning('Showing mirrored Panda data only: %s', e)
+        result['panda_unavailable'] = True
+        encoding_dicts, video_dicts = \
+            panda_helper.get_mirrored_dicts(media.files, fetch=False)
+    result['encoding_dicts'] = encoding_dicts
+    result['video_dicts'] = video_dicts
 
-    if video_dicts or encoding_dicts:
-        result['profile_names'] = storage.panda_helper().get_profile_ids_names()
+    if fetch and any(video_dicts.itervalues()) and not result['panda_unavailable']:
+        try:
+            result['profile_names'] = panda_helper.get_profile_ids_names()
+        except PandaUnavailable, e:
+            log.warning('Could not list Panda profiles: %s', e)
+            result['panda_unavailable'] = True
 
     return result
+
+def _panda_time(s):
+    # Panda timestamps look like '2011/03/14 12:34:56 +0000'.
+    try:
+        t = calendar.timegm(time.strptime(s[:19], '%Y/%m/%d %H:%M:%S'))
+        offset = s[20:25]
+        if offset:
+            minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+            if offset[0] == '-':
+                minutes = -minutes
+            t -= minutes * 60
+        return t
+    except (TypeError, ValueError):
+        return 0
+
+def _local_time(dt):
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1000000.0
+
+def panda_status_delta(media, since=0, fetch=True):
+    """Return what has changed in the encode status box of a media item.
+
+    This is the data behind the polled JSON status, so it comes from the
+    same place as the status box itself (see :func:`add_panda_vars`).
+
+    :param since: The ``version`` of an earlier delta, or 0 for everything.
+    :type since: float
+    :param fetch: False to use only the local mirror, without asking Panda
+                  about videos that aren't mirrored yet.
+    :type fetch: bool
+    :returns: A dict with the ``status``, ``encoding_progress``,
+              ``started`` and ``failed`` of each encoding that changed at
+              or after ``since``, the IDs of every current encoding and
+              the state of every unfinished job. Also a ``version``, which
+              is the time of the last change, and an ``etag`` that changes
+              with any of the content.
+    :rtype: dict
+    """
+    result = add_panda_vars(fetch=fetch, media=media)
+
+    encodings = {}
+    for file in media.files:
+        for id, e in result['encoding_dicts'].get(file.id, {}).iteritems():
+            video = result['video_dicts'][file.id][e['video_id']]
+            encoding_failed = e['status'] == 'fail' \
+                or (video['status'] == 'fail' and not e['started_encoding_at'])
+            encodings[id] = dict(
+                status = e['status'],
+                encoding_progress = e['encoding_progress'] or 0,
+                started = bool(e['started_encoding_at']),
+                failed = encoding_failed,
+                updated_at = e['updated_at'],
+            )
+
+    # Panda's timestamps don't change with the encoding progress, but the
+    # local mirror's do.
+    refreshed = {}
+    if encodings:
+        refreshed = dict(DBSession.query(PandaEncodingState.encoding_id,
+                                         PandaEncodingState.refreshed_on)\
+            .filter(PandaEncodingState.encoding_id.in_(encodings.keys())))
+
+    version = 0
+    changed = {}
+    for id, e in encodings.iteritems():
+        updated = _panda_time(e.pop('updated_at'))
+        if id in refreshed:
+            updated = max(updated, _local_time(refreshed[id]))
+        version = max(version, updated)
+        # Changes made in the same instant as the last delta are sent
+        # again, rather than risk missing them.
+        if updated >= since:
+            changed[id] = e
+    jobs = [dict(id=job.id, state=job.state) for job in result['panda_jobs']]
+    for job in result['panda_jobs']:
+        version = max(version, _local_time(job.modified_on))
+
+    done = not any(result['encoding_dicts'].get(file.id) for file in media.files) \
+        and not jobs
+    content = (
+        sorted((id, e['status'], e['encoding_progress'], e['started'], e['failed'])
+               for id, e in encodings.iteritems()),
+        [(job['id'], job['state']) for job in jobs],
+        done,
+        result['panda_unavailable'],
+    )
+    return dict(
+        version = version,
+        etag = md5(repr(content)).hexdigest(),
+        encodings = changed,
+        encoding_ids = sorted(encodings),
+        jobs = jobs,
+        done = done,
+        panda_unavailable = result['panda_unavailable'],
+    )
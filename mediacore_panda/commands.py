@@ -0,0 +1,300 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Paster commands for maintaining a MediaCore-Panda installation.
+
+Run them from your MediaCore directory, passing your deployment's config
+file, e.g. ``paster panda_setup deployment.ini``.
+"""
+
+import os
+import time
+import urlparse
+
+from paste.deploy import loadapp
+from paste.script.command import BadCommand, Command
+
+class PandaCommand(Command):
+    """Base class for commands that need a loaded MediaCore environment."""
+    min_args = 1
+    max_args = 1
+    usage = 'CONFIG_FILE'
+    group_name = 'mediacore_panda'
+
+    def load_app(self):
+        # Loading the app sets up pylons.config and the database connection.
+        # The web server's background threads aren't wanted here.
+        import mediacore_panda
+        mediacore_panda.start_threads = False
+        config_file = os.path.abspath(self.args[0])
+        self.app = loadapp('config:%s' % config_file)
+
+class SetupCommand(PandaCommand):
+    """Create the Panda plugin's tables and migrate existing data into them.
+
+    This is safe to run more than once.
+    """
+    summary = __doc__.splitlines()[0]
+    parser = Command.standard_parser(verbose=True)
+
+    def command(self):
+        self.load_app()
+        from mediacore.model.meta import DBSession
+        from mediacore_panda import model
+        from mediacore_panda.lib.records import migrate_media_files
+
+        model.create_tables()
+        moved = model.migrate_video_meta()
+        reduced = migrate_media_files()
+        DBSession.commit()
+        if self.verbose:
+            print 'Moved %d video associations into panda_videos.' % moved
+            print 'Reduced %d media file records to Panda file IDs.' % reduced
+
+class WorkerCommand(PandaCommand):
+    """Run queued Panda jobs, such as submitting new uploads for transcoding.
+
+    Use this instead of, or as well as, the worker threads that run inside
+    the web server processes (see the panda.job_workers setting). Like
+    them, it also keeps the progress of videos being encoded up to date.
+    """
+    summary = __doc__.splitlines()[0]
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--once', action='store_true', dest='once',
+        help='Run the jobs that are due, then exit.')
+    parser.add_option('--interval', type='float', dest='interval', default=10,
+        help='Seconds to wait between checks for new jobs (default 10).')
+    parser.add_option('--refresh-interval', type='float', dest='refresh_interval', default=60,
+        help='Seconds between refreshes of videos being encoded, or 0 not to (default 60).')
+
+    def command(self):
+        self.load_app()
+        from mediacore.model.meta import DBSession
+        from mediacore_panda.lib.jobs import JobRunner
+
+        runner = JobRunner(refresh_interval=self.options.refresh_interval)
+        while True:
+            count = runner.run_pending()
+            DBSession.remove()
+            if self.verbose and count:
+                print 'Ran %d Panda jobs.' % count
+            if self.options.once:
+                break
+            time.sleep(self.options.interval)
+
+class ReconcileCommand(PandaCommand):
+    """Finalize videos that Panda has finished, without its notifications.
+
+    Use this where Panda can't reach the site's notification URL, running
+    it on one machine only. Each check lists the cloud's videos and
+    encodings, and videos are checked less often the longer their
+    encodings are expected to take.
+    """
+    summary = __doc__.splitlines()[0]
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--once', action='store_true', dest='once',
+        help='Check every unfinished video, then exit.')
+    parser.add_option('--interval', type='float', dest='interval', default=60,
+        help='Fewest seconds between checks of one video (default 60).')
+    parser.add_option('--max-interval', type='float', dest='max_interval', default=3600,
+        help='Most seconds between checks of one video (default 3600).')
+
+    def command(self):
+        self.load_app()
+        from mediacore.model.meta import DBSession
+        from mediacore_panda.lib.reconcile import Reconciler
+        from mediacore_panda.lib.storage import PandaStorage
+
+        storage = DBSession.query(PandaStorage).first()
+        if storage is None:
+            raise BadCommand('The Panda storage engine has not been set up.')
+
+        reconciler = Reconciler(min_interval=self.options.interval,
+                                max_interval=self.options.max_interval)
+        while True:
+            checked, finalized = reconciler.run(storage.panda_helper())
+            DBSession.remove()
+            storage = DBSession.query(PandaStorage).first()
+            if self.verbose and checked:
+                print 'Checked %d Panda videos, finalized %d.' % (checked, finalized)
+            if self.options.once:
+                break
+            time.sleep(self.options.interval)
+
+class BackfillCommand(PandaCommand):
+    """Submit existing video files to Panda for transcoding, in bulk.
+
+    By default, every video file that has not yet been sent to Panda is
+    submitted. With --profile, every video already sent to Panda is
+    instead encoded with that one additional profile.
+
+    Progress is saved to the --checkpoint file after each batch, so an
+    interrupted run can be resumed by running the same command again.
+    """
+    summary = __doc__.splitlines()[0]
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--base-url', dest='base_url',
+        help='The public URL of this MediaCore site, e.g. http://example.com/ '
+             '(required, since Panda downloads the files from it).')
+    parser.add_option('--profile', dest='profile',
+        help='Add this profile (by name) to the videos already in Panda.')
+    parser.add_option('--concurrency', type='int', dest='concurrency', default=4,
+        help='Submissions to make at the same time (default 4).')
+    parser.add_option('--rate', type='float', dest='rate', default=2,
+        help='Most submissions to make per second (default 2).')
+    parser.add_option('--checkpoint', dest='checkpoint', default='panda_backfill.json',
+        help='File to save progress in (default panda_backfill.json).')
+    parser.add_option('--limit', type='int', dest='limit',
+        help='Stop after submitting about this many.')
+
+    def command(self):
+        if not self.options.base_url:
+            raise BadCommand('--base-url is required.')
+        self.load_app()
+        self.setup_urls(self.options.base_url)
+        from mediacore.model.meta import DBSession
+        from mediacore_panda.lib.backfill import Backfill, Checkpoint
+        from mediacore_panda.lib.storage import PandaStorage
+
+        storage = DBSession.query(PandaStorage).first()
+        if storage is None:
+            raise BadCommand('The Panda storage engine has not been set up.')
+
+        report = None
+        if self.verbose:
+            def report(message):
+                print message
+        backfill = Backfill(storage, Checkpoint(self.options.checkpoint),
+            concurrency=self.options.concurrency, rate=self.options.rate,
+            report=report)
+        if self.options.profile:
+            backfill.add_profile(self.options.profile, limit=self.options.limit)
+        else:
+            backfill.transcode_library(limit=self.options.limit)
+
+    def setup_urls(self, base_url):
+        # Outside of a web request, url_for needs to be told our host so it
+        # can build the download and notification URLs we send to Panda.
+        import pylons
+        from routes import request_config
+        from routes.util import URLGenerator
+        from paste.registry import Registry
+
+        parts = urlparse.urlsplit(base_url)
+        environ = {
+            'wsgi.url_scheme': parts.scheme,
+            'HTTP_HOST': parts.netloc,
+            'SCRIPT_NAME': parts.path.rstrip('/'),
+            'PATH_INFO': '/',
+        }
+        mapper = pylons.config['routes.map']
+        config = request_config()
+        config.mapper = mapper
+        config.host = parts.netloc
+        config.protocol = parts.scheme
+        config.environ = environ
+        registry = Registry()
+        registry.prepare()
+        registry.register(pylons.url, URLGenerator(mapper, environ))
+
+class EmulatorCommand(Command):
+    """Run an imitation of the Panda API, for development and load testing.
+
+    Point MediaCore at it with the panda.api_host and panda.api_port
+    settings. Any cloud ID and keys are accepted.
+    """
+    summary = __doc__.splitlines()[0]
+    usage = ''
+    group_name = 'mediacore_panda'
+    min_args = 0
+    max_args = 0
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--host', dest='host', default='127.0.0.1',
+        help='Address to listen on (default 127.0.0.1).')
+    parser.add_option('--port', type='int', dest='port', default=8642,
+        help='Port to listen on (default 8642).')
+    parser.add_option('--encoding-time', type='float', dest='encoding_time', default=10,
+        help='Seconds each encoding takes (default 10).')
+    parser.add_option('--fail-rate', type='float', dest='fail_rate', default=0,
+        help='Fraction of encodings that fail (default 0).')
+    parser.add_option('--latency', type='float', dest='latency', default=0,
+        help='Seconds to delay every response by (default 0).')
+    parser.add_option('--error-rate', type='float', dest='error_rate', default=0,
+        help='Fraction of requests to answer with an error (default 0).')
+
+    def command(self):
+        from mediacore_panda.lib import emulator
+
+        panda = emulator.PandaEmulator(encoding_time=self.options.encoding_time,
+                                       fail_rate=self.options.fail_rate)
+        if self.options.latency:
+            panda.inject(emulator.LATENCY, delay=self.options.latency)
+        if self.options.error_rate:
+            panda.inject(emulator.ERROR, probability=self.options.error_rate)
+        print 'Emulating Panda at http://%s:%d/' % (self.options.host, self.options.port)
+        print 'Set panda.api_host = %s and panda.api_port = %d' % (self.options.host, self.options.port)
+        try:
+            emulator.serve(panda, self.options.host, self.options.port, background=False)
+        except KeyboardInterrupt:
+            pass
+
+class BenchmarkCommand(PandaCommand):
+    """Measure the cost of the plugin's admin pages and webhooks by media size.
+
+    Runs against an emulated Panda, inside a transaction that is rolled
+    back, so it is safe to run on a copy of a real site's database (which
+    must have had panda_setup run on it). Exits with status 1 if any result
+    regressed from the --baseline.
+    """
+    summary = __doc__.splitlines()[0]
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--sizes', dest='sizes', default='1,10,50',
+        help='Comma separated numbers of files per media item (default 1,10,50).')
+    parser.add_option('--videos', type='int', dest='videos', default=1,
+        help='Panda videos per file (default 1).')
+    parser.add_option('--profiles', type='int', dest='profiles', default=2,
+        help='Encoding profiles per video (default 2).')
+    parser.add_option('--repeat', type='int', dest='repeat', default=5,
+        help='Runs of each scenario, of which the fastest counts (default 5).')
+    parser.add_option('--workers', type='int', dest='workers', default=0,
+        help='Threads for parallel Panda requests, as panda.max_workers (default 0).')
+    parser.add_option('--baseline', dest='baseline',
+        help='Compare the results with this baseline file.')
+    parser.add_option('--save-baseline', dest='save_baseline',
+        help='Save the results to this file, as a baseline for later runs.')
+    parser.add_option('--tolerance', type='float', dest='tolerance', default=0.25,
+        help='Fraction by which wall time may grow before it is flagged (default 0.25).')
+
+    def command(self):
+        self.load_app()
+        from mediacore_panda.lib import benchmark
+
+        sizes = [int(size) for size in self.options.sizes.split(',')]
+        bench = benchmark.Benchmark(videos=self.options.videos,
+            profiles=self.options.profiles, repeat=self.options.repeat,
+            max_workers=self.options.workers)
+        results = bench.run(sizes)
+
+        regressed = 0
+        if self.options.baseline:
+            baseline = benchmark.load_baseline(self.options.baseline)
+            regressed = benchmark.compare(results, baseline, self.options.tolerance)
+        for result in results:
+            print result
+        if self.options.save_baseline:
+            benchmark.save_baseline(self.options.save_baseline, results)
+        if regressed:
+            print '%d results regressed.' % regressed
+            return 1
@@ -14,7 +14,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import simplejson
+import time
+from email.utils import formatdate, mktime_tz, parsedate_tz
 
+from paste.deploy.converters import asbool
+from pylons import request, response
 from repoze.what.predicates import has_permission
 from repoze.what.plugins.pylonshq import ActionProtector
 
@@ -24,27 +29,113 @@ from mediacore.lib.helpers import redirect
 from mediacore.model import Media, MediaFile, fetch_row
 from mediacore.model.meta import DBSession
 
-from mediacore_panda import add_panda_vars
+from mediacore_panda import add_panda_vars, panda_status_delta
 from mediacore_panda.lib import PandaHelper
+from mediacore_panda.lib.broker import broker, publish_after_commit
+from mediacore_panda.lib.jobs import wake_workers
+from mediacore_panda.lib.metrics import metrics
 from mediacore_panda.lib.storage import PandaStorage
+from mediacore_panda.model import DONE, PandaJob
 
 log = logging.getLogger(__name__)
 admin_perms = has_permission('edit')
 
+# The longest a status request may wait for a change, in seconds. This is
+# kept under the usual 30 second timeout of proxies.
+MAX_STATUS_WAIT = 25
+
+# How often a waiting status request re-checks the database, in seconds,
+# for changes made by other processes.
+STATUS_RECHECK_INTERVAL = 5
+
+def _not_modified(etag, version):
+    if_none_match = request.headers.get('If-None-Match', None)
+    if_modified_since = request.headers.get('If-Modified-Since', None)
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')]
+    elif if_modified_since is not None:
+        parsed = parsedate_tz(if_modified_since)
+        return parsed is not None and int(version) <= mktime_tz(parsed)
+    return False
+
 class MediaController(BaseController):
+    def __call__(self, environ, start_response):
+        # Count the Panda calls made by each action; see panda_metrics. The
+        # count is ended even if the action raises, when __after__ isn't
+        # called, so that it doesn't run on into this thread's next request.
+        metrics.begin_page('admin/media/%s' % environ['pylons.routes_dict']['action'])
+        try:
+            return BaseController.__call__(self, environ, start_response)
+        finally:
+            metrics.end_page()
+
     @ActionProtector(admin_perms)
     @expose('panda/admin/media/panda-status-box.html')
-    def panda_status(self, id, **kwargs):
+    @autocommit
+    def panda_status(self, id, refresh=False, **kwargs):
         media = fetch_row(Media, id)
         result = {'media': media, 'include_javascript': False}
-        result = add_panda_vars(**result)
+        result = add_panda_vars(refresh=asbool(refresh), **result)
+        if asbool(refresh):
+            publish_after_commit(media.id)
 
         encoding_dicts = result['encoding_dicts']
         result['display_panda_refresh_message'] = \
-            not any(encoding_dicts.get(file.id) for file in media.files)
+            not any(encoding_dicts.get(file.id) for file in media.files) \
+            and not result['panda_jobs']
 
         return result
 
+    @ActionProtector(admin_perms)
+    @expose()
+    @autocommit
+    def panda_status_json(self, id, since=None, wait=0, **kwargs):
+        """Report what has changed in the status box, for the widget to patch.
+
+        Answers 304 Not Modified if the client's ETag, or failing that its
+        Last-Modified time, is still current. With ``wait``, an unchanged
+        status is instead held for up to that many seconds, until it
+        changes. The status comes from the local mirror, so waiting
+        viewers don't add to the calls made to Panda.
+        """
+        media = fetch_row(Media, id)
+        try:
+            since = float(since or 0)
+            wait = min(float(wait or 0), MAX_STATUS_WAIT)
+        except ValueError:
+            since, wait = 0, 0
+
+        deadline = time.time() + wait
+        published = broker.version(media.id)
+        delta = panda_status_delta(media, since)
+        etag = '"%s"' % delta.pop('etag')
+        while _not_modified(etag, delta['version']):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # End the transaction, so that changes committed by other
+            # requests and processes can be seen.
+            DBSession.commit()
+            woken = broker.wait(media.id, published, min(remaining, STATUS_RECHECK_INTERVAL))
+            if woken is None:
+                # Too many requests are waiting already.
+                break
+            published = broker.version(media.id)
+            # Whatever was missing from the mirror was fetched above, so
+            # waiting requests never call Panda themselves.
+            delta = panda_status_delta(media, since, fetch=False)
+            etag = '"%s"' % delta.pop('etag')
+
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = formatdate(delta['version'], usegmt=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        if _not_modified(etag, delta['version']):
+            response.status_int = 304
+            return ''
+
+        response.headers['Content-Type'] = 'application/json'
+        return simplejson.dumps(delta)
+
     @ActionProtector(admin_perms)
     @expose('json')
     @autocommit
@@ -52,6 +143,7 @@ class MediaController(BaseController):
         media_file = fetch_row(MediaFile, file_id)
         storage = DBSession.query(PandaStorage).first()
         storage.panda_helper().cancel_transcode(media_file, encoding_id)
+        publish_after_commit(media_file.media_id)
         return dict(
             success = True,
         )
@@ -63,6 +155,54 @@ class MediaController(BaseController):
         media_file = fetch_row(MediaFile, file_id)
         storage = DBSession.query(PandaStorage).first()
         storage.panda_helper().retry_transcode(media_file, encoding_id)
+        publish_after_commit(media_file.media_id)
+        return dict(
+            success = True,
+        )
+
+    @ActionProtector(admin_perms)
+    @expose('json')
+    def panda_metrics(self, reset=False, **kwargs):
+        """Report the Panda API usage of this process, for finding hot spots."""
+        snapshot = metrics.snapshot()
+        storage = DBSession.query(PandaStorage).first()
+        if storage is not None:
+            client = storage.panda_helper().client
+            snapshot['cache'] = dict(
+                size = len(client.json_cache),
+                hits = client.json_cache.hits,
+                misses = client.json_cache.misses,
+                evictions = client.json_cache.evictions,
+            )
+            snapshot['connections'] = dict(client.connection_pool.stats,
+                reuse_rate = client.connection_pool.reuse_rate)
+            snapshot['breaker'] = client.breaker.state
+        if asbool(reset):
+            metrics.reset()
+        return snapshot
+
+    @ActionProtector(admin_perms)
+    @expose('json')
+    def panda_jobs(self, state=None, **kwargs):
+        """List queued Panda jobs, by default those that are not yet done."""
+        jobs = PandaJob.query.order_by(PandaJob.id.desc())
+        if state:
+            jobs = jobs.filter(PandaJob.state == state)
+        else:
+            jobs = jobs.filter(PandaJob.state != DONE)
+        return dict(
+            jobs = [job.as_dict() for job in jobs[:100]],
+        )
+
+    @ActionProtector(admin_perms)
+    @expose('json')
+    @autocommit
+    def panda_job_retry(self, id, **kwargs):
+        job = fetch_row(PandaJob, id)
+        job.retry()
+        if hasattr(request, 'commit_callbacks'):
+            request.commit_callbacks.append(wake_workers)
+        publish_after_commit(job.media_file.media_id)
         return dict(
             success = True,
         )
@@ -70,6 +210,19 @@ class MediaController(BaseController):
     @expose()
     @autocommit
     def panda_update(self, media_id=None, file_id=None, video_id=None, **kwargs):
+        if file_id and video_id:
+            # This is a notification from Panda, sent to the state_update_url
+            # given in PandaStorage.transcode. Apply just what it tells us.
+            media_file = fetch_row(MediaFile, file_id)
+            storage = DBSession.query(PandaStorage).first()
+            storage.panda_helper().handle_notification(media_file, video_id,
+                encoding_id = kwargs.get('encoding_id', None),
+                status = kwargs.get('status', None),
+                progress = kwargs.get('progress', kwargs.get('encoding_progress', None)),
+            )
+            publish_after_commit(media_file.media_id)
+            return ''
+
         if file_id:
             media_file = fetch_row(MediaFile, file_id)
             media_files = [media_file]
@@ -81,5 +234,6 @@ class MediaController(BaseController):
 
         for media_file in media_files:
             storage.panda_helper().video_status_update(media_file, video_id)
+            publish_after_commit(media_file.media_id)
 
         redirect(controller='/admin/media', action='edit', id=media_id)
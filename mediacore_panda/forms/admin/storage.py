@@ -124,6 +124,7 @@ class PandaForm(StorageForm):
         engine._data[CLOUDFRONT_DOWNLOAD_URI] = cloudfront['download_uri']
 
         engine.panda_helper.cache.clear()
+        engine.clear_uri_templates()
         try:
             engine.panda_helper().client.get_cloud()
         except PandaException, e:
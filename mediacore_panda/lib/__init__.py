@@ -13,20 +13,37 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cgi
+import httplib
 import logging
 import os
+import re
 import simplejson
+import socket
+import sys
+import threading
+import time
 import urllib
-from pprint import pformat
-from socket import gaierror
+from datetime import datetime, timedelta
 
 import panda
-from pylons import request
 
 from mediacore.lib.helpers import download_uri
 from mediacore.lib.storage import add_new_media_file
+from sqlalchemy import or_
+
 from mediacore.model.meta import DBSession
-from mediacore.model.media import MediaFilesMeta
+
+from mediacore_panda.model import (FINALIZED, GONE, PandaEncodingState,
+    PandaEvent, PandaVideo, PandaVideoState)
+from mediacore_panda.lib.breaker import CLOSED, CircuitBreaker, backoff_delays
+from mediacore_panda.lib.cache import SHARED_NAMESPACES, ResponseCache
+from mediacore_panda.lib.metrics import metrics as default_metrics
+from mediacore_panda.lib.tracing import tracer as default_tracer
+from mediacore_panda.lib.pool import DeadlineExceeded, Future, WorkerPool, shared_pool
+from mediacore_panda.lib.records import PANDA_URL_PREFIX, encode as encode_record
+from mediacore_panda.lib.transport import ConnectionPool
+from mediacore_panda.lib.upload import LogProgress, MultipartStream
 
 log = logging.getLogger(__name__)
 
@@ -41,8 +58,6 @@ POST = 'POST'
 DELETE = 'DELETE'
 GET = 'GET'
 
-META_VIDEO_PREFIX = "panda_video_"
-PANDA_URL_PREFIX = "panda:"
 TYPES = {
     'video': "video_id",
     'encoding': "encoding_id",
@@ -70,69 +85,400 @@ encoding_keys = [
     'encoding_progress', 'encoding_time', 'started_encoding_at', 'profile_id', 'video_id', # Encoding Specific
 ]
 
+# Cached URLs that become stale when a resource of the given type is created,
+# modified or deleted. Encodings are listed against their videos (and video
+# state depends on its encodings), so a change to either invalidates both.
+INVALIDATED_URLS = {
+    'videos': ('/videos', '/encodings'),
+    'encodings': ('/encodings', '/videos'),
+    'profiles': ('/profiles',),
+}
+
+# How many times to retry a GET that failed because Panda was unreachable.
+DEFAULT_RETRIES = 2
+
+# Threads per client for refreshing stale cache entries in the background.
+REFRESH_WORKERS = 2
+
+# Panda notifications are validated before anything in them is trusted.
+NOTIFICATION_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+ENCODING_STATUSES = ('success', 'fail', 'processing')
+
+# When looking up this many videos or more at once, list the videos and
+# encodings in the cloud and filter them locally instead of fetching each
+# video and its encodings individually.
+BATCH_LISTING_THRESHOLD = 10
+
+# Listings are fetched this many items at a time, up to a limit, so that a
+# large cloud isn't listed in full. Anything not found in the pages that
+# were fetched is fetched individually instead.
+LISTING_PAGE_SIZE = 100
+LISTING_MAX_PAGES = 5
+
 class PandaException(Exception):
     pass
 
-def log_request(request_url, method, query_string_data, body_data, response_data):
-    log.debug("Sending Panda a %s request: %s from %s", method, request_url, request.url)
-    if query_string_data:
-        log.debug("Query String Data: %s", pformat(query_string_data))
-    if body_data:
-        log.debug("Request Body Data: %s", pformat(body_data))
-    log.debug("Received response: %s", pformat(response_data))
+class PandaUnavailable(PandaException):
+    """Panda could not be reached, or did not respond in time.
+
+    Pages that show Panda data should catch this and render what they
+    can without it, rather than failing.
+    """
+    pass
+
+class PandaTimeout(PandaUnavailable):
+    """Panda did not respond in time.
+
+    Unlike other failures to reach Panda, these aren't retried, since a
+    retry would most likely time out as well, making the caller wait twice.
+    """
+    pass
+
+def _url_resource(url):
+    # '/videos/abc.json' -> 'videos'
+    return url.lstrip('/').split('/')[0].split('.')[0]
+
+def _add_page(data, page, per_page):
+    if page:
+        data['page'] = int(page)
+    if per_page:
+        data['per_page'] = int(per_page)
+
+class ProfileIndex(object):
+    """Lookup tables for a cloud's list of encoding profiles.
+
+    Panda doesn't require profile names to be unique, so a name may map to
+    several profiles. :attr:`name_to_id` holds the first of them, in the
+    order Panda lists them, and :attr:`name_to_ids` holds them all.
+
+    :param profiles: The result of :meth:`PandaClient.get_profiles`.
+    :type profiles: list of dicts
+    """
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.by_id = {}
+        self.name_to_id = {}
+        self.name_to_ids = {}
+        for p in profiles:
+            self.by_id[p['id']] = p
+            self.name_to_id.setdefault(p['name'], p['id'])
+            self.name_to_ids.setdefault(p['name'], []).append(p['id'])
+        self.id_to_name = dict((id, p['name']) for id, p in self.by_id.iteritems())
+
+    def names_to_ids(self, names):
+        """Return the IDs of every profile with one of the given names.
+
+        IDs are in the order Panda lists the profiles; unknown names are
+        ignored.
+        """
+        names = set(names)
+        return [p['id'] for p in self.profiles if p['name'] in names]
+
+    def ids_to_names(self, ids):
+        """Return the distinct names of the given profiles, in Panda's order."""
+        ids = set(ids)
+        seen = set()
+        names = []
+        for p in self.profiles:
+            if p['id'] in ids and p['name'] not in seen:
+                seen.add(p['name'])
+                names.append(p['name'])
+        return names
 
 class PandaClient(object):
-    def __init__(self, cloud_id, access_key, secret_key):
+    def __init__(self, cloud_id, access_key, secret_key, json_cache=None,
+                 connection_pool=None, shared_cache=None, breaker=None,
+                 retries=DEFAULT_RETRIES, metrics=None, tracer=None,
+                 api_host=None, api_port=None):
+        """
+        :param json_cache: The per-process response cache. Identical GETs
+                           made at the same time by several threads share
+                           one request, and if the cache has a
+                           ``stale_ttl``, expired responses are served
+                           while they are refreshed in the background.
+        :type json_cache: :class:`~mediacore_panda.lib.cache.ResponseCache`
+
+        :param connection_pool: The keep-alive connection pool to send
+                                requests through.
+        :type connection_pool: :class:`~mediacore_panda.lib.transport.ConnectionPool`
+
+        :param shared_cache: If given, cloud, preset and profile documents
+                             are cached here instead of in ``json_cache``,
+                             so that they are shared with other processes.
+        :type shared_cache: :class:`~mediacore_panda.lib.cache.SharedCacheBackend`
+
+        :param breaker: Tracks whether Panda is failing, so that requests
+                        can fail fast with :exc:`PandaUnavailable`.
+        :type breaker: :class:`~mediacore_panda.lib.breaker.CircuitBreaker`
+
+        :param retries: How many times to retry GET requests that failed
+                        to reach Panda, after a jittered exponential delay.
+        :type retries: int
+
+        :param metrics: Where to record each request. The process-wide
+                        metrics are used by default.
+        :type metrics: :class:`~mediacore_panda.lib.metrics.Metrics`
+
+        :param tracer: Logs each request and response for debugging. The
+                       process-wide tracer is used by default.
+        :type tracer: :class:`~mediacore_panda.lib.tracing.Tracer`
+
+        :param api_host: The Panda API host, if not the real Panda's, e.g.
+                         when using :mod:`~mediacore_panda.lib.emulator`.
+        :type api_host: str
+        :param api_port: The Panda API port.
+        :type api_port: int
+        """
         self.conn = panda.Panda(
             cloud_id.encode('utf-8'),
             access_key.encode('utf-8'),
             secret_key.encode('utf-8'),
         )
-        self.json_cache = {}
+        if api_host:
+            self.conn.api_host = api_host
+        if api_port:
+            self.conn.api_port = api_port
+        if json_cache is None:
+            json_cache = ResponseCache()
+        if connection_pool is None:
+            connection_pool = ConnectionPool()
+        if breaker is None:
+            breaker = CircuitBreaker()
+        if metrics is None:
+            metrics = default_metrics
+        if tracer is None:
+            tracer = default_tracer
+        self.json_cache = json_cache
+        self.connection_pool = connection_pool
+        self.shared_cache = shared_cache
+        self.breaker = breaker
+        self.retries = retries
+        self.metrics = metrics
+        self.tracer = tracer
+        self.refresh_pool = WorkerPool(REFRESH_WORKERS, name='panda-refresh')
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._profile_index = None
+        self._profile_index_lock = threading.Lock()
+
+    def _request(self, method, url, params):
+        # Sign the request exactly as panda.Panda._http_request does, but send
+        # it over a pooled keep-alive connection instead of a new one.
+        path = panda.canonical_path(url)
+        signed_query = self.conn._signed_query(method, path, params)
+        request_url = self.conn.api_path() + path
+        if method in (POST, PUT):
+            body = signed_query
+            headers = {'Content-type': 'application/x-www-form-urlencoded'}
+        else:
+            request_url += '?' + signed_query
+            body = None
+            headers = {}
+        return self._send(method, url, request_url, body, headers,
+                          len(body or '') + len(request_url))
+
+    def _send(self, method, url, request_url, body, headers, bytes_sent):
+        # Returns the decoded response. No response at all, a server error
+        # or a body that can't be decoded all mean that Panda is failing,
+        # so they count against the breaker and raise PandaUnavailable.
+        if not self.breaker.allow():
+            self.metrics.record_error('circuit_open')
+            raise PandaUnavailable('Panda is failing; not trying again yet.')
+        started = time.time()
+        succeeded = False
+        try:
+            try:
+                status, data = self.connection_pool.request(self.conn.api_host,
+                    self.conn.api_port, method, request_url, body, headers)
+            except socket.timeout, e:
+                self.metrics.record_request(method, url, time.time() - started,
+                    bytes_sent, 0, error=e.__class__.__name__)
+                raise PandaTimeout(e)
+            except (socket.error, httplib.HTTPException), e:
+                # This includes DNS lookup failures.
+                self.metrics.record_request(method, url, time.time() - started,
+                    bytes_sent, 0, error=e.__class__.__name__)
+                raise PandaUnavailable(e)
+            if status >= 500:
+                self.metrics.record_request(method, url, time.time() - started,
+                    bytes_sent, len(data), error='http_%d' % status)
+                raise PandaUnavailable('Panda responded with a server error.', status)
+            try:
+                obj = simplejson.loads(data)
+            except ValueError, e:
+                self.metrics.record_request(method, url, time.time() - started,
+                    bytes_sent, len(data), error='malformed')
+                raise PandaUnavailable('Panda sent an invalid response.', e)
+            succeeded = True
+        finally:
+            # The breaker must hear how every call it allowed went, whatever
+            # was raised, or a half-open breaker would wait on its trial call.
+            if succeeded:
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+        self.metrics.record_request(method, url, time.time() - started,
+            bytes_sent, len(data))
+        return obj
+
+    def _invalidate(self, url):
+        # Drop any cached responses that the mutation of this URL made stale.
+        prefixes = INVALIDATED_URLS.get(_url_resource(url), None)
+        if prefixes:
+            self.json_cache.invalidate(prefixes)
+            if self.shared_cache is not None:
+                for prefix in prefixes:
+                    if prefix[1:] in SHARED_NAMESPACES:
+                        self.shared_cache.bump_version(prefix[1:])
+
+    def _shared_cache_key(self, url, query_string_data):
+        # Several clouds may share one backend, so the cloud ID is part of the key.
+        return '%s:%s?%s' % (self.conn.cloud_id, url,
+                             urllib.urlencode(sorted(query_string_data.iteritems())))
+
+    def _get_json(self, url, query_string_data={}, refresh=False):
+        # The objects returned are shared with the cache and with other
+        # threads, so callers must copy them rather than change them.
+        # If refresh is true, a cached response isn't used, but is replaced.
+        namespace = self.shared_cache is not None and _url_resource(url)
+        if namespace in SHARED_NAMESPACES:
+            key = self._shared_cache_key(url, query_string_data)
+            return self._single_flight(key, self._get_shared_json,
+                                       namespace, key, url, query_string_data)
 
-    def _get_json(self, url, query_string_data={}):
         # This function is memoized with a custom hashing algorithm for its arguments.
         hash_tuple = url, frozenset(query_string_data.iteritems())
-        if hash_tuple in self.json_cache:
-            return self.json_cache[hash_tuple]
+        obj, fresh = refresh and (None, False) or self.json_cache.lookup(hash_tuple)
+        if obj is not None:
+            if not fresh:
+                # Serve the stale copy now, and refresh it for next time.
+                self._revalidate(hash_tuple, url, query_string_data)
+            return obj
+        return self._single_flight(hash_tuple, self._fetch_and_cache,
+                                   hash_tuple, url, query_string_data)
+
+    def _get_shared_json(self, namespace, key, url, query_string_data):
+        obj = self.shared_cache.get(namespace, key)
+        if obj is not None:
+            return obj
+        # Read the version before fetching, so that if another process
+        # invalidates this namespace meanwhile, our stale copy is ignored.
+        version = self.shared_cache.get_version(namespace)
+        obj = self._fetch_json(url, query_string_data)
+        ttl = self.json_cache.ttl_for(url)
+        self.shared_cache.set(namespace, key, obj, ttl, version)
+        return obj
 
+    def _fetch_and_cache(self, hash_tuple, url, query_string_data):
+        obj = self._fetch_json(url, query_string_data)
+        self.json_cache.set(hash_tuple, obj)
+        return obj
+
+    def _single_flight(self, key, func, *args):
+        # Returns func(*args), unless another thread is already running the
+        # call for this key, in which case its result is shared instead.
+        self._inflight_lock.acquire()
         try:
-            json = self.conn.get(request_path=url, params=query_string_data)
-        except gaierror, e:
-            # Catch socket errors and re-raise them as Panda errors.
-            raise PandaException(e)
+            future = self._inflight.get(key, None)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        finally:
+            self._inflight_lock.release()
+        if not leader:
+            return future.result()
 
-        obj = simplejson.loads(json)
-        log_request(url, GET, query_string_data, None, obj)
+        try:
+            try:
+                result = func(*args)
+            except:
+                future.set_exception(sys.exc_info())
+                raise
+            future.set_result(result)
+            return result
+        finally:
+            self._inflight_lock.acquire()
+            try:
+                del self._inflight[key]
+            finally:
+                self._inflight_lock.release()
+
+    def _revalidate(self, hash_tuple, url, query_string_data):
+        # Refresh a stale cache entry in the background, unless that's
+        # already underway.
+        self._inflight_lock.acquire()
+        try:
+            if hash_tuple in self._inflight:
+                return
+        finally:
+            self._inflight_lock.release()
+        def refresh():
+            try:
+                self._single_flight(hash_tuple, self._fetch_and_cache,
+                                    hash_tuple, url, query_string_data)
+            except PandaException, e:
+                log.warning('Could not refresh %s from Panda: %s', url, e)
+        self.refresh_pool.submit(refresh)
+
+    def _fetch_json(self, url, query_string_data):
+        # GETs are safe to repeat, so transient failures are retried.
+        delays = backoff_delays(self.retries)
+        while True:
+            try:
+                obj = self._request(GET, url, query_string_data)
+                break
+            except PandaTimeout:
+                raise
+            except PandaUnavailable, e:
+                delay = next(delays, None)
+                if delay is None or self.breaker.state != CLOSED:
+                    raise
+                log.warning('Retrying Panda GET %s in %.2fs: %s', url, delay, e)
+                time.sleep(delay)
+
+        return self._decode(url, GET, query_string_data, None, obj)
+
+    def _decode(self, url, method, query_string_data, body_data, obj):
+        # Traces a decoded response, and raises the error it reports, if any.
+        self.tracer.trace(method, url, query_string_data, body_data, obj)
         if 'error' in obj:
+            self.metrics.record_error(obj['error'])
             raise PandaException(obj['error'], obj['message'])
-
-        self.json_cache[hash_tuple] = obj
         return obj
 
     def _post_json(self, url, post_data={}):
-        json = self.conn.post(request_path=url, params=post_data)
-        obj = simplejson.loads(json)
-        log_request(url, POST, None, post_data, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
-        return obj
+        obj = self._request(POST, url, post_data)
+        self._invalidate(url)
+        return self._decode(url, POST, None, post_data, obj)
+
+    def _upload_json(self, url, post_data, file, filename, size=None, progress=None):
+        # Streams the file as a multipart POST, with the signed parameters as
+        # the other form fields. The file isn't part of the signature.
+        path = panda.canonical_path(url)
+        fields = cgi.parse_qsl(self.conn._signed_query(POST, path, post_data))
+        stream = MultipartStream(fields, 'file', filename, file, size=size,
+                                 progress=progress)
+        headers = {
+            'Content-Type': stream.content_type,
+            'Content-Length': str(stream.length),
+        }
+        request_url = self.conn.api_path() + path
+        obj = self._send(POST, url, request_url, stream, headers,
+                          stream.length + len(request_url))
+        log.info('Uploaded %s to Panda: %d bytes at %.0f KB/s', filename,
+                 stream.sent, stream.throughput / 1024)
+        self._invalidate(url)
+        return self._decode(url, POST, None, dict(post_data, file=filename), obj)
 
     def _put_json(self, url, put_data={}):
-        json = self.conn.put(request_path=url, params=put_data)
-        obj = simplejson.loads(json)
-        log_request(url, PUT, None, put_data, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
-        return obj
+        obj = self._request(PUT, url, put_data)
+        self._invalidate(url)
+        return self._decode(url, PUT, None, put_data, obj)
 
     def _delete_json(self, url, query_string_data={}):
-        json = self.conn.delete(request_path=url, params=query_string_data)
-        obj = simplejson.loads(json)
-        log_request(url, DELETE, query_string_data, None, obj)
-        if 'error' in obj:
-            raise PandaException(obj['error'], obj['message'])
-        return obj
+        obj = self._request(DELETE, url, query_string_data)
+        self._invalidate(url)
+        return self._decode(url, DELETE, query_string_data, None, obj)
 
     def get_cloud(self):
         """Get the data for the currently selected Panda cloud."""
@@ -144,20 +490,31 @@ class PandaClient(object):
         url = '/presets.json'
         return self._get_json(url)
 
-    def get_videos(self, status=None):
+    def get_videos(self, status=None, page=None, per_page=None, refresh=False):
         """List all videos, filtered by status.
 
         :param status: Filter by status. One of 'success', 'fail', 'processing'.
         :type status: str
 
+        :param page: The page of results to return, starting from 1.
+        :type page: int
+
+        :param per_page: The number of results per page.
+        :type per_page: int
+
+        :param refresh: Ask Panda, even if the list is cached.
+        :type refresh: bool
+
         :rtype: list of dicts
         """
         data = {}
         if status in ('success', 'fail', 'processing'):
             data['status'] = status
-        return self._get_json('/videos.json', data)
+        _add_page(data, page, per_page)
+        return self._get_json('/videos.json', data, refresh=refresh)
 
-    def get_encodings(self, status=None, profile_id=None, profile_name=None, video_id=None):
+    def get_encodings(self, status=None, profile_id=None, profile_name=None, video_id=None,
+                      page=None, per_page=None, refresh=False):
         """List all encoded instances of all videos, filtered by whatever critera are provided.
 
         :param status: Filter by status. One of 'success', 'fail', 'processing'.
@@ -172,6 +529,15 @@ class PandaClient(object):
         :param video_id: filter by video_id
         :type video_id: str
 
+        :param page: The page of results to return, starting from 1.
+        :type page: int
+
+        :param per_page: The number of results per page.
+        :type per_page: int
+
+        :param refresh: Ask Panda, even if the list is cached.
+        :type refresh: bool
+
         :rtype: list of dicts
         """
         data = {}
@@ -183,7 +549,8 @@ class PandaClient(object):
             data['profile_name'] = profile_name
         if video_id:
             data['video_id'] = video_id
-        return self._get_json('/encodings.json', data)
+        _add_page(data, page, per_page)
+        return self._get_json('/encodings.json', data, refresh=refresh)
 
     def get_profiles(self):
         """List all encoding profiles.
@@ -192,16 +559,40 @@ class PandaClient(object):
         """
         return self._get_json('/profiles.json')
 
-    def get_video(self, video_id):
+    def get_profile_index(self):
+        """Return a :class:`ProfileIndex` of the current profile list.
+
+        The index is only rebuilt when the list itself changes, i.e. when
+        the cached response expires or is invalidated by adding or deleting
+        a profile.
+        """
+        return self._index_profiles(self.get_profiles())
+
+    def _index_profiles(self, profiles):
+        # Returns the ProfileIndex of the given profile list, reusing the
+        # last one if the list is the same (cached) object.
+        self._profile_index_lock.acquire()
+        try:
+            index = self._profile_index
+            if index is None or index.profiles is not profiles:
+                index = self._profile_index = ProfileIndex(profiles)
+            return index
+        finally:
+            self._profile_index_lock.release()
+
+    def get_video(self, video_id, refresh=False):
         """Get the details for a single video.
 
         :param video_id: The ID string of the video.
         :type video_id: str
 
+        :param refresh: Ask Panda, even if the video is cached.
+        :type refresh: bool
+
         :rtype: dict
         """
         url = '/videos/%s.json' % video_id
-        return self._get_json(url)
+        return self._get_json(url, refresh=refresh)
 
     def get_encoding(self, encoding_id):
         """Get the details for a single encoding of a video.
@@ -281,7 +672,7 @@ class PandaClient(object):
             width = width,
             height = height
         )
-        for x in data:
+        for x in data.keys():
             if data[x] == None:
                 data.pop(x)
         return self._post_json('/profiles.json', data)
@@ -322,9 +713,14 @@ class PandaClient(object):
         url = '/profiles/%s.json' % profile_id
         return self._delete_json(url)['deleted']
 
-    def transcode_file(self, file_or_source_url, profile_ids, state_update_url=None):
+    def transcode_file(self, file_or_source_url, profile_ids, state_update_url=None,
+                       filename=None, size=None, progress=None):
         """Upload or mark a video file for transcoding.
 
+        A file is streamed to Panda in chunks, so it needn't fit in memory.
+        An upload that fails part way must be started again from the
+        beginning.
+
         :param file_or_source_url: A file object or url to transfer to Panda
         :type file_or_source_url: A file-like object or str
 
@@ -336,22 +732,38 @@ class PandaClient(object):
                                  http://www.pandastream.com/docs/api
         :type state_update_url: str
 
+        :param filename: The name of the file being uploaded. Panda uses
+                         its extension to help identify the format.
+        :type filename: str
+
+        :param size: The number of bytes to upload from the file, if it
+                     can't be worked out (e.g. from a pipe).
+        :type size: int
+
+        :param progress: Called with the number of bytes uploaded so far
+                         and the total, as the upload proceeds.
+        :type progress: callable
+
         :returns: a dict representing the newly created video object
         :rtype: dict
         """
         if not profile_ids:
             raise Exception('Must provide at least one profile ID.')
 
-        if not isinstance(file_or_source_url, basestring):
-            raise Exception('File-like objects are not currently supported.')
-
         data = {
-            'source_url': file_or_source_url,
             'profiles': ','.join(profile_ids),
         }
         if state_update_url:
             data['state_update_url'] = state_update_url
-        return self._post_json('/videos.json', data)
+
+        if isinstance(file_or_source_url, basestring):
+            data['source_url'] = file_or_source_url
+            return self._post_json('/videos.json', data)
+
+        if filename is None:
+            filename = os.path.basename(getattr(file_or_source_url, 'name', 'video'))
+        return self._upload_json('/videos.json', data, file_or_source_url,
+                                 filename, size=size, progress=progress)
 
     def add_transcode_profile(self, video_id, profile_id):
         """Add a transcode profile to an existing Panda video.
@@ -373,57 +785,113 @@ class PandaClient(object):
 
 
 class PandaHelper(object):
-    def __init__(self, cloud_id, access_key, secret_key):
-        self.client = PandaClient(cloud_id, access_key, secret_key)
+    def __init__(self, cloud_id, access_key, secret_key, max_workers=0,
+                 timeout=None, connection_pool=None, shared_cache=None,
+                 breaker=None, retries=DEFAULT_RETRIES, json_cache=None,
+                 api_host=None, api_port=None):
+        """
+        :param max_workers: If non-zero, independent API requests are issued
+                            in parallel using a shared pool of this many threads.
+        :type max_workers: int
+
+        :param timeout: When requests are issued in parallel, the number of
+                        seconds to wait for a whole batch of them to complete.
+        :type timeout: float or None
+
+        :param connection_pool: The keep-alive connection pool to send
+                                requests through. A new one is created by
+                                default.
+        :type connection_pool: :class:`~mediacore_panda.lib.transport.ConnectionPool`
+
+        :param shared_cache: A cache for account-level documents that is
+                             shared with other processes.
+        :type shared_cache: :class:`~mediacore_panda.lib.cache.SharedCacheBackend`
+
+        :param breaker: The circuit breaker for requests to Panda.
+        :type breaker: :class:`~mediacore_panda.lib.breaker.CircuitBreaker`
+
+        :param retries: How many times to retry GETs that failed to reach Panda.
+        :type retries: int
+
+        :param json_cache: The per-process response cache. A new one with
+                           the default settings is created by default.
+        :type json_cache: :class:`~mediacore_panda.lib.cache.ResponseCache`
+
+        :param api_host: The Panda API host, if not the real Panda's.
+        :type api_host: str
+        :param api_port: The Panda API port.
+        :type api_port: int
+        """
+        self.client = PandaClient(cloud_id, access_key, secret_key,
+                                  json_cache=json_cache,
+                                  connection_pool=connection_pool,
+                                  shared_cache=shared_cache,
+                                  breaker=breaker, retries=retries,
+                                  api_host=api_host, api_port=api_port)
+        self.pool = max_workers and shared_pool(max_workers) or None
+        self.timeout = timeout
+
+    def _map(self, func, items):
+        # Returns map(func, items), running the calls in parallel if this
+        # helper has a worker pool. The results stay in order, and the first
+        # exception raised (in order) is propagated, as with the serial map.
+        if self.pool is None or len(items) < 2:
+            return map(func, items)
+        try:
+            func = self.client.tracer.bind(self.client.metrics.bind(func))
+            return self.pool.map(func, items, self.timeout)
+        except DeadlineExceeded, e:
+            raise PandaUnavailable('Timed out waiting for Panda to respond.', self.timeout)
 
     def profile_names_to_ids(self, names):
-        profiles = self.client.get_profiles()
-        ids = []
-        for p in profiles:
-            if p['name'] in names:
-                ids.append(p['id'])
-        return ids
+        return self.client.get_profile_index().names_to_ids(names)
 
     def profile_ids_to_names(self, ids):
-        profiles = self.client.get_profiles()
-        names = []
-        for p in profiles:
-            if p['id'] in ids and p['name'] not in names:
-                names.append(p['name'])
-        return names
+        return self.client.get_profile_index().ids_to_names(ids)
 
     def get_profile_ids_names(self):
-        profiles = self.client.get_profiles()
-        out = {}
-        for profile in profiles:
-            out[profile['id']] = profile['name']
-        return out
+        # The returned dict is shared, so callers mustn't modify it.
+        return self.client.get_profile_index().id_to_name
 
     def associate_video_id(self, media_file, video_id, state=None):
-        # Create a meta_key for this MediaCore::MediaFile -> Panda::Video pairing.
-        # This is sort of a perversion of the meta table, but hey, it works.
-        meta_key = "%s%s" % (META_VIDEO_PREFIX, video_id)
-        media_file.meta[meta_key] = state
+        video = PandaVideo()
+        video.media_file = media_file
+        video.video_id = video_id
+        video.state = state
+        DBSession.add(video)
 
     def disassociate_video_id(self, media_file, video_id):
-        # Create a meta_key for this MediaCore::MediaFile -> Panda::Video pairing.
-        # This is sort of a perversion of the meta table, but hey, it works.
-        meta_key = "%s%s" % (META_VIDEO_PREFIX, video_id)
-        mfm = DBSession.query(MediaFilesMeta)\
-                .filter(MediaFilesMeta.media_files_id==media_file.id)\
-                .filter(MediaFilesMeta.key==meta_key)
-        for x in mfm:
-            DBSession.delete(x)
+        PandaVideo.query\
+            .filter(PandaVideo.media_file_id == media_file.id)\
+            .filter(PandaVideo.video_id == video_id)\
+            .delete(synchronize_session=False)
+        self._forget_video_states([video_id])
 
     def list_associated_video_ids(self, media_file):
         # This method returns a list, for futureproofing and testing, but the
         # current logic basically ensures that the list will have at most one element.
-        ids = []
-        offset = len(META_VIDEO_PREFIX)
-        for key, value in media_file.meta.iteritems():
-            if key.startswith(META_VIDEO_PREFIX):
-                ids.append(key[offset:])
-        return ids
+        return [id for file_id, id in self._query_associations([media_file.id])]
+
+    def _query_associations(self, media_file_ids):
+        # Returns (media file ID, video ID) tuples for the given files.
+        if not media_file_ids:
+            return []
+        return DBSession.query(PandaVideo.media_file_id, PandaVideo.video_id)\
+            .filter(PandaVideo.media_file_id.in_(media_file_ids))\
+            .filter(or_(PandaVideo.state == None, PandaVideo.state != FINALIZED))\
+            .order_by(PandaVideo.id)\
+            .all()
+
+    def get_associated_media_file(self, video_id):
+        """Get the MediaFile that the given Panda video was created from.
+
+        :param video_id: The ID string of the video.
+        :type video_id: str
+
+        :rtype: :class:`~mediacore.model.media.MediaFile` or None
+        """
+        video = PandaVideo.query.filter(PandaVideo.video_id == video_id).first()
+        return video and video.media_file or None
 
     def get_associated_video_dicts(self, media_file):
         ids = self.list_associated_video_ids(media_file)
@@ -442,21 +910,337 @@ class PandaHelper(object):
                 encoding_dicts[encoding['id']] = encoding
         return encoding_dicts
 
-    def get_all_associated_encoding_dicts(self, media_files):
+    def get_associated_dicts(self, media_files):
+        """Get the Panda video and encoding dicts for many files at once.
+
+        All associated video IDs are collected first so that they can be
+        resolved with as few API calls as possible.
+
+        :param media_files: The MediaFiles to look up.
+        :type media_files: list of :class:`~mediacore.model.media.MediaFile`
+
+        :returns: An ``(encoding_dicts, video_dicts)`` tuple. Each maps
+                  every given MediaFile ID to a dict of Panda encoding or
+                  video dicts, keyed by their Panda ID.
+        :rtype: tuple of dicts
+        """
+        file_video_ids = self._list_file_video_ids(media_files)
+        return self._get_associated_dicts(file_video_ids)
+
+    def _list_file_video_ids(self, media_files):
+        # Returns a list of (file ID, list of associated video IDs) tuples,
+        # looking up the associations of every file with a single query.
+        file_ids = [file.id for file in media_files]
+        video_ids = dict((id, []) for id in file_ids)
+        for file_id, video_id in self._query_associations(file_ids):
+            video_ids[file_id].append(video_id)
+        return [(id, video_ids[id]) for id in file_ids]
+
+    def _get_associated_dicts(self, file_video_ids):
+        # Fetches and assembles the return value of get_associated_dicts.
+        # Since only IDs are passed in, this is safe to call from any thread.
+        all_video_ids = []
+        for file_id, ids in file_video_ids:
+            all_video_ids.extend(ids)
+        videos, video_encodings = self._get_videos_and_encodings(all_video_ids)
+        return self._assemble_associated_dicts(file_video_ids, videos, video_encodings)
+
+    def get_mirrored_dicts(self, media_files, refresh=False, fetch=True):
+        """Get the video and encoding dicts for many files from the local mirror.
+
+        Only videos that have never been mirrored are fetched from Panda,
+        unless ``refresh`` is true, in which case every video is fetched
+        and its mirrored state updated. If ``fetch`` is false, Panda is not
+        contacted at all, and unmirrored videos are left out.
+
+        :returns: The same ``(encoding_dicts, video_dicts)`` tuple as
+                  :meth:`get_associated_dicts`.
+        :rtype: tuple of dicts
+        """
+        file_video_ids = self._list_file_video_ids(media_files)
+        all_video_ids = []
+        for file_id, ids in file_video_ids:
+            all_video_ids.extend(ids)
+
+        if refresh and fetch:
+            videos, video_encodings = {}, {}
+            stale_ids = all_video_ids
+        else:
+            videos, video_encodings = self._load_video_states(all_video_ids)
+            stale_ids = [id for id in all_video_ids if id not in videos]
+
+        if stale_ids and fetch:
+            fetched_videos, fetched_encodings = self._get_videos_and_encodings(stale_ids)
+            self._store_video_states(fetched_videos, fetched_encodings)
+            videos.update(fetched_videos)
+            video_encodings.update(fetched_encodings)
+        return self._assemble_associated_dicts(file_video_ids, videos, video_encodings)
+
+    def refresh_video_states(self, video_ids):
+        """Fetch the given videos from Panda and update their mirrored state."""
+        videos, video_encodings = self._get_videos_and_encodings(video_ids)
+        self._store_video_states(videos, video_encodings)
+
+    def refresh_processing_videos(self, max_age, limit=None):
+        """Refresh the mirrored state of videos that Panda is still encoding.
+
+        Notifications only arrive when an encoding starts or finishes, so
+        this keeps the progress shown on the admin pages moving. Only
+        videos that weren't refreshed in the last ``max_age`` seconds are
+        fetched, the least recently refreshed first, so that several
+        processes doing this don't repeat each other's work.
+
+        :param max_age: Seconds after which a mirrored video is refreshed.
+        :param limit: The most videos to refresh.
+        :returns: The IDs of the videos that were refreshed.
+        :rtype: list
+        """
+        cutoff = datetime.now() - timedelta(seconds=max_age)
+        processing = DBSession.query(PandaEncodingState.video_id)\
+            .filter(PandaEncodingState.status == u'processing')
+        query = DBSession.query(PandaVideoState.video_id)\
+            .filter(PandaVideoState.refreshed_on < cutoff)\
+            .filter(or_(PandaVideoState.status == u'processing',
+                        PandaVideoState.video_id.in_(processing)))\
+            .order_by(PandaVideoState.refreshed_on)
+        if limit:
+            query = query.limit(limit)
+        video_ids = [id for id, in query]
+        if video_ids:
+            self.refresh_video_states(video_ids)
+        return video_ids
+
+    def reconcile_videos(self, panda_videos):
+        """Update many associated videos without relying on notifications.
+
+        This is for when Panda's notifications can't reach us. One paged
+        listing of the cloud's videos and one of its encodings, fetched
+        fresh, give the state of every video: their mirrored state is
+        updated, and the ones whose encodings have all succeeded are
+        finalized. Only when a listing is too long to page through are the
+        videos it leaves out fetched individually.
+
+        Videos that Panda doesn't have (e.g. because they were deleted from
+        it) are marked as :data:`~mediacore_panda.model.GONE`.
+
+        :param panda_videos: The associations to update.
+        :type panda_videos: list of :class:`~mediacore_panda.model.PandaVideo`
+        :returns: The video dicts and lists of encoding dicts that were found,
+                  both keyed by video ID, a list of the IDs of the videos
+                  that were finalized, and a list of the IDs of the videos
+                  that are gone.
+        :rtype: tuple
+        """
+        wanted = dict((v.video_id, v) for v in panda_videos)
+        (all_videos, videos_complete), (all_encodings, encodings_complete) = \
+            self._map(self._list_fresh, [self.client.get_videos, self.client.get_encodings])
+
+        videos = {}
+        video_encodings = {}
+        for video in all_videos:
+            if video['id'] in wanted:
+                videos[video['id']] = video
+                video_encodings[video['id']] = []
+        if encodings_complete:
+            for encoding in all_encodings:
+                if encoding['video_id'] in videos:
+                    video_encodings[encoding['video_id']].append(encoding)
+        else:
+            # A video's encodings may be split across the pages that were
+            # fetched and the ones that weren't.
+            ids = videos.keys()
+            for id, encodings in zip(ids, self._map(self._get_fresh_encodings, ids)):
+                video_encodings[id] = encodings
+
+        gone = []
+        missing = [id for id in wanted if id not in videos]
+        if videos_complete:
+            gone = missing
+        else:
+            for id, state in zip(missing, self._map(self._get_state_if_exists, missing)):
+                if state is None:
+                    gone.append(id)
+                else:
+                    videos[id], video_encodings[id] = state
+        self._store_video_states(videos, video_encodings)
+
+        if gone:
+            for id in gone:
+                log.warning('Panda video %s was not found in the cloud.', id)
+                wanted[id].state = GONE
+            self._forget_video_states(gone)
+
+        finalized = []
+        for id, v in videos.iteritems():
+            encodings = video_encodings[id]
+            if v['status'] == 'success' and encodings \
+            and all(e['status'] == 'success' for e in encodings):
+                self._finalize_video(wanted[id].media_file, v, encodings)
+                finalized.append(id)
+        return videos, video_encodings, finalized, gone
+
+    def _list_fresh(self, get):
+        # Bypasses the cache, since videos may be finalized from the listing.
+        return self._list(get, refresh=True)
+
+    def _get_fresh_encodings(self, video_id):
+        # Bypasses the cache, as _list_fresh does.
+        return self.client.get_encodings(video_id=video_id, refresh=True)
+
+    def _get_state_if_exists(self, video_id):
+        # Returns the video's state from Panda, bypassing the cache since
+        # the video may be finalized from it, or None if Panda doesn't
+        # have the video.
+        try:
+            return self._get_video_state(video_id, refresh=True)
+        except PandaUnavailable:
+            raise
+        except PandaException, e:
+            log.info('Could not get Panda video %s: %s', video_id, e)
+            return None
+
+    def _load_video_states(self, video_ids):
+        # Returns the mirrored video dicts and lists of encoding dicts, both
+        # keyed by video ID, in the same shape as _get_videos_and_encodings.
+        videos = {}
+        video_encodings = {}
+        if video_ids:
+            for state in PandaVideoState.query\
+                    .filter(PandaVideoState.video_id.in_(video_ids)):
+                videos[state.video_id] = state.as_dict()
+            for state in PandaEncodingState.query\
+                    .filter(PandaEncodingState.video_id.in_(video_ids)):
+                video_encodings.setdefault(state.video_id, []).append(state.as_dict())
+        return videos, video_encodings
+
+    def _store_video_states(self, videos, video_encodings):
+        # Replaces the mirrored state of the given videos and their encodings.
+        if not videos:
+            return
+        video_ids = videos.keys()
+        existing = dict((state.video_id, state) for state in PandaVideoState.query\
+            .filter(PandaVideoState.video_id.in_(video_ids)))
+        now = datetime.now()
+        for id, video in videos.iteritems():
+            state = existing.get(id, None)
+            if state is None:
+                state = PandaVideoState()
+                DBSession.add(state)
+            state.update_from(video)
+            # Set even if nothing else changed, for refresh_processing_videos.
+            state.refreshed_on = now
+
+        DBSession.flush()
+        PandaEncodingState.query\
+            .filter(PandaEncodingState.video_id.in_(video_ids))\
+            .delete(synchronize_session=False)
+        for id in video_ids:
+            for encoding in video_encodings.get(id, ()):
+                state = PandaEncodingState()
+                state.update_from(encoding)
+                DBSession.add(state)
+
+    def _store_encoding_state(self, encoding):
+        # Mirrors a single encoding of a video that is already mirrored.
+        if PandaVideoState.query.get(encoding['video_id']) is None:
+            return
+        state = PandaEncodingState.query.get(encoding['id'])
+        if state is None:
+            state = PandaEncodingState()
+            DBSession.add(state)
+        state.update_from(encoding)
+
+    def _forget_encoding_state(self, encoding_id):
+        # Flush first, so that no pending state is inserted after the delete.
+        DBSession.flush()
+        PandaEncodingState.query\
+            .filter(PandaEncodingState.encoding_id == encoding_id)\
+            .delete(synchronize_session=False)
+
+    def _forget_video_states(self, video_ids):
+        # Flush first, so that no pending state is inserted after the delete.
+        DBSession.flush()
+        PandaVideoState.query\
+            .filter(PandaVideoState.video_id.in_(video_ids))\
+            .delete(synchronize_session=False)
+        PandaEncodingState.query\
+            .filter(PandaEncodingState.video_id.in_(video_ids))\
+            .delete(synchronize_session=False)
+
+    def _assemble_associated_dicts(self, file_video_ids, videos, video_encodings):
         encoding_dicts = {}
-        for file in media_files:
-            dicts = self.get_associated_encoding_dicts(file)
-            if dicts:
-                encoding_dicts[file.id] = dicts
-        return encoding_dicts
+        video_dicts = {}
+        for file_id, ids in file_video_ids:
+            encoding_dicts[file_id] = file_encodings = {}
+            video_dicts[file_id] = file_videos = {}
+            for id in ids:
+                video = videos.get(id, None)
+                if video is None:
+                    # Not mirrored, and Panda wasn't asked.
+                    continue
+                file_videos[video['id']] = video
+                for encoding in video_encodings.get(id, ()):
+                    file_encodings[encoding['id']] = encoding
+        return encoding_dicts, video_dicts
+
+    def _get_videos_and_encodings(self, video_ids):
+        # Returns a dict of video dicts and a dict of encoding lists, both
+        # keyed by video ID.
+        videos = {}
+        video_encodings = {}
+        if len(video_ids) >= BATCH_LISTING_THRESHOLD:
+            wanted = set(video_ids)
+            (all_videos, _), (all_encodings, complete) = self._map(self._list,
+                [self.client.get_videos, self.client.get_encodings])
+            for video in all_videos:
+                if video['id'] in wanted:
+                    videos[video['id']] = video
+            if complete:
+                for encoding in all_encodings:
+                    if encoding['video_id'] in wanted:
+                        video_encodings.setdefault(encoding['video_id'], []).append(encoding)
+
+        # Fall back to fetching anything that wasn't in the listings.
+        missing = [id for id in video_ids if id not in videos]
+        for id, (video, encodings) in zip(missing, self._map(self._get_video_state, missing)):
+            videos[id] = video
+            video_encodings[id] = encodings
+        self._fetch_unlisted_encodings(videos, video_encodings)
+        return videos, video_encodings
+
+    def _fetch_unlisted_encodings(self, videos, video_encodings):
+        # A video with no encodings in a listing may only have been left out
+        # of the pages that were fetched, so ask Panda about each of them.
+        unlisted = [id for id in videos if id not in video_encodings]
+        for id, encodings in zip(unlisted, self._map(self._get_encodings, unlisted)):
+            video_encodings[id] = encodings
+
+    def _get_encodings(self, video_id):
+        return self.client.get_encodings(video_id=video_id)
+
+    def _list(self, get, **filters):
+        # Returns the items from the first LISTING_MAX_PAGES pages of a
+        # listing, and whether that was all of them.
+        items = []
+        for page in xrange(1, LISTING_MAX_PAGES + 1):
+            results = get(page=page, per_page=LISTING_PAGE_SIZE, **filters)
+            items.extend(results)
+            if len(results) < LISTING_PAGE_SIZE:
+                return items, True
+        return items, False
+
+    def _get_video_state(self, video_id, refresh=False):
+        # Returns the video dict and the list of its encoding dicts.
+        return self.client.get_video(video_id, refresh=refresh), \
+            self.client.get_encodings(video_id=video_id, refresh=refresh)
+
+    def get_all_associated_encoding_dicts(self, media_files):
+        encoding_dicts, video_dicts = self.get_associated_dicts(media_files)
+        return dict((id, dicts) for id, dicts in encoding_dicts.iteritems() if dicts)
 
     def get_all_associated_video_dicts(self, media_files):
-        video_dicts = {}
-        for file in media_files:
-            dicts = self.get_associated_video_dicts(file)
-            if dicts:
-                video_dicts[file.id] = dicts
-        return video_dicts
+        encoding_dicts, video_dicts = self.get_associated_dicts(media_files)
+        return dict((id, dicts) for id, dicts in video_dicts.iteritems() if dicts)
 
     def cancel_transcode(self, media_file, encoding_id):
         video_ids = self.list_associated_video_ids(media_file)
@@ -466,6 +1250,7 @@ class PandaHelper(object):
         if e['video_id'] not in video_ids:
             raise PandaException('Specified encoding is not associated with the specified media file. Cannot cancel job.', encoding_id, media_file)
         self.client.delete_encoding(encoding_id)
+        self._forget_encoding_state(encoding_id)
 
     def retry_transcode(self, media_file, encoding_id):
         # Ensure that the encoding to retry belongs to the given media file.
@@ -476,49 +1261,224 @@ class PandaHelper(object):
 
         # Upon successful deletion of the old encoding object, retry!
         if self.client.delete_encoding(encoding_id):
-            self.client.add_transcode_profile(e['video_id'], e['profile_id'])
+            self._forget_encoding_state(encoding_id)
+            retry = self.client.add_transcode_profile(e['video_id'], e['profile_id'])
+            self._store_encoding_state(retry)
         else:
             raise PandaException('Could not delete specified encoding.', encoding_id)
 
-    def transcode_media_file(self, media_file, profile_ids, state_update_url=None):
-        uri = download_uri(media_file)
-        if not uri:
-            raise PandaException('Cannot transcode because no download URL exists.')
-        transcode_details = self.client.transcode_file(str(uri), profile_ids, state_update_url)
+    def add_transcode_profile(self, video_id, profile_id):
+        """Encode an already associated video with an additional profile.
+
+        If the video was already finalized, it is reopened so that a
+        MediaFile is created for the new encoding when it is complete.
+        """
+        encoding = self.client.add_transcode_profile(video_id, profile_id)
+        self.reopen_video(video_id)
+        return encoding
+
+    def reopen_video(self, video_id):
+        """Undo the finalization of a video that is getting a new encoding."""
+        video = PandaVideo.query.filter(PandaVideo.video_id == video_id).first()
+        if video is not None and video.state == FINALIZED:
+            video.state = None
+
+    def transcode_media_file(self, media_file, profile_ids, state_update_url=None,
+                             source_url=None, file_path=None, progress=None):
+        # A file we can read is uploaded, so that Panda needn't be able to
+        # download it from us. Otherwise Panda fetches it from its URL.
+        # progress is called with the bytes sent and the total, as the
+        # upload goes.
+        if file_path and os.path.exists(file_path):
+            file = open(file_path, 'rb')
+            try:
+                name = os.path.basename(file_path)
+                log_progress = LogProgress(name)
+                def report(sent, total):
+                    log_progress(sent, total)
+                    if progress is not None:
+                        progress(sent, total)
+                transcode_details = self.client.transcode_file(file, profile_ids,
+                    state_update_url, filename=name, progress=report)
+            finally:
+                file.close()
+        else:
+            uri = source_url or download_uri(media_file)
+            if not uri:
+                raise PandaException('Cannot transcode because no download URL exists.')
+            transcode_details = self.client.transcode_file(str(uri), profile_ids, state_update_url)
         self.associate_video_id(media_file, transcode_details['id'])
 
     def video_status_update(self, media_file, video_id=None):
         # If no ID is specified, update all associated videos!
         if video_id is None:
             video_ids = self.list_associated_video_ids(media_file)
-            for video_id in video_ids:
-                self.video_status_update(media_file, video_id)
+        else:
+            video_ids = [video_id]
+
+        # Fetch everything up front (in parallel, if possible), because the
+        # database work below must all happen in this thread.
+        states = self._map(self._get_video_state, video_ids)
+        self._store_video_states(
+            dict((v['id'], v) for v, encodings in states),
+            dict((v['id'], encodings) for v, encodings in states))
+        for v, encodings in states:
+            self._finalize_video(media_file, v, encodings)
+
+    def handle_notification(self, media_file, video_id, encoding_id=None,
+                            status=None, progress=None):
+        """Apply a ``state_update_url`` notification sent by Panda.
+
+        Panda notifies us once for each encoding of a video, so rather than
+        fetching the whole video every time, only the named encoding's
+        mirrored state is updated, using the status and progress in the
+        notification when it includes them. The video is finalized, with
+        MediaFiles created for each encoding, when the last encoding succeeds.
+
+        :param media_file: The MediaFile named in the notification URL.
+        :param video_id: The ID string of the video.
+        :param encoding_id: The ID string of the encoding, if the notification
+                            is about one.
+        :param status: The encoding status, if included.
+        :param progress: The encoding progress percentage, if included.
+
+        :returns: True if the video was finalized.
+        :rtype: bool
+        :raises PandaException: If the notification is malformed.
+        """
+        for id in (video_id, encoding_id):
+            if id is not None and not NOTIFICATION_ID_RE.match(id):
+                raise PandaException('Invalid ID in Panda notification.', id)
+        if status is not None and status not in ENCODING_STATUSES:
+            raise PandaException('Invalid status in Panda notification.', status)
+        if progress is not None:
+            try:
+                progress = max(0, min(100, int(progress)))
+            except ValueError:
+                raise PandaException('Invalid progress in Panda notification.', progress)
+
+        # Panda may deliver the same notification more than once, even at
+        # the same time.
+        if status is not None:
+            event = status
+            if status == 'processing' and progress is not None:
+                event = u'%s:%d' % (status, progress)
+            if not PandaEvent.record(video_id, encoding_id, event):
+                log.info('Ignoring duplicate Panda notification for video %s', video_id)
+                return False
+
+        if video_id not in self.list_associated_video_ids(media_file):
+            # Most likely a late notification for a video we've finalized.
+            log.info('Ignoring Panda notification for unassociated video %s', video_id)
+            return False
+
+        if PandaVideoState.query.get(video_id) is None:
+            # We know nothing about this video yet, so mirror all of it.
+            self.refresh_video_states([video_id])
+        elif encoding_id is not None:
+            self._update_encoding_state(video_id, encoding_id, status, progress)
+        else:
+            self.refresh_video_states([video_id])
+
+        # The mirror may still hold encodings that have since been replaced
+        # or deleted, so a success is checked against Panda's own list.
+        return self._finalize_if_complete(media_file, video_id,
+                                          check=status == 'success')
+
+    def _update_encoding_state(self, video_id, encoding_id, status, progress):
+        state = PandaEncodingState.query.get(encoding_id)
+        if state is None or status is None:
+            # An encoding we haven't seen (e.g. a retry), or a notification
+            # without the state we need: ask Panda about just this encoding.
+            encoding = self.client.get_encoding(encoding_id)
+            if encoding['video_id'] != video_id:
+                raise PandaException('Encoding does not belong to the specified video.', encoding_id, video_id)
+            if state is None:
+                state = PandaEncodingState()
+                DBSession.add(state)
+            state.update_from(encoding)
             return
+        if state.video_id != video_id:
+            raise PandaException('Encoding does not belong to the specified video.', encoding_id, video_id)
+        state.status = status
+        if progress is not None:
+            state.encoding_progress = progress
+        elif status == 'success':
+            state.encoding_progress = 100
+
+    def _finalize_if_complete(self, media_file, video_id, check=False):
+        # Finalizes the video if Panda says every encoding has succeeded.
+        # Panda is only asked if none of the mirrored encodings are still
+        # processing, and either all have succeeded or check is true.
+        # Returns True if it finalized the video.
+        DBSession.flush()
+        statuses = set(status for status, in DBSession.query(PandaEncodingState.status)\
+            .filter(PandaEncodingState.video_id == video_id))
+        if not statuses or 'processing' in statuses \
+        or statuses != set(['success']) and not check:
+            return False
+
+        # The mirror may have been updated from notifications, which anyone
+        # can send and which lack the files' sizes and durations, so the
+        # MediaFiles are only ever made from what Panda itself reports.
+        encodings = self.client.get_encodings(video_id=video_id, refresh=True)
+
+        # The source video's metadata is only complete once Panda has
+        # finished processing it, so it may need to be fetched once more.
+        # The mirrored video only ever comes from Panda.
+        video = PandaVideoState.query.get(video_id)
+        if video.status == 'success' and video.duration is not None:
+            v = video.as_dict()
+        else:
+            v = self.client.get_video(video_id, refresh=True)
 
-        v = self.client.get_video(video_id)
-        encodings = self.client.get_encodings(video_id=video_id)
+        self._store_video_states({video_id: v}, {video_id: encodings})
+        if v['status'] != 'success' or not encodings \
+        or any(e['status'] != 'success' for e in encodings):
+            log.warning('Panda video %s is not complete, despite its notifications', video_id)
+            return False
+        self._finalize_video(media_file, v, encodings)
+        return True
 
+    def _finalize_video(self, media_file, v, encodings):
         # Only proceed if the video has completed all encoding steps successfully.
         if any(e['status'] != 'success' for e in encodings):
             return
 
+        # Make sure that concurrent or repeated updates only do this once.
+        if not PandaVideo.claim(v['id']):
+            log.info('Panda video %s has already been finalized', v['id'])
+            return
+
         profiles = self.get_profile_ids_names()
 
+        # A video that gains a new profile after it was first finalized (see
+        # add_transcode_profile) already has MediaFiles for its other files.
+        existing = set(file.unique_id for file in media_file.media.files)
+
         # For each successful encoding (and the original file), create a new MediaFile
+        # The dicts may be shared with the response cache, so they are copied
+        # rather than changed.
         display_name, orig_ext = os.path.splitext(media_file.display_name)
-        v['display_name'] = "(%s) %s%s" % ('original', display_name, v['extname'])
-        url = PANDA_URL_PREFIX + simplejson.dumps(v)
-        new_mf = add_new_media_file(media_file.media, url=url)
+        if v['id'] + v['extname'] not in existing:
+            v = dict(v, display_name="(%s) %s%s" % ('original', display_name, v['extname']))
+            url = encode_record(v)
+            new_mf = add_new_media_file(media_file.media, url=url)
 
         for e in encodings:
+            extname = e['extname']
             # Panda reports multi-bitrate http streaming encodings as .ts file
             # but the associated playlist is the only thing ipods, etc, can read.
-            if e['extname'] == '.ts':
-                e['extname'] = '.m3u8'
-
-            e['display_name'] = "(%s) %s%s" % (profiles[e['profile_id']].replace('_', ' '), display_name, e['extname'])
-            url = PANDA_URL_PREFIX + simplejson.dumps(e)
+            if extname == '.ts':
+                extname = '.m3u8'
+            if e['id'] + extname in existing:
+                continue
+
+            e = dict(e, extname=extname, display_name="(%s) %s%s" % (
+                profiles[e['profile_id']].replace('_', ' '), display_name, extname))
+            url = encode_record(e)
             new_mf = add_new_media_file(media_file.media, url=url)
 
-        self.disassociate_video_id(media_file, v['id'])
+        self._forget_video_states([v['id']])
+        PandaEvent.forget_progress(v['id'])
         # TODO: Now delete the exisitng media_file?
@@ -0,0 +1,155 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Non-blocking variants of :class:`PandaClient` and :class:`PandaHelper`.
+
+Every API method returns a :class:`~mediacore_panda.lib.pool.Future`
+immediately and runs on a :class:`~mediacore_panda.lib.pool.WorkerPool`,
+so one process can have as many Panda requests in flight as the pool has
+threads. For example::
+
+    client = AsyncPandaClient(cloud_id, access_key, secret_key, WorkerPool(200))
+    futures = [client.get_video(id) for id in video_ids]
+    videos = [f.result() for f in futures]
+
+Request signing, caching and error handling are shared with the blocking
+classes, and a :class:`~mediacore_panda.lib.PandaException` raised by a
+request is re-raised by :meth:`Future.result`.
+
+Python 2 has no asyncio, so rather than an event loop these are backed
+by threads; size the pool to the number of requests you want in flight.
+"""
+
+import time
+
+from mediacore_panda.lib import PandaClient, PandaHelper, PandaUnavailable
+from mediacore_panda.lib.pool import DeadlineExceeded
+
+# The blocking PandaClient methods that AsyncPandaClient runs in the pool.
+CLIENT_METHODS = (
+    'get_cloud', 'get_presets', 'get_videos', 'get_encodings', 'get_profiles',
+    'get_video', 'get_encoding', 'get_profile', 'add_profile',
+    'add_profile_from_preset', 'delete_encoding', 'delete_video',
+    'delete_profile', 'transcode_file', 'add_transcode_profile',
+)
+
+def _submitter(method):
+    def submit(self, *args, **kwargs):
+        return self.pool.submit(method, self, *args, **kwargs)
+    submit.__name__ = method.__name__
+    submit.__doc__ = method.__doc__
+    return submit
+
+class AsyncPandaClient(PandaClient):
+    """A :class:`PandaClient` whose API methods return Futures."""
+    def __init__(self, cloud_id, access_key, secret_key, pool, **kwargs):
+        PandaClient.__init__(self, cloud_id, access_key, secret_key, **kwargs)
+        self.pool = pool
+
+    def get_profile_index(self):
+        """Get a Future for the :class:`ProfileIndex` of the profile list."""
+        return self.pool.submit(self._get_profile_index)
+
+    def _get_profile_index(self):
+        # self.get_profiles returns a Future, so the blocking one is used.
+        return self._index_profiles(PandaClient.get_profiles(self))
+
+for name in CLIENT_METHODS:
+    setattr(AsyncPandaClient, name, _submitter(getattr(PandaClient, name).im_func))
+del name
+
+class AsyncPandaHelper(object):
+    """A non-blocking wrapper around a :class:`PandaHelper`.
+
+    Anything that reads MediaFile objects or writes to the database still
+    happens in the calling thread, since SQLAlchemy sessions are
+    thread-local; only the Panda API requests are handed to the pool. The
+    wrapped blocking helper is available as :attr:`helper` for the methods
+    that never talk to Panda, such as :meth:`PandaHelper.associate_video_id`.
+    """
+    def __init__(self, cloud_id, access_key, secret_key, pool, **kwargs):
+        # The helper's own parallel _map is disabled: a pool task that waits
+        # on other tasks in the same pool could deadlock it.
+        kwargs['max_workers'] = 0
+        self.helper = PandaHelper(cloud_id, access_key, secret_key, **kwargs)
+        self.client = self.helper.client
+        self.pool = pool
+
+    def profile_names_to_ids(self, names):
+        return self.pool.submit(self.helper.profile_names_to_ids, names)
+
+    def profile_ids_to_names(self, ids):
+        return self.pool.submit(self.helper.profile_ids_to_names, ids)
+
+    def get_profile_ids_names(self):
+        return self.pool.submit(self.helper.get_profile_ids_names)
+
+    def get_video_state(self, video_id):
+        """Get a Future for a ``(video dict, list of encoding dicts)`` tuple."""
+        return self.pool.submit(self.helper._get_video_state, video_id)
+
+    def get_associated_dicts(self, media_files):
+        """Get a Future for the result of :meth:`PandaHelper.get_associated_dicts`."""
+        file_video_ids = self.helper._list_file_video_ids(media_files)
+        return self.pool.submit(self.helper._get_associated_dicts, file_video_ids)
+
+    def fetch_video_status(self, media_file, video_id=None):
+        """Start fetching the data needed by :meth:`apply_video_status`.
+
+        :returns: One Future per video, in the order they will be applied.
+        :rtype: list of :class:`~mediacore_panda.lib.pool.Future`
+        """
+        if video_id is None:
+            video_ids = self.helper.list_associated_video_ids(media_file)
+        else:
+            video_ids = [video_id]
+        return [self.get_video_state(id) for id in video_ids]
+
+    def apply_video_status(self, media_file, futures):
+        """Wait for the given fetches, then create any completed MediaFiles.
+
+        Together with :meth:`fetch_video_status` this is the non-blocking
+        equivalent of :meth:`PandaHelper.video_status_update`: the mirrored
+        state of each video is updated too. It must be called from the
+        thread that owns the database session.
+
+        :raises PandaUnavailable: If the fetches aren't all done within the
+                                  helper's timeout.
+        """
+        # The timeout is for the whole batch, not for each fetch.
+        timeout = remaining = self.helper.timeout
+        if timeout is not None:
+            deadline = time.time() + timeout
+        states = []
+        for future in futures:
+            if timeout is not None:
+                remaining = max(0, deadline - time.time())
+            try:
+                states.append(future.result(remaining))
+            except DeadlineExceeded, e:
+                raise PandaUnavailable('Timed out waiting for Panda to respond.', self.helper.timeout)
+        self.helper._store_video_states(
+            dict((v['id'], v) for v, encodings in states),
+            dict((v['id'], encodings) for v, encodings in states))
+        for v, encodings in states:
+            self.helper._finalize_video(media_file, v, encodings)
+
+    def video_status_update(self, media_file, video_id=None):
+        """Fetch every video's state concurrently, then apply it.
+
+        Unlike the other methods this blocks until the update is complete.
+        """
+        self.apply_video_status(media_file,
+            self.fetch_video_status(media_file, video_id))
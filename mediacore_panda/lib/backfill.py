@@ -0,0 +1,226 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bulk submission of an existing media library to Panda.
+
+See ``paster panda_backfill --help``.
+"""
+
+import logging
+import os
+import simplejson
+import time
+
+from mediacore.lib.filetypes import VIDEO
+from mediacore.lib.helpers import download_uri, url_for
+from mediacore.lib.storage import LocalFileStorage
+from mediacore.model import MediaFile
+from mediacore.model.meta import DBSession
+
+from mediacore_panda.lib import PandaException
+from mediacore_panda.lib.pool import RateLimiter, WorkerPool
+from mediacore_panda.lib.storage import PANDA_PROFILES, PandaStorage, local_file_path
+from mediacore_panda.model import PandaJob, PandaVideo
+
+log = logging.getLogger(__name__)
+
+class Checkpoint(object):
+    """Progress of a backfill, saved to a file so that it can be resumed.
+
+    ``last_id`` is the highest ID (of a MediaFile, or of a PandaVideo when
+    adding a profile) below which everything has been dealt with.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.last_id = 0
+        self.submitted = 0
+        self.skipped = 0
+        self.failed = 0
+        if path and os.path.exists(path):
+            f = open(path)
+            try:
+                self.__dict__.update(simplejson.load(f))
+            finally:
+                f.close()
+
+    def save(self):
+        if not self.path:
+            return
+        # Write then rename, so a crash never leaves a truncated checkpoint.
+        tmp_path = self.path + '.tmp'
+        f = open(tmp_path, 'w')
+        try:
+            simplejson.dump(dict(last_id=self.last_id, submitted=self.submitted,
+                skipped=self.skipped, failed=self.failed), f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+class Backfill(object):
+    """Submits many MediaFiles (or videos) to Panda, concurrently but politely.
+
+    Work is done in batches of ``concurrency`` items: each batch is sent to
+    Panda in parallel, then each submission is recorded in the database and
+    checkpointed in turn, and the next batch begins.
+
+    :param rate: The most Panda submissions to make per second.
+    :param report: Called with a progress message every ``report_every``
+                   seconds.
+    """
+    def __init__(self, storage, checkpoint, concurrency=4, rate=2.0,
+                 report=None, report_every=30):
+        self.storage = storage
+        self.helper = storage.panda_helper()
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.pool = WorkerPool(concurrency, name='panda-backfill')
+        self.limiter = RateLimiter(rate)
+        self.report = report
+        self.report_every = report_every
+        self._started = None
+        self._last_report = None
+
+    def transcode_library(self, limit=None):
+        """Submit every eligible video file in the library for transcoding.
+
+        Eligible files are videos, not stored by Panda themselves, with a
+        download URL, that are neither associated with a Panda video nor
+        already queued for transcoding. Files stored on this server are
+        uploaded rather than downloaded by Panda, as in
+        :meth:`PandaStorage.transcode`.
+        """
+        profile_ids = self.helper.profile_names_to_ids(self.storage._data[PANDA_PROFILES])
+        if not profile_ids:
+            raise PandaException('No Panda encoding profiles are enabled.')
+
+        def submit(args):
+            file_id, source_url, file_path, state_update_url = args
+            self.limiter.wait()
+            if file_path and os.path.exists(file_path):
+                file = open(file_path, 'rb')
+                try:
+                    return self.helper.client.transcode_file(file, profile_ids,
+                        state_update_url, filename=os.path.basename(file_path))
+                finally:
+                    file.close()
+            return self.helper.client.transcode_file(source_url, profile_ids, state_update_url)
+
+        def record(file_id, video):
+            media_file = MediaFile.query.get(file_id)
+            self.helper.associate_video_id(media_file, video['id'])
+
+        self._run(self._eligible_files, submit, record, limit)
+
+    def add_profile(self, profile_name, limit=None):
+        """Encode every video already sent to Panda with one more profile."""
+        profile_id = self.helper.client.get_profile_index().name_to_id.get(profile_name, None)
+        if profile_id is None:
+            raise PandaException('No such Panda profile.', profile_name)
+        # One listing tells us which videos don't need doing. If it's too
+        # long to page through, the videos it doesn't mention are each
+        # checked before they're submitted.
+        encodings, complete = self.helper._list(self.helper.client.get_encodings,
+                                                profile_id=profile_id, refresh=True)
+        done = set(e['video_id'] for e in encodings)
+
+        def batches(after_id):
+            videos = PandaVideo.query\
+                .filter(PandaVideo.id > after_id)\
+                .order_by(PandaVideo.id)\
+                .limit(self.concurrency).all()
+            return [(v.id, v.video_id in done, v.video_id) for v in videos]
+
+        def submit(video_id):
+            if not complete and self.helper.client.get_encodings(
+                    video_id=video_id, profile_id=profile_id, refresh=True):
+                return None
+            self.limiter.wait()
+            return self.helper.client.add_transcode_profile(video_id, profile_id)
+
+        def record(id, encoding):
+            # The same as PandaHelper.add_transcode_profile, except that the
+            # Panda call is made in a pool thread and the database write here.
+            self.helper.reopen_video(encoding['video_id'])
+
+        self._run(batches, submit, record, limit)
+
+    def _eligible_files(self, after_id):
+        # Returns (ID, skip, submit args) tuples for the next batch of files.
+        queued = DBSession.query(PandaJob.media_file_id)\
+            .filter(PandaJob.media_file_id != None)
+        associated = DBSession.query(PandaVideo.media_file_id)
+        files = MediaFile.query\
+            .filter(MediaFile.id > after_id)\
+            .filter(MediaFile.type == VIDEO)\
+            .filter(~MediaFile.id.in_(associated))\
+            .filter(~MediaFile.id.in_(queued))\
+            .order_by(MediaFile.id)\
+            .limit(self.concurrency).all()
+        batch = []
+        for file in files:
+            uri = download_uri(file)
+            file_path = None
+            if isinstance(file.storage, LocalFileStorage):
+                file_path = local_file_path(file)
+            skip = isinstance(file.storage, PandaStorage) or not (uri or file_path)
+            state_update_url = url_for(controller='/panda/admin/media',
+                action='panda_update', file_id=file.id, qualified=True)
+            batch.append((file.id, skip,
+                          (file.id, uri and str(uri), file_path, state_update_url)))
+        return batch
+
+    def _run(self, next_batch, submit, record, limit):
+        # submit is called in a pool thread, and may return None if it finds
+        # that the item needn't be submitted after all.
+        self._started = self._last_report = time.time()
+        count = 0
+        while limit is None or count < limit:
+            batch = next_batch(self.checkpoint.last_id)
+            if not batch:
+                break
+            todo = [(id, args) for id, skip, args in batch if not skip]
+            self.checkpoint.skipped += len(batch) - len(todo)
+            futures = [(id, self.pool.submit(submit, args)) for id, args in todo]
+            for id, future in futures:
+                try:
+                    result = future.result()
+                    if result is None:
+                        self.checkpoint.skipped += 1
+                    else:
+                        record(id, result)
+                        self.checkpoint.submitted += 1
+                except PandaException, e:
+                    log.error('Could not submit %r to Panda: %s', id, e)
+                    self.checkpoint.failed += 1
+                # Save each submission as soon as it's made, so that a
+                # resumed backfill doesn't make it again.
+                DBSession.commit()
+                self.checkpoint.last_id = id
+                self.checkpoint.save()
+            count += len(todo)
+            self.checkpoint.last_id = batch[-1][0]
+            self.checkpoint.save()
+            self._report()
+        self._report(force=True)
+
+    def _report(self, force=False):
+        now = time.time()
+        if not self.report or (not force and now - self._last_report < self.report_every):
+            return
+        self._last_report = now
+        cp = self.checkpoint
+        elapsed = max(now - self._started, 0.001)
+        self.report('%d submitted, %d failed, %d skipped; up to ID %d; %.2f submissions/sec'
+                    % (cp.submitted, cp.failed, cp.skipped, cp.last_id, cp.submitted / elapsed))
@@ -0,0 +1,306 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures how the plugin's hot paths scale with the size of a media item.
+
+Each scenario is run against a :class:`~mediacore_panda.lib.emulator.PandaEmulator`
+for media with a given number of files, recording wall time, Panda API
+calls, database queries and the growth in live Python objects. Results can
+be saved as a baseline, and later runs compared against it.
+
+Everything is done in one database transaction which is rolled back at
+the end, so nothing is left behind. See ``paster panda_benchmark --help``.
+"""
+
+import gc
+import simplejson
+import time
+
+from mediacore.lib.filetypes import VIDEO
+from mediacore.model import Author, Media, MediaFile, get_available_slug
+from mediacore.model.meta import DBSession
+
+from mediacore_panda import add_panda_vars
+from mediacore_panda.lib import PandaHelper
+from mediacore_panda.lib.emulator import EmulatedConnectionPool, PandaEmulator
+from mediacore_panda.lib.records import encode as encode_record, records
+from mediacore_panda.lib.storage import PandaStorage
+
+# How much slower (as a fraction) a run may be than its baseline before it
+# is flagged. API calls and queries are flagged if they increase at all.
+DEFAULT_TOLERANCE = 0.25
+
+# Growth in live objects smaller than this is never flagged, since it
+# varies a little from run to run.
+OBJECTS_SLACK = 100
+
+class QueryCounter(object):
+    """Counts the SQL statements executed through an engine."""
+    def __init__(self, engine):
+        self.dialect = engine.dialect
+        self.count = 0
+
+    def start(self):
+        # Every version of SQLAlchemy sends statements through these.
+        dialect = self.dialect
+        do_execute = dialect.do_execute
+        do_executemany = dialect.do_executemany
+        def counted(func):
+            def wrapper(*args, **kwargs):
+                self.count += 1
+                return func(*args, **kwargs)
+            return wrapper
+        dialect.do_execute = counted(do_execute)
+        dialect.do_executemany = counted(do_executemany)
+
+    def stop(self):
+        del self.dialect.do_execute
+        del self.dialect.do_executemany
+
+class Result(object):
+    def __init__(self, scenario, size, wall, api_calls, queries, objects):
+        self.scenario = scenario
+        self.size = size
+        self.wall = wall
+        self.api_calls = api_calls
+        self.queries = queries
+        self.objects = objects
+        self.regressions = []
+
+    @property
+    def key(self):
+        return '%s@%d' % (self.scenario, self.size)
+
+    def as_dict(self):
+        return dict(wall=self.wall, api_calls=self.api_calls,
+                    queries=self.queries, objects=self.objects)
+
+    def compare(self, baseline, tolerance=DEFAULT_TOLERANCE):
+        """Note each way in which this result is worse than the baseline dict."""
+        if self.wall > baseline['wall'] * (1 + tolerance):
+            self.regressions.append('wall %.1fms > %.1fms'
+                                    % (self.wall * 1000, baseline['wall'] * 1000))
+        for name in ('api_calls', 'queries'):
+            if getattr(self, name) > baseline[name]:
+                self.regressions.append('%s %d > %d' % (name, getattr(self, name), baseline[name]))
+        if self.objects > max(baseline['objects'] * (1 + tolerance),
+                              baseline['objects'] + OBJECTS_SLACK):
+            self.regressions.append('objects %d > %d' % (self.objects, baseline['objects']))
+
+    def __str__(self):
+        line = '%-28s %5d %10.1fms %6d api %6d sql %8d obj' % (self.scenario,
+            self.size, self.wall * 1000, self.api_calls, self.queries, self.objects)
+        if self.regressions:
+            line += '  REGRESSION: ' + '; '.join(self.regressions)
+        return line
+
+class _FakeFile(object):
+    # Just enough of a MediaFile for PandaStorage.get_uris.
+    def __init__(self, id, unique_id):
+        self.id = id
+        self.unique_id = unique_id
+
+class Benchmark(object):
+    """Builds fixtures for each size and runs every scenario against them.
+
+    :param videos: Panda videos per media file.
+    :param profiles: Encoding profiles, and so encodings per video.
+    :param repeat: Runs of each scenario; the fastest is reported.
+    """
+    def __init__(self, videos=1, profiles=2, repeat=5, max_workers=0):
+        self.videos = videos
+        self.profiles = profiles
+        self.repeat = repeat
+        self.max_workers = max_workers
+        self.queries = QueryCounter(DBSession.bind)
+
+    def run(self, sizes):
+        """Run every scenario for media of each number of files.
+
+        :rtype: list of :class:`Result`
+        """
+        results = []
+        try:
+            self._setup_storage()
+            for size in sizes:
+                self._setup_media(size)
+                for name, setup, func in self.scenarios():
+                    results.append(self._measure(name, size, setup, func))
+        finally:
+            DBSession.rollback()
+        return results
+
+    def scenarios(self):
+        # (name, setup or None, function) tuples. Setup runs before each
+        # repetition, without being measured.
+        return [
+            ('add_panda_vars (cold)', self._forget_mirror, self._edit_page),
+            ('add_panda_vars (warm)', None, self._edit_page),
+            ('panda_status (refresh)', None, self._status_refresh),
+            ('video_status_update', self._clear_cache, self._status_update),
+            ('webhook (progress)', None, self._webhooks),
+            ('PandaStorage.parse', records.clear, self._parse),
+            ('PandaStorage.get_uris', None, self._get_uris),
+            ('PandaStorage.get_uris_for_files', None, self._get_uris_for_files),
+        ]
+
+    def _setup_storage(self):
+        self.clock = [time.time()]
+        self.emulator = PandaEmulator(clock=lambda: self.clock[0],
+                                      queue_time=1, encoding_time=100,
+                                      notify=lambda url, params: None)
+        self.helper = PandaHelper(u'benchmark', u'benchmark', u'benchmark',
+            max_workers=self.max_workers,
+            connection_pool=EmulatedConnectionPool(self.emulator))
+        client = self.helper.client
+        presets = [p['name'] for p in client.get_presets()]
+        while len(client.get_profiles()) < self.profiles:
+            client.add_profile_from_preset(presets[len(client.get_profiles()) % len(presets)])
+        self.profile_ids = [p['id'] for p in client.get_profiles()][:self.profiles]
+
+        self.storage = DBSession.query(PandaStorage).first()
+        if self.storage is None:
+            self.storage = PandaStorage()
+            DBSession.add(self.storage)
+        # Every part of the plugin gets its helper from the storage engine.
+        self.storage.panda_helper = lambda: self.helper
+
+    def _setup_media(self, size):
+        media = Media()
+        media.author = Author(u'Panda Benchmark', u'benchmark@example.com')
+        media.title = u'Panda benchmark (%d files)' % size
+        media.slug = get_available_slug(Media, media.title)
+        media.type = VIDEO
+        DBSession.add(media)
+        for i in range(size):
+            file = MediaFile()
+            file.storage = self.storage
+            file.type = VIDEO
+            file.container = u'mp4'
+            file.display_name = u'video-%d.mp4' % i
+            file.unique_id = u'http://benchmark.example.com/video-%d.mp4' % i
+            media.files.append(file)
+        DBSession.flush()
+
+        # Start every encoding, but finish none, so nothing is finalized.
+        self.video_ids = []
+        for file in media.files:
+            for i in range(self.videos):
+                video = self.helper.client.transcode_file(str(file.unique_id),
+                    self.profile_ids, 'http://benchmark.example.com/update')
+                self.helper.associate_video_id(file, video['id'])
+                self.video_ids.append(video['id'])
+        DBSession.flush()
+        self.clock[0] += 10
+        self.media = media
+        self.progress = 0
+
+        # One progress notification per encoding.
+        encodings = self.helper.client.get_encodings()
+        files = dict((v.video_id, file) for file in media.files for v in file.panda_videos)
+        self.notifications = [(files[e['video_id']], e['video_id'], e['id'])
+                              for e in encodings if e['video_id'] in files]
+
+        # Fixtures for the storage scenarios.
+        self.panda_urls = []
+        for encoding in encodings:
+            encoding = dict(encoding, display_name=u'video.mp4', file_size=1024,
+                            width=640, height=480, duration=60000)
+            self.panda_urls.append(encode_record(encoding))
+            if len(self.panda_urls) == size:
+                break
+        self.fake_files = [_FakeFile(i, u'%032d.mp4' % i) for i in range(size)]
+
+    def _measure(self, name, size, setup, func):
+        best = None
+        for i in range(self.repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            objects = len(gc.get_objects())
+            requests = self.emulator.requests
+            self.queries.count = 0
+            self.queries.start()
+            try:
+                started = time.time()
+                func()
+                wall = time.time() - started
+            finally:
+                self.queries.stop()
+            result = Result(name, size, wall, self.emulator.requests - requests,
+                            self.queries.count, len(gc.get_objects()) - objects)
+            if best is None or result.wall < best.wall:
+                best = result
+        return best
+
+    def _forget_mirror(self):
+        self._clear_cache()
+        self.helper._forget_video_states(self.video_ids)
+
+    def _clear_cache(self):
+        self.helper.client.json_cache.clear()
+
+    def _edit_page(self):
+        add_panda_vars(media=self.media)
+
+    def _status_refresh(self):
+        add_panda_vars(refresh=True, media=self.media)
+
+    def _status_update(self):
+        for file in self.media.files:
+            self.helper.video_status_update(file)
+
+    def _webhooks(self):
+        # Each run reports new progress, or it would be ignored as a duplicate.
+        self.progress = self.progress % 99 + 1
+        for file, video_id, encoding_id in self.notifications:
+            self.helper.handle_notification(file, video_id, encoding_id,
+                                            status=u'processing', progress=self.progress)
+
+    def _parse(self):
+        for url in self.panda_urls:
+            self.storage.parse(url=url)
+
+    def _get_uris(self):
+        for file in self.fake_files:
+            self.storage.get_uris(file)
+
+    def _get_uris_for_files(self):
+        self.storage.get_uris_for_files(self.fake_files)
+
+def load_baseline(path):
+    f = open(path)
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
+
+def save_baseline(path, results):
+    f = open(path, 'w')
+    try:
+        simplejson.dump(dict((r.key, r.as_dict()) for r in results), f,
+                        indent=2, sort_keys=True)
+    finally:
+        f.close()
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Flag regressions against a baseline, returning how many results regressed."""
+    regressed = 0
+    for result in results:
+        if result.key in baseline:
+            result.compare(baseline[result.key], tolerance)
+            if result.regressions:
+                regressed += 1
+    return regressed
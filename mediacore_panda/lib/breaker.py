@@ -0,0 +1,93 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+import time
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker(object):
+    """Stops calls to a service that keeps failing, so they fail fast instead.
+
+    After ``failure_threshold`` consecutive failures the breaker opens, and
+    :meth:`allow` refuses every call for ``reset_timeout`` seconds. Then a
+    single trial call is let through: if it succeeds the breaker closes
+    again, and if it fails the breaker stays open for another period.
+
+    Every allowed call must be followed by :meth:`success` or
+    :meth:`failure`. In case one never is, another trial call is let
+    through if the last one hasn't reported back within ``reset_timeout``.
+    """
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may be made now."""
+        self._lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return True
+            now = self.clock()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout \
+            or self.state == HALF_OPEN and now - self._trial_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._trial_at = now
+                return True
+            # Either open, or half-open with the trial call still underway.
+            return False
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            self.state = CLOSED
+            self.failures = 0
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = self.clock()
+        finally:
+            self._lock.release()
+
+def backoff_delays(retries, base=0.2, cap=2.0):
+    """Yield the delays to sleep before each of ``retries`` retries.
+
+    Delays grow exponentially from ``base`` up to ``cap``, with "full
+    jitter": each is a random fraction of its limit, so that clients that
+    failed together don't all retry together.
+    """
+    for attempt in xrange(retries):
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
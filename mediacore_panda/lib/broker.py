@@ -0,0 +1,118 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Wakes up the requests that are waiting for a media item's Panda state to
+change.
+
+Notifications from Panda, jobs and the reconciler publish the ID of each
+media item whose mirrored state they've committed. Long-polling status
+requests (see ``MediaController.panda_status_json``) wait for those.
+
+This only reaches requests in the same process. Waiting requests also
+re-check the database every so often, so with several processes a change
+is still seen, just not as soon.
+"""
+
+import threading
+import time
+
+# Each waiting request holds one of the web server's worker threads (the
+# threadpool_workers setting of paste's server, 10 by default). Only this
+# fraction of them may wait at once, so that the rest stay free to serve
+# other requests.
+WAITER_FRACTION = 0.25
+DEFAULT_SERVER_THREADS = 10
+
+def default_max_waiters(server_threads=DEFAULT_SERVER_THREADS):
+    """Return how many requests may wait at once, given the server's thread count."""
+    return max(1, int(server_threads * WAITER_FRACTION))
+
+DEFAULT_MAX_WAITERS = default_max_waiters()
+
+class Broker(object):
+    """An in-process publish/subscribe channel, with one topic per media item.
+
+    :param max_waiters: The most requests that may wait at once, since
+                        each one holds a web server thread. Keep it to a
+                        small fraction of the server's threads (see
+                        :func:`default_max_waiters`).
+    """
+    def __init__(self, max_waiters=DEFAULT_MAX_WAITERS, clock=time.time):
+        self.max_waiters = max_waiters
+        self.clock = clock
+        self.waiters = 0
+        self._versions = {}     # topic -> number of publications
+        self._condition = threading.Condition()
+
+    def version(self, topic):
+        """Return a number that changes whenever ``topic`` is published."""
+        self._condition.acquire()
+        try:
+            return self._versions.get(topic, 0)
+        finally:
+            self._condition.release()
+
+    def publish(self, topic):
+        self._condition.acquire()
+        try:
+            self._versions[topic] = self._versions.get(topic, 0) + 1
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def wait(self, topic, version, timeout):
+        """Wait until ``topic`` is published after ``version``, or time runs out.
+
+        :returns: True if it was published, False if not, or None if too
+                  many requests were already waiting.
+        :rtype: bool or None
+        """
+        deadline = self.clock() + timeout
+        self._condition.acquire()
+        try:
+            if self.waiters >= self.max_waiters:
+                return None
+            self.waiters += 1
+            try:
+                while self._versions.get(topic, 0) == version:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self.waiters -= 1
+        finally:
+            self._condition.release()
+
+#: The broker for every request and worker in this process.
+broker = Broker()
+
+def publish_after_commit(topic):
+    """Publish ``topic`` once the current web request's transaction commits.
+
+    Waiting requests would otherwise read the database before the change
+    is visible to them. Outside of a web request, or on versions of
+    MediaCore without commit callbacks, it is published right away.
+    """
+    try:
+        from pylons import request
+        callbacks = getattr(request, 'commit_callbacks', None)
+    except (ImportError, TypeError):
+        callbacks = None
+    if callbacks is None:
+        broker.publish(topic)
+    else:
+        callbacks.append(lambda: broker.publish(topic))
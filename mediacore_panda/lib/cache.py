@@ -0,0 +1,272 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import simplejson
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 1000
+DEFAULT_TTL = 30
+
+# (url pattern, seconds) pairs, checked in order. Account-level documents
+# rarely change, while video and encoding state changes while we watch.
+DEFAULT_TTLS = [
+    (re.compile(r'^/presets\.json$'), 24 * 60 * 60),
+    (re.compile(r'^/clouds/[^/]+\.json$'), 60 * 60),
+    (re.compile(r'^/profiles(/[^/]+)?\.json$'), 60 * 60),
+    (re.compile(r'^/videos(/[^/]+)?\.json$'), 10),
+    (re.compile(r'^/encodings(/[^/]+)?\.json$'), 5),
+]
+
+# The account-level documents that every worker process can share through a
+# SharedCacheBackend, named by the first component of their URLs.
+SHARED_NAMESPACES = ('clouds', 'presets', 'profiles')
+
+# Indexes into the linked list nodes used by ResponseCache.
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+class ResponseCache(object):
+    """A size-bounded LRU cache whose entries expire after a per-URL TTL.
+
+    Keys are ``(url, frozenset(query_string_data.items()))`` tuples, as
+    built by :meth:`mediacore_panda.lib.PandaClient._get_json`.
+
+    Entries are kept in a circular doubly linked list, most recently used
+    first, so that lookups, insertions and evictions are all O(1). All
+    access is serialized by a lock, since the client may be shared by
+    several threads.
+
+    If ``stale_ttl`` is set, expired entries are kept for that many more
+    seconds, during which :meth:`lookup` still returns them (flagged as
+    stale) so that they can be served while a fresh copy is fetched.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttls=DEFAULT_TTLS,
+                 default_ttl=DEFAULT_TTL, clock=time.time, stale_ttl=0):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ttl_for(self, url):
+        """Return the number of seconds a response for this URL is fresh."""
+        for pattern, ttl in self.ttls:
+            if pattern.match(url):
+                return ttl
+        return self.default_ttl
+
+    def get(self, key, default=None):
+        value, fresh = self.lookup(key)
+        if not fresh:
+            return default
+        return value
+
+    def lookup(self, key):
+        """Return a ``(value, fresh)`` tuple for the given key.
+
+        ``value`` is None if there is no entry, and may be a stale value
+        (with ``fresh`` false) if ``stale_ttl`` is set. Stale values count
+        as misses.
+        """
+        self._lock.acquire()
+        try:
+            node = self._entries.get(key, None)
+            if node is None:
+                self.misses += 1
+                return None, False
+            now = self.clock()
+            if node[EXPIRES] <= now:
+                self.misses += 1
+                if node[EXPIRES] + self.stale_ttl <= now:
+                    self._unlink(node)
+                    return None, False
+                return node[VALUE], False
+            self._move_to_front(node)
+            self.hits += 1
+            return node[VALUE], True
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        ttl = self.ttl_for(key[0])
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            node = self._entries.get(key, None)
+            if node is not None:
+                node[VALUE] = value
+                node[EXPIRES] = self.clock() + ttl
+                self._move_to_front(node)
+                return
+
+            root = self._root
+            first = root[NEXT]
+            node = [root, first, key, value, self.clock() + ttl]
+            first[PREV] = root[NEXT] = self._entries[key] = node
+
+            while len(self._entries) > self.max_size:
+                self._unlink(root[PREV])
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, url_prefixes):
+        """Drop every entry whose URL starts with one of the given prefixes.
+
+        :param url_prefixes: URL prefixes such as ``'/videos'``.
+        :type url_prefixes: tuple of str
+        :returns: The number of entries removed.
+        :rtype: int
+        """
+        self._lock.acquire()
+        try:
+            stale = [node for key, node in self._entries.iteritems()
+                     if key[0].startswith(url_prefixes)]
+            for node in stale:
+                self._unlink(node)
+            return len(stale)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            root = self._root
+            root[:] = [root, root, None, None, None]
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def _move_to_front(self, node):
+        prev, next = node[PREV], node[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        root = self._root
+        first = root[NEXT]
+        node[PREV] = root
+        node[NEXT] = first
+        first[PREV] = root[NEXT] = node
+
+    def _unlink(self, node):
+        prev, next = node[PREV], node[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        del self._entries[node[KEY]]
+
+class SharedCacheBackend(object):
+    """A cache shared by every worker process, for slow-changing documents.
+
+    Entries belong to a namespace (e.g. ``'profiles'``) which has a version
+    number. Bumping the version hides every entry stored under an earlier
+    version, so a change made by one process is seen by all of them.
+
+    Implementations must be safe to use from several threads at once.
+    """
+    def get(self, namespace, key):
+        """Return the current, unexpired value for this key, or None."""
+        raise NotImplementedError
+
+    def set(self, namespace, key, value, ttl, version):
+        """Store a value for ``ttl`` seconds under the given version.
+
+        Callers should read the namespace version *before* fetching the
+        value, so that a fetch which raced with an invalidation is stored
+        under the old version and never served.
+        """
+        raise NotImplementedError
+
+    def get_version(self, namespace):
+        raise NotImplementedError
+
+    def bump_version(self, namespace):
+        raise NotImplementedError
+
+class SQLiteCacheBackend(SharedCacheBackend):
+    """A :class:`SharedCacheBackend` stored in a local SQLite database file.
+
+    Every process on the host that points at the same file shares its
+    entries. Decoded values are kept in memory until the row changes, so
+    repeated hits only cost one indexed query.
+    """
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._decoded = {}
+        db = self._db()
+        db.execute('CREATE TABLE IF NOT EXISTS panda_cache ('
+                   'key TEXT PRIMARY KEY, namespace TEXT NOT NULL, '
+                   'version INTEGER NOT NULL, expires REAL NOT NULL, '
+                   'stored REAL NOT NULL, value TEXT NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS panda_cache_versions ('
+                   'namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)')
+
+    def _db(self):
+        # sqlite3 connections may not be shared between threads.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return db
+
+    def get(self, namespace, key):
+        row = self._db().execute(
+            'SELECT c.value, c.stored FROM panda_cache c '
+            'LEFT JOIN panda_cache_versions v ON v.namespace = c.namespace '
+            'WHERE c.key = ? AND c.expires > ? AND c.version = COALESCE(v.version, 0)',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        value, stored = row
+        decoded = self._decoded.get(key, None)
+        if decoded is None or decoded[0] != stored:
+            decoded = self._decoded[key] = (stored, simplejson.loads(value))
+        return decoded[1]
+
+    def set(self, namespace, key, value, ttl, version):
+        now = time.time()
+        self._db().execute(
+            'INSERT OR REPLACE INTO panda_cache '
+            '(key, namespace, version, expires, stored, value) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (key, namespace, version, now + ttl, now, simplejson.dumps(value)))
+
+    def get_version(self, namespace):
+        row = self._db().execute(
+            'SELECT version FROM panda_cache_versions WHERE namespace = ?',
+            (namespace,)).fetchone()
+        return row and row[0] or 0
+
+    def bump_version(self, namespace):
+        db = self._db()
+        db.execute('INSERT OR IGNORE INTO panda_cache_versions '
+                   '(namespace, version) VALUES (?, 0)', (namespace,))
+        db.execute('UPDATE panda_cache_versions SET version = version + 1 '
+                   'WHERE namespace = ?', (namespace,))
+        db.execute('DELETE FROM panda_cache WHERE namespace = ?', (namespace,))
@@ -0,0 +1,572 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+An imitation of the Panda API, for trying out the plugin without Panda.
+
+:class:`PandaEmulator` keeps clouds, presets, profiles, videos and
+encodings in memory and answers the requests that
+:class:`~mediacore_panda.lib.PandaClient` makes. Encodings progress on
+their own over a configurable time, and when they finish the
+``state_update_url`` of their video is notified, as Panda would.
+
+The emulator can be used in-process, by giving a client an
+:class:`EmulatedConnectionPool`, or over HTTP, with :func:`serve` or
+``paster panda_emulator`` and the ``panda.api_host`` and ``panda.api_port``
+settings.
+
+Faults can be injected with :meth:`PandaEmulator.inject`, e.g.::
+
+    emulator.inject(LATENCY, delay=2, path='/videos')
+    emulator.inject(ERROR, probability=0.1)
+    emulator.inject(TIMEOUT, method='POST', times=1)
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import httplib
+import logging
+import random
+import re
+import simplejson
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+from StringIO import StringIO
+
+from mediacore_panda.lib.transport import ConnectionPool
+
+log = logging.getLogger(__name__)
+
+# Fault kinds
+LATENCY = 'latency'         # respond normally, after ``delay`` seconds
+ERROR = 'error'             # respond with a Panda error
+TIMEOUT = 'timeout'         # don't respond for ``delay`` seconds
+MALFORMED = 'malformed'     # respond with invalid JSON
+DISCONNECT = 'disconnect'   # close the connection without responding
+
+# Query parameters added by request signing, which aren't part of the call.
+SIGNING_PARAMS = ('access_key', 'cloud_id', 'signature', 'timestamp')
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+DEFAULT_PRESETS = [
+    dict(name='h264', title='MP4 (H.264)', extname='.mp4', width=480, height=320),
+    dict(name='h264.hi', title='MP4 (H.264) Hi', extname='.mp4', width=1280, height=720),
+    dict(name='ogg', title='OGG (Theora)', extname='.ogg', width=480, height=320),
+    dict(name='webm', title='WebM (VP8)', extname='.webm', width=480, height=320),
+]
+
+def _timestamp(t):
+    return time.strftime('%Y/%m/%d %H:%M:%S +0000', time.gmtime(t))
+
+def _new_id():
+    return uuid.uuid4().hex
+
+class Fault(object):
+    """A failure to inject into matching requests.
+
+    :param kind: One of LATENCY, ERROR, TIMEOUT, MALFORMED or DISCONNECT.
+    :param probability: The chance, between 0 and 1, that a matching
+                        request is affected.
+    :param method: Only affect requests with this HTTP method.
+    :param path: Only affect requests whose path (without the API version
+                 and query string) starts with this, e.g. ``'/videos'``.
+    :param times: Stop after affecting this many requests.
+    :param delay: Seconds of delay, for LATENCY and TIMEOUT faults.
+    """
+    def __init__(self, kind, probability=1.0, method=None, path=None,
+                 times=None, delay=None):
+        if delay is None:
+            delay = kind == TIMEOUT and 60 or 1
+        self.kind = kind
+        self.probability = probability
+        self.method = method
+        self.path = path
+        self.times = times
+        self.delay = delay
+
+    def matches(self, method, path):
+        return (self.method is None or self.method == method) \
+            and (self.path is None or path.startswith(self.path)) \
+            and (self.times is None or self.times > 0) \
+            and random.random() < self.probability
+
+class Response(object):
+    def __init__(self, status, body, fault=None):
+        self.status = status
+        self.body = body
+        self.fault = fault
+
+class PandaEmulator(object):
+    """An in-memory Panda cloud.
+
+    :param queue_time: Seconds before a new encoding starts.
+    :param encoding_time: Seconds an encoding takes once started.
+    :param fail_rate: The fraction of encodings that fail.
+    :param notify: Called with ``(url, params)`` to deliver each
+                   notification. By default they are POSTed from a
+                   background thread.
+    :param clock: Returns the current time, so that the lifecycle can be
+                  driven by a test.
+    """
+    def __init__(self, cloud_id='emulated', queue_time=1, encoding_time=10,
+                 fail_rate=0, notify=None, clock=time.time):
+        self.cloud_id = cloud_id
+        self.queue_time = queue_time
+        self.encoding_time = encoding_time
+        self.fail_rate = fail_rate
+        self.notify = notify or self._post_notification
+        self.clock = clock
+        self.faults = []
+        self.requests = 0
+        self.clouds = {cloud_id: dict(id=cloud_id, name=cloud_id,
+            s3_videos_bucket='emulated', s3_private_access=False,
+            url='http://emulated.s3.amazonaws.com/')}
+        self.presets = list(DEFAULT_PRESETS)
+        self.profiles = {}
+        self.videos = {}
+        self.encodings = {}
+        self._lock = threading.RLock()
+        for preset in self.presets[:2]:
+            self._add_profile(dict(preset_name=preset['name']))
+
+    def inject(self, kind, **kwargs):
+        """Add a :class:`Fault`, and return it. See its parameters."""
+        fault = Fault(kind, **kwargs)
+        self.faults.append(fault)
+        return fault
+
+    def clear_faults(self):
+        self.faults = []
+
+    def handle(self, method, url, body=None, content_type=None, content_length=None):
+        """Answer an API request.
+
+        :param url: The request path, e.g. ``/v2/videos.json?status=fail``
+        :param body: The url-encoded body of a POST or PUT request, or a
+                     multipart/form-data body (as a string or a file-like
+                     object) that uploads a file.
+        :rtype: :class:`Response`
+        """
+        path, _, query = url.partition('?')
+        path = re.sub(r'^/v\d+', '', path)
+        params = dict((k, v[-1]) for k, v in cgi.parse_qs(query).iteritems())
+        if content_type and content_type.startswith('multipart/form-data'):
+            params.update(self._parse_multipart(body, content_type, content_length))
+        elif body:
+            params.update((k, v[-1]) for k, v in cgi.parse_qs(body).iteritems())
+        for key in SIGNING_PARAMS:
+            params.pop(key, None)
+
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            faults = self._faults_for(method, path)
+        finally:
+            self._lock.release()
+        for fault in faults:
+            if fault.kind == LATENCY:
+                time.sleep(fault.delay)
+            elif fault.kind == ERROR:
+                return Response(500, simplejson.dumps(dict(error='InternalError',
+                    message='Injected error from the Panda emulator.')), fault)
+            elif fault.kind == MALFORMED:
+                return Response(200, '{"id": "', fault)
+            else:
+                return Response(None, None, fault)
+
+        self._lock.acquire()
+        try:
+            self._advance()
+            status, obj = self._route(method, path, params)
+        finally:
+            self._lock.release()
+        return Response(status, simplejson.dumps(obj))
+
+    def _parse_multipart(self, body, content_type, content_length):
+        # Uploaded files are read through, a chunk at a time, and only
+        # their names and sizes are kept.
+        if isinstance(body, basestring):
+            content_length = len(body)
+            body = StringIO(body)
+        elif not hasattr(body, 'readline'):
+            body = _LineReader(body)
+        form = cgi.FieldStorage(fp=body, environ=dict(REQUEST_METHOD='POST',
+            CONTENT_TYPE=content_type, CONTENT_LENGTH=str(content_length)))
+        params = {}
+        for field in form.list or []:
+            if field.filename:
+                size = 0
+                chunk = field.file.read(UPLOAD_CHUNK_SIZE)
+                while chunk:
+                    size += len(chunk)
+                    chunk = field.file.read(UPLOAD_CHUNK_SIZE)
+                params['_upload'] = (field.filename, size)
+            else:
+                params[field.name] = field.value
+        return params
+
+    def _faults_for(self, method, path):
+        # Returns the faults that affect this request, latencies first.
+        faults = []
+        for fault in self.faults:
+            if fault.matches(method, path):
+                if fault.times is not None:
+                    fault.times -= 1
+                faults.append(fault)
+        faults.sort(key=lambda f: f.kind != LATENCY)
+        return faults
+
+    def _route(self, method, path, params):
+        match = re.match(r'^/(\w+)(?:/(\w+))?(?:/(\w+))?\.json$', path)
+        if not match:
+            return self._not_found(path)
+        resource, id, child = match.groups()
+        handler = getattr(self, '_%s_%s%s' % (method.lower(), resource,
+                                              id and (child and '_' + child or '_one') or ''), None)
+        if handler is None:
+            return self._not_found(path)
+        if id:
+            return handler(id, params)
+        return handler(params)
+
+    def _not_found(self, what):
+        return 404, dict(error='RecordNotFound', message="Couldn't find %s" % what)
+
+    def _get_clouds_one(self, id, params):
+        # Any cloud ID is accepted, so no configuration is needed.
+        if id not in self.clouds:
+            self.clouds[id] = dict(self.clouds[self.cloud_id], id=id, name=id)
+        return 200, self.clouds[id]
+
+    def _get_presets(self, params):
+        return 200, self.presets
+
+    def _get_profiles(self, params):
+        return 200, [self._public(p) for p in
+                     sorted(self.profiles.values(), key=lambda p: p['_seq'])]
+
+    def _get_profiles_one(self, id, params):
+        if id not in self.profiles:
+            return self._not_found(id)
+        return 200, self._public(self.profiles[id])
+
+    def _post_profiles(self, params):
+        return 201, self._add_profile(params)
+
+    def _add_profile(self, params):
+        preset = {}
+        for p in self.presets:
+            if p['name'] == params.get('preset_name', None):
+                preset = p
+        now = _timestamp(self.clock())
+        profile = dict(preset, id=_new_id(), preset_name=preset.get('name', None),
+                       created_at=now, updated_at=now)
+        for key in ('name', 'title', 'extname', 'command'):
+            if key in params:
+                profile[key] = params[key]
+        for key in ('width', 'height'):
+            if key in params:
+                profile[key] = int(params[key])
+        profile.setdefault('name', profile['id'])
+        profile['_seq'] = len(self.profiles)
+        self.profiles[profile['id']] = profile
+        return self._public(profile)
+
+    def _delete_profiles_one(self, id, params):
+        return 200, dict(deleted=self.profiles.pop(id, None) is not None)
+
+    def _get_videos(self, params):
+        return 200, self._filter(self.videos.values(), params, ('status',))
+
+    def _get_videos_one(self, id, params):
+        if id not in self.videos:
+            return self._not_found(id)
+        return 200, self._public(self.videos[id])
+
+    def _get_videos_encodings(self, id, params):
+        return 200, self._filter(self.encodings.values(), dict(params, video_id=id),
+                                 ('status', 'profile_id', 'profile_name', 'video_id'))
+
+    def _post_videos(self, params):
+        if params.get('_upload', None):
+            name, file_size = params['_upload']
+        elif params.get('source_url', None):
+            name, file_size = params['source_url'].rstrip('/').split('/')[-1], None
+        else:
+            return 422, dict(error='BadRequest', message='source_url or file is required')
+        now = self.clock()
+        video = dict(id=_new_id(), status='processing', source_url=params.get('source_url', None),
+            original_filename=name, extname='.' + name.rpartition('.')[2],
+            file_size=file_size, width=None, height=None, duration=None,
+            error_message=None, created_at=_timestamp(now), updated_at=_timestamp(now))
+        video['_state_update_url'] = params.get('state_update_url', None)
+        video['_created'] = now
+        self.videos[video['id']] = video
+        for profile_id in filter(None, params.get('profiles', '').split(',')):
+            self._add_encoding(video, profile_id)
+        return 201, self._public(video)
+
+    def _delete_videos_one(self, id, params):
+        deleted = self.videos.pop(id, None) is not None
+        for encoding in self.encodings.values():
+            if encoding['video_id'] == id:
+                del self.encodings[encoding['id']]
+        return 200, dict(deleted=deleted)
+
+    def _get_encodings(self, params):
+        return 200, self._filter(self.encodings.values(), params,
+                                 ('status', 'profile_id', 'profile_name', 'video_id'))
+
+    def _get_encodings_one(self, id, params):
+        if id not in self.encodings:
+            return self._not_found(id)
+        return 200, self._public(self.encodings[id])
+
+    def _post_encodings(self, params):
+        video = self.videos.get(params.get('video_id', None), None)
+        if video is None:
+            return self._not_found(params.get('video_id', None))
+        encoding = self._add_encoding(video, params.get('profile_id', None))
+        if encoding is None:
+            return self._not_found(params.get('profile_id', None))
+        return 201, self._public(encoding)
+
+    def _delete_encodings_one(self, id, params):
+        return 200, dict(deleted=self.encodings.pop(id, None) is not None)
+
+    def _add_encoding(self, video, profile_ref):
+        profile = self.profiles.get(profile_ref, None)
+        if profile is None:
+            # Panda accepts profile names as well as IDs.
+            for p in self.profiles.itervalues():
+                if p['name'] == profile_ref:
+                    profile = p
+        if profile is None:
+            return None
+        now = self.clock()
+        encoding = dict(id=_new_id(), video_id=video['id'], profile_id=profile['id'],
+            profile_name=profile['name'], status='processing', encoding_progress=0,
+            started_encoding_at=None, encoding_time=None, extname=profile['extname'],
+            file_size=None, width=profile.get('width', None), height=profile.get('height', None),
+            duration=None, error_message=None, created_at=_timestamp(now),
+            updated_at=_timestamp(now))
+        encoding['_created'] = now
+        encoding['_fails'] = random.random() < self.fail_rate
+        self.encodings[encoding['id']] = encoding
+        return encoding
+
+    def _filter(self, objs, params, fields):
+        wanted = [(f, params[f]) for f in fields if params.get(f, None)]
+        objs = [o for o in objs if all(o.get(f, None) == value for f, value in wanted)]
+        if params.get('page', None) or params.get('per_page', None):
+            objs.sort(key=lambda o: (o['_created'], o['id']))
+            page = int(params.get('page', None) or 1)
+            per_page = int(params.get('per_page', None) or 100)
+            objs = objs[(page - 1) * per_page:page * per_page]
+        return [self._public(o) for o in objs]
+
+    def _public(self, obj):
+        return dict((k, v) for k, v in obj.iteritems() if not k.startswith('_'))
+
+    def advance(self):
+        """Bring every video and encoding up to date with the clock.
+
+        This is done before every request anyway, but a long-running
+        emulator should call it regularly so notifications go out on time.
+        """
+        self._lock.acquire()
+        try:
+            self._advance()
+        finally:
+            self._lock.release()
+
+    def _advance(self):
+        now = self.clock()
+        notifications = []
+        for video in self.videos.itervalues():
+            if video['status'] == 'processing' and now >= video['_created'] + self.queue_time:
+                video.update(status='success', file_size=1024 * 1024, width=640,
+                             height=480, duration=60 * 1000,
+                             updated_at=_timestamp(now))
+                notifications.append((video, None))
+
+        for encoding in self.encodings.itervalues():
+            if encoding['status'] != 'processing':
+                continue
+            start = encoding['_created'] + self.queue_time
+            if now < start:
+                continue
+            encoding['started_encoding_at'] = _timestamp(start)
+            progress = min(100, int(100 * (now - start) / max(self.encoding_time, 0.001)))
+            if encoding['_fails'] and progress >= 50:
+                encoding.update(status='fail', encoding_progress=50,
+                                error_message='Emulated failure.')
+            elif progress >= 100:
+                encoding.update(status='success', encoding_progress=100,
+                                file_size=512 * 1024, duration=60 * 1000,
+                                encoding_time=self.encoding_time)
+            else:
+                encoding['encoding_progress'] = progress
+                continue
+            encoding['updated_at'] = _timestamp(now)
+            video = self.videos.get(encoding['video_id'], None)
+            if video is not None:
+                notifications.append((video, encoding))
+
+        for video, encoding in notifications:
+            url = video['_state_update_url']
+            if not url:
+                continue
+            params = dict(video_id=video['id'], status=video['status'])
+            if encoding is not None:
+                params.update(encoding_id=encoding['id'], status=encoding['status'],
+                              encoding_progress=encoding['encoding_progress'])
+            self.notify(url, params)
+
+    def _post_notification(self, url, params):
+        def post():
+            try:
+                urllib2.urlopen(url, urllib.urlencode(params), 10).read()
+            except Exception, e:
+                log.warning('Could not deliver emulated notification to %s: %s', url, e)
+        thread = threading.Thread(target=post, name='panda-emulator-notify')
+        thread.setDaemon(True)
+        thread.start()
+
+class _LineReader(object):
+    # Adds the readline() that cgi.FieldStorage needs to a stream that only
+    # has read(), such as a MultipartStream.
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ''
+
+    def _fill(self):
+        chunk = self.stream.read(UPLOAD_CHUNK_SIZE)
+        self.buffer += chunk
+        return bool(chunk)
+
+    def _take(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while '\n' not in self.buffer \
+        and (size < 0 or len(self.buffer) < size) and self._fill():
+            pass
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+class EmulatedConnectionPool(ConnectionPool):
+    """A connection pool that sends every request to a :class:`PandaEmulator`.
+
+    Pass one to a PandaClient or PandaHelper to use the emulator with no
+    network at all. TIMEOUT and DISCONNECT faults raise the same errors
+    a real connection would.
+    """
+    def __init__(self, emulator, **kwargs):
+        ConnectionPool.__init__(self, **kwargs)
+        self.emulator = emulator
+
+    def request(self, host, port, method, url, body=None, headers={}):
+        self.stats['requests'] += 1
+        response = self.emulator.handle(method, url, body,
+            content_type=headers.get('Content-Type', None),
+            content_length=headers.get('Content-Length', None))
+        if response.fault is not None and response.fault.kind == TIMEOUT:
+            time.sleep(min(response.fault.delay, self.read_timeout or response.fault.delay))
+            raise socket.timeout('timed out')
+        if response.fault is not None and response.fault.kind == DISCONNECT:
+            raise httplib.BadStatusLine('')
+        return response.status, response.body
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        content_type = self.headers.get('Content-Type', None)
+        if content_type and content_type.startswith('multipart/form-data'):
+            # Uploads are parsed as they are read, however big they are.
+            body = self.rfile
+        else:
+            body = length and self.rfile.read(length) or None
+        response = self.server.emulator.handle(self.command, self.path, body,
+                                               content_type, length)
+        if response.fault is not None and response.fault.kind == TIMEOUT:
+            time.sleep(response.fault.delay)
+            self.close_connection = 1
+            return
+        if response.fault is not None and response.fault.kind == DISCONNECT:
+            self.close_connection = 1
+            return
+        self.send_response(response.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+class EmulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, emulator, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RequestHandler)
+        self.emulator = emulator
+
+def serve(emulator, host='127.0.0.1', port=0, background=True, tick=1):
+    """Serve the emulator's API over HTTP.
+
+    :param port: The port to listen on, or 0 to pick a free one (see
+                 ``server.server_address``).
+    :param background: Serve from daemon threads and return right away,
+                       instead of serving until interrupted.
+    :param tick: Seconds between calls to :meth:`PandaEmulator.advance`,
+                 so notifications are sent without waiting for a request.
+    :returns: The server, which can be stopped with ``server.shutdown()``.
+    :rtype: :class:`EmulatorServer`
+    """
+    server = EmulatorServer(emulator, (host, port))
+    def advance():
+        while True:
+            time.sleep(tick)
+            emulator.advance()
+    threads = [threading.Thread(target=advance, name='panda-emulator-tick')]
+    if background:
+        threads.append(threading.Thread(target=server.serve_forever, name='panda-emulator'))
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    if not background:
+        server.serve_forever()
+    return server
@@ -0,0 +1,267 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Workers for the durable queue of :class:`~mediacore_panda.model.PandaJob`.
+
+Jobs can be run by daemon threads inside the web process (see
+:func:`start_workers`, configured with ``panda.job_workers``), by
+``paster panda_worker``, or both; a job is only ever claimed by one worker.
+The workers also refresh the mirrored state of the videos that Panda is
+encoding, between its notifications.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda.lib import PandaException
+from mediacore_panda.lib.broker import broker
+from mediacore_panda.lib.tracing import tracer
+from mediacore_panda.model import DONE, FAILED, PENDING, RUNNING, PandaJob, PandaVideo
+
+log = logging.getLogger(__name__)
+
+TRANSCODE = u'transcode'
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60
+MAX_RETRY_DELAY = 60 * 60
+# Running jobs that haven't finished after this long are assumed to have
+# been abandoned by a worker that died, and are queued again.
+STALE_AFTER = timedelta(minutes=30)
+# How often, in seconds, a job that takes a while (e.g. uploading a large
+# file) shows the other workers that it hasn't been abandoned.
+HEARTBEAT_INTERVAL = 60
+# Seconds between refreshes of the mirrored state of videos being encoded.
+DEFAULT_REFRESH_INTERVAL = 60
+# The most videos to refresh at a time.
+REFRESH_LIMIT = 50
+
+class Heartbeat(object):
+    """A progress callback that keeps a running job from being requeued.
+
+    It can be called as often as you like, but only touches the job every
+    ``interval`` seconds.
+    """
+    def __init__(self, job_id, interval=HEARTBEAT_INTERVAL, clock=time.time):
+        self.job_id = job_id
+        self.interval = interval
+        self.clock = clock
+        self._last = clock()
+
+    def __call__(self, *args):
+        now = self.clock()
+        if now - self._last >= self.interval:
+            self._last = now
+            PandaJob.touch(self.job_id)
+
+def run_transcode(panda_helper, job):
+    data = job.data
+    # Profiles are queued by name, and resolved when the job runs, so that
+    # a profile that is recreated meanwhile is still used.
+    profile_ids = panda_helper.profile_names_to_ids(data['profile_names'])
+    if not profile_ids:
+        raise PandaException('None of the enabled Panda profiles exist.', data['profile_names'])
+    panda_helper.transcode_media_file(job.media_file, profile_ids,
+        state_update_url=data.get('state_update_url', None),
+        source_url=data.get('source_url', None),
+        file_path=data.get('file_path', None),
+        progress=Heartbeat(job.id))
+
+# Maps a PandaJob.kind to a function taking a PandaHelper and the job.
+job_handlers = {
+    TRANSCODE: run_transcode,
+}
+
+class JobRunner(object):
+    """Runs queued jobs, and keeps the mirror of videos being encoded fresh.
+
+    :param refresh_interval: Seconds between refreshes of the mirrored
+                             state of videos that are being encoded (see
+                             :meth:`PandaHelper.refresh_processing_videos`),
+                             or 0 not to refresh them.
+    """
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.refresh_interval = refresh_interval
+        self._next_refresh = 0
+        self._refresh_lock = threading.Lock()
+
+    def run_pending(self, limit=None):
+        """Run jobs that are due until there are none left, or ``limit`` are run.
+
+        Each job is committed separately, so this must not be called in the
+        middle of some other unit of work.
+
+        :returns: The number of jobs run.
+        :rtype: int
+        """
+        self.requeue_stale()
+        self.refresh_processing()
+        count = 0
+        while limit is None or count < limit:
+            job_ids = [id for id, in DBSession.query(PandaJob.id)\
+                .filter(PandaJob.state == PENDING)\
+                .filter(PandaJob.run_after <= datetime.now())\
+                .order_by(PandaJob.run_after)\
+                .limit(10)]
+            if not job_ids:
+                break
+            for job_id in job_ids:
+                if limit is not None and count >= limit:
+                    break
+                if self.run_job(job_id):
+                    count += 1
+        return count
+
+    def run_job(self, job_id):
+        """Claim and run a single job, recording its outcome.
+
+        :returns: False if another worker claimed the job first.
+        :rtype: bool
+        """
+        claimed = PandaJob.claim(job_id)
+        DBSession.commit()
+        if not claimed:
+            return False
+
+        job = PandaJob.query.get(job_id)
+        tracer.begin('job-%d' % job_id)
+        try:
+            try:
+                handler = job_handlers[job.kind]
+                handler(self._panda_helper(), job)
+            except Exception, e:
+                log.exception(e)
+                DBSession.rollback()
+                job = PandaJob.query.get(job_id)
+                self._failed(job, e)
+            else:
+                job.state = DONE
+                job.last_error = None
+        finally:
+            tracer.end()
+        media_id = job.media_file and job.media_file.media_id
+        DBSession.commit()
+        if media_id:
+            # The status box shows queued jobs; let it know.
+            broker.publish(media_id)
+        return True
+
+    def requeue_stale(self):
+        cutoff = datetime.now() - STALE_AFTER
+        stale = PandaJob.query\
+            .filter(PandaJob.state == RUNNING)\
+            .filter(PandaJob.modified_on < cutoff)\
+            .all()
+        for job in stale:
+            log.warning('Requeueing abandoned Panda job %d', job.id)
+            job.state = PENDING
+        DBSession.commit()
+
+    def refresh_processing(self):
+        """Refresh the mirrored state of videos being encoded, if it's time.
+
+        :returns: The number of videos refreshed.
+        :rtype: int
+        """
+        if not self.refresh_interval:
+            return 0
+        # Only one of the threads sharing this runner needs to do it.
+        self._refresh_lock.acquire()
+        try:
+            now = time.time()
+            if now < self._next_refresh:
+                return 0
+            self._next_refresh = now + self.refresh_interval
+        finally:
+            self._refresh_lock.release()
+
+        try:
+            panda_helper = self._panda_helper()
+            if panda_helper is None:
+                return 0
+            video_ids = panda_helper.refresh_processing_videos(
+                self.refresh_interval, limit=REFRESH_LIMIT)
+            media_ids = set()
+            if video_ids:
+                media_ids = set(v.media_file.media_id for v in PandaVideo.query\
+                    .filter(PandaVideo.video_id.in_(video_ids)))
+            DBSession.commit()
+        except Exception, e:
+            log.exception(e)
+            DBSession.rollback()
+            return 0
+        for media_id in media_ids:
+            broker.publish(media_id)
+        return len(video_ids)
+
+    def _failed(self, job, e):
+        job.attempts += 1
+        job.last_error = unicode(repr(e))
+        if job.attempts >= self.max_attempts:
+            job.state = FAILED
+        else:
+            job.state = PENDING
+            delay = min(self.retry_delay * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+            job.run_after = datetime.now() + timedelta(seconds=delay)
+
+    def _panda_helper(self):
+        from mediacore_panda.lib.storage import PandaStorage
+        storage = DBSession.query(PandaStorage).first()
+        return storage is not None and storage.panda_helper() or None
+
+_workers = []
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+
+def start_workers(count, poll_interval=10, runner=None):
+    """Start ``count`` daemon threads that run jobs, if not already started.
+
+    :param poll_interval: Seconds between checks for jobs that are due,
+                          when the workers aren't woken up sooner by
+                          :func:`wake_workers`.
+    """
+    _workers_lock.acquire()
+    try:
+        if runner is None:
+            runner = JobRunner()
+        while len(_workers) < count:
+            thread = threading.Thread(target=_work, args=(runner, poll_interval),
+                                      name='panda-jobs-%d' % len(_workers))
+            thread.setDaemon(True)
+            thread.start()
+            _workers.append(thread)
+    finally:
+        _workers_lock.release()
+
+def wake_workers():
+    """Have the worker threads check for jobs right away."""
+    _wakeup.set()
+
+def _work(runner, poll_interval):
+    while True:
+        try:
+            runner.run_pending()
+        except Exception, e:
+            log.exception(e)
+        DBSession.remove()
+        _wakeup.wait(poll_interval)
+        _wakeup.clear()
@@ -0,0 +1,255 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Counters and timings for the Panda API calls made by this process.
+
+Every :class:`~mediacore_panda.lib.PandaClient` records its requests in
+the process-wide :data:`metrics`, which can be read as JSON from
+``/admin/plugins/panda/metrics`` or forwarded elsewhere by adding a
+:class:`MetricsSink`.
+
+To find out how many Panda calls a page makes, run it inside a page scope
+(see :func:`measure_page`).
+"""
+
+import logging
+import re
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Upper bounds of the buckets for the number of Panda calls made per page.
+CALLS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+def endpoint(url):
+    """Return the URL with any resource ID replaced, for grouping requests.
+
+    e.g. ``/videos/abc123/encodings.json`` becomes
+    ``/videos/:id/encodings.json``.
+    """
+    return re.sub(r'^(/[^/]+)/[^/.]+', r'\1/:id', url)
+
+class Histogram(object):
+    """Counts observations in buckets of a fixed set of upper bounds."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        labels = ['<=%s' % b for b in self.buckets] + ['>%s' % self.buckets[-1]]
+        return dict(
+            buckets = dict(zip(labels, self.counts)),
+            count = self.count,
+            sum = self.sum,
+            max = self.max,
+            mean = self.count and float(self.sum) / self.count or 0,
+        )
+
+class MetricsSink(object):
+    """Receives each Panda request as it is recorded.
+
+    Subclass this to forward metrics to another monitoring system. Sinks
+    are called on the thread that made the request, so they must be quick
+    and must not raise.
+    """
+    def request(self, method, endpoint, seconds, bytes_sent, bytes_received, error):
+        pass
+
+    def page(self, name, calls):
+        pass
+
+class LogSink(MetricsSink):
+    """Logs every request at debug level."""
+    def request(self, method, endpoint, seconds, bytes_sent, bytes_received, error):
+        log.debug('Panda %s %s took %.3fs (%d bytes out, %d in)%s', method,
+            endpoint, seconds, bytes_sent, bytes_received,
+            error and ', error: %s' % error or '')
+
+    def page(self, name, calls):
+        log.debug('%s made %d Panda calls', name, calls)
+
+class Metrics(object):
+    def __init__(self):
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.started = time.time()
+            self.requests = {}      # (method, endpoint) -> count
+            self.latency = {}       # (method, endpoint) -> Histogram
+            self.errors = {}        # error type -> count
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.pages = {}         # page name -> Histogram of calls
+        finally:
+            self._lock.release()
+
+    def record_request(self, method, url, seconds, bytes_sent=0, bytes_received=0, error=None):
+        key = method, endpoint(url)
+        self._lock.acquire()
+        try:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.latency[key].observe(seconds)
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+            # The scope may be shared with other threads; see bind().
+            scope = getattr(self._local, 'scope', None)
+            if scope is not None:
+                scope[1] += 1
+        finally:
+            self._lock.release()
+        for sink in self.sinks:
+            sink.request(key[0], key[1], seconds, bytes_sent, bytes_received, error)
+
+    def record_error(self, error):
+        """Count an error that wasn't recorded along with a request."""
+        self._lock.acquire()
+        try:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        finally:
+            self._lock.release()
+
+    def begin_page(self, name):
+        """Start counting the Panda calls made by this thread for a page."""
+        self._local.scope = [name, 0]
+
+    def end_page(self):
+        """Stop counting, and record the number of calls the page made.
+
+        :returns: The number of calls made.
+        :rtype: int
+        """
+        scope = getattr(self._local, 'scope', None)
+        if scope is None:
+            return 0
+        self._local.scope = None
+        name, calls = scope
+        self._lock.acquire()
+        try:
+            if name not in self.pages:
+                self.pages[name] = Histogram(CALLS_BUCKETS)
+            self.pages[name].observe(calls)
+        finally:
+            self._lock.release()
+        for sink in self.sinks:
+            sink.page(name, calls)
+        return calls
+
+    def bind(self, func):
+        """Wrap ``func`` so that its calls count towards this thread's page.
+
+        Use this for work that is handed to another thread.
+        """
+        scope = getattr(self._local, 'scope', None)
+        if scope is None:
+            return func
+        def bound(*args, **kwargs):
+            self._local.scope = scope
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.scope = None
+        return bound
+
+    def snapshot(self):
+        """Return everything recorded so far as a JSON-serializable dict."""
+        self._lock.acquire()
+        try:
+            endpoints = {}
+            for (method, path), count in self.requests.iteritems():
+                endpoints['%s %s' % (method, path)] = dict(
+                    count = count,
+                    latency = self.latency[method, path].as_dict(),
+                )
+            return dict(
+                since = self.started,
+                endpoints = endpoints,
+                errors = dict(self.errors),
+                bytes_sent = self.bytes_sent,
+                bytes_received = self.bytes_received,
+                pages = dict((name, h.as_dict()) for name, h in self.pages.iteritems()),
+            )
+        finally:
+            self._lock.release()
+
+#: The metrics for every Panda client in this process.
+metrics = Metrics()
+
+_configured_sinks = None
+
+def configure_sinks(spec):
+    """Set the sinks of :data:`metrics` from a ``panda.metrics.sinks`` setting.
+
+    :param spec: Whitespace separated ``module:ClassName`` names of
+                 :class:`MetricsSink` classes, e.g.
+                 ``mediacore_panda.lib.metrics:LogSink``.
+    :type spec: str
+    """
+    global _configured_sinks
+    if spec == _configured_sinks:
+        return
+    sinks = []
+    for name in spec.split():
+        module_name, class_name = name.split(':')
+        __import__(module_name)
+        sinks.append(getattr(sys.modules[module_name], class_name)())
+    metrics.sinks = sinks
+    _configured_sinks = spec
+
+def measure_page(name):
+    """Decorate a function to count the Panda calls made each time it runs.
+
+    Calls are counted for the outermost measured function only, so e.g. a
+    controller action that calls a measured helper counts as one page.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if getattr(metrics._local, 'scope', None) is not None:
+                return func(*args, **kwargs)
+            metrics.begin_page(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.end_page()
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
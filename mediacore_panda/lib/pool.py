@@ -0,0 +1,159 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import time
+from Queue import Queue
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Future(object):
+    """The pending result of a call submitted to a :class:`WorkerPool`."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result.
+
+        If the call raised an exception, it is re-raised here with its
+        original traceback.
+
+        :param timeout: Seconds to wait, or None to wait forever.
+        :type timeout: float or None
+        :raises DeadlineExceeded: If the call has not finished in time.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise DeadlineExceeded(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+class WorkerPool(object):
+    """A fixed-size pool of daemon threads for running blocking calls.
+
+    Threads are started as work is submitted, up to ``max_workers``, and
+    then live for the life of the process.
+    """
+    def __init__(self, max_workers, name='panda-worker'):
+        self.max_workers = max_workers
+        self.name = name
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule ``func(*args, **kwargs)`` and return its :class:`Future`."""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        self._lock.acquire()
+        try:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work,
+                    name='%s-%d' % (self.name, len(self._threads)))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+        return future
+
+    def map(self, func, items, timeout=None):
+        """Call ``func`` on each item in parallel, returning results in order.
+
+        If any call raises, the exception of the earliest such item is
+        re-raised once the calls before it have completed, just as when
+        calling ``map(func, items)`` serially.
+
+        :param timeout: Seconds to wait for all the calls to complete, or
+                        None to wait as long as it takes.
+        :type timeout: float or None
+        :raises DeadlineExceeded: If the calls did not finish in time. Any
+                                  calls still running are left to finish in
+                                  the background and their results discarded.
+        """
+        futures = [self.submit(func, item) for item in items]
+        if timeout is None:
+            return [f.result() for f in futures]
+        deadline = time.time() + timeout
+        return [f.result(max(0, deadline - time.time())) for f in futures]
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._queue.get()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except:
+                future.set_exception(sys.exc_info())
+
+_shared_pools = {}
+_shared_pools_lock = threading.Lock()
+
+def shared_pool(max_workers):
+    """Return the process-wide :class:`WorkerPool` of the given size.
+
+    Sharing pools means that rebuilding a PandaHelper (e.g. after the
+    storage settings are saved) does not strand a set of idle threads.
+    """
+    _shared_pools_lock.acquire()
+    try:
+        if max_workers not in _shared_pools:
+            _shared_pools[max_workers] = WorkerPool(max_workers)
+        return _shared_pools[max_workers]
+    finally:
+        _shared_pools_lock.release()
+
+class RateLimiter(object):
+    """Spaces out calls so that no more than ``rate`` happen per second.
+
+    Call :meth:`wait` before each call; it sleeps for as long as needed.
+    Short bursts of up to ``burst`` calls are allowed after a quiet spell.
+    """
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(burst)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        self._lock.acquire()
+        try:
+            now = self.clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            delay = self._tokens < 0 and -self._tokens / self.rate or 0
+        finally:
+            self._lock.release()
+        if delay:
+            self.sleep(delay)
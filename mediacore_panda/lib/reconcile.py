@@ -0,0 +1,135 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Periodic reconciliation with Panda, for sites that its notifications
+can't reach (e.g. behind a firewall, or on a development machine).
+
+Each run lists the cloud's videos and encodings, a page at a time, and
+finalizes the videos that are done. Videos are only included in a run
+when they're due to be checked: how often that is depends on how quickly
+their encodings have been progressing, so a long encoding isn't polled
+every minute. Videos that Panda no longer has are marked as gone, and
+aren't checked again.
+
+Run it with ``paster panda_reconcile``, in one process only. It isn't run
+by the web server, since each of its processes would repeat the work.
+"""
+
+import logging
+import time
+
+from sqlalchemy import or_
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda.lib.broker import broker
+from mediacore_panda.model import FINALIZED, GONE, PandaVideo
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 60 * 60
+
+class _Schedule(object):
+    __slots__ = ('interval', 'next_check', 'progress', 'checked_at')
+
+    def __init__(self, interval, next_check, progress, checked_at):
+        self.interval = interval
+        self.next_check = next_check
+        self.progress = progress
+        self.checked_at = checked_at
+
+def video_progress(video, encodings):
+    """Return how far along a video is overall, from 0 to 100."""
+    if video['status'] != 'success':
+        return 0
+    if not encodings:
+        return 0
+    total = 0
+    for e in encodings:
+        if e['status'] == 'success':
+            total += 100
+        else:
+            total += e.get('encoding_progress') or 0
+    return float(total) / len(encodings)
+
+class Reconciler(object):
+    """Finalizes associated videos that Panda has finished with.
+
+    The schedule is kept in memory, so a new process checks every
+    unfinished video on its first run.
+
+    :param min_interval: The fewest seconds between checks of one video.
+    :param max_interval: The most seconds between checks of one video.
+    """
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self._schedule = {}     # video_id -> _Schedule
+
+    def run(self, panda_helper):
+        """Check every video that is due, committing what was found.
+
+        :returns: The number of videos checked, and the number finalized.
+        :rtype: tuple
+        """
+        now = self.clock()
+        unfinished = DBSession.query(PandaVideo)\
+            .filter(or_(PandaVideo.state == None,
+                        ~PandaVideo.state.in_([FINALIZED, GONE])))\
+            .all()
+
+        # Forget videos that have been finalized or dissociated elsewhere.
+        video_ids = set(v.video_id for v in unfinished)
+        for video_id in self._schedule.keys():
+            if video_id not in video_ids:
+                del self._schedule[video_id]
+
+        due = [v for v in unfinished
+               if v.video_id not in self._schedule
+               or self._schedule[v.video_id].next_check <= now]
+        if not due:
+            return 0, 0
+
+        videos, video_encodings, finalized, gone = panda_helper.reconcile_videos(due)
+        media_ids = set(v.media_file.media_id for v in due if v.video_id in videos)
+        DBSession.commit()
+        for media_id in media_ids:
+            broker.publish(media_id)
+
+        now = self.clock()
+        for video_id in (v.video_id for v in due):
+            if video_id in finalized or video_id in gone:
+                self._schedule.pop(video_id, None)
+            else:
+                progress = video_progress(videos[video_id], video_encodings[video_id])
+                self._reschedule(video_id, progress, now)
+        return len(due), len(finalized)
+
+    def _reschedule(self, video_id, progress, now):
+        previous = self._schedule.get(video_id, None)
+        if previous is None:
+            interval = self.min_interval
+        elif progress > previous.progress:
+            # Check again about halfway through the expected time remaining.
+            rate = float(progress - previous.progress) / max(now - previous.checked_at, 1)
+            interval = (100 - progress) / rate / 2
+        else:
+            # No progress: queued, stalled or failed. Back off.
+            interval = previous.interval * 2
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self._schedule[video_id] = _Schedule(interval, now + interval, progress, now)
@@ -0,0 +1,212 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+The ``panda:`` URLs that describe a finished Panda file to
+:meth:`PandaStorage.parse <mediacore_panda.lib.storage.PandaStorage.parse>`.
+
+A record holds only the fields that are needed to create the MediaFile,
+in a fixed order, e.g.::
+
+    panda:2:abc123:.mp4:640:480:1048576:60000:0:%28original%29%20Intro.mp4
+
+Version 1 records, which were the whole Panda dict as JSON, can still be
+decoded.
+"""
+
+import logging
+import simplejson
+import threading
+import urllib
+
+from mediacore_panda.lib.cache import KEY, NEXT, PREV, VALUE
+
+log = logging.getLogger(__name__)
+
+PANDA_URL_PREFIX = 'panda:'
+RECORD_VERSION = '2'
+
+# The fields of a version 2 record, in order.
+FIELDS = ('id', 'extname', 'width', 'height', 'file_size', 'duration',
+          'bitrate', 'display_name')
+INT_FIELDS = ('width', 'height', 'file_size', 'duration', 'bitrate')
+
+# The most decoded records to keep.
+CACHE_SIZE = 1000
+
+def encode(d):
+    """Return the record for a Panda video or encoding dict.
+
+    The dict must have an extra ``display_name`` key.
+
+    :rtype: str
+    """
+    d = dict(d, bitrate=(d.get('audio_bitrate') or 0) + (d.get('video_bitrate') or 0))
+    values = []
+    for field in FIELDS:
+        value = d.get(field, None)
+        if value is None:
+            value = ''
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        values.append(urllib.quote(str(value), safe=''))
+    return '%s%s:%s' % (PANDA_URL_PREFIX, RECORD_VERSION, ':'.join(values))
+
+class RecordCache(object):
+    """Remembers decoded records, keyed by the unique ID of their file.
+
+    The least recently used record is evicted when the cache is full, as
+    in :class:`~mediacore_panda.lib.cache.ResponseCache`. Records of the
+    same file may differ (e.g. in display name), so each entry is only
+    used for the record it was decoded from.
+    """
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._lock = threading.Lock()
+
+    def decode(self, url):
+        """Return the dict for a record.
+
+        :raises ValueError: If the record can't be decoded.
+        :rtype: dict
+        """
+        key = _unique_id(url)
+        if key is None:
+            return _decode(url)
+        self._lock.acquire()
+        try:
+            node = self._entries.get(key, None)
+            if node is not None and node[VALUE][0] == url:
+                self._move_to_front(node)
+                return node[VALUE][1]
+        finally:
+            self._lock.release()
+
+        d = _decode(url)
+        self._lock.acquire()
+        try:
+            node = self._entries.get(key, None)
+            if node is not None:
+                self._unlink(node)
+            root = self._root
+            first = root[NEXT]
+            node = [root, first, key, (url, d)]
+            first[PREV] = root[NEXT] = self._entries[key] = node
+            while len(self._entries) > self.size:
+                self._unlink(root[PREV])
+        finally:
+            self._lock.release()
+        return d
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            root = self._root
+            root[:] = [root, root, None, None]
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+    def _move_to_front(self, node):
+        prev, next = node[PREV], node[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        root = self._root
+        first = root[NEXT]
+        node[PREV] = root
+        node[NEXT] = first
+        first[PREV] = root[NEXT] = node
+
+    def _unlink(self, node):
+        prev, next = node[PREV], node[NEXT]
+        prev[NEXT] = next
+        next[PREV] = prev
+        del self._entries[node[KEY]]
+
+def _unique_id(url):
+    # Returns the unique ID of the file that a version 2 record describes,
+    # without decoding the rest of it, or None for any other record.
+    values = url[len(PANDA_URL_PREFIX):].split(':', 3)
+    if len(values) < 4 or values[0] != RECORD_VERSION:
+        return None
+    return urllib.unquote(values[1]) + urllib.unquote(values[2])
+
+def _decode(url):
+    body = url[len(PANDA_URL_PREFIX):]
+    if body.startswith('{'):
+        # Version 1
+        d = simplejson.loads(body)
+        d['bitrate'] = (d.get('audio_bitrate') or 0) + (d.get('video_bitrate') or 0)
+        return d
+    version, _, body = body.partition(':')
+    if version != RECORD_VERSION:
+        raise ValueError('Unknown Panda record version: %r' % version)
+    values = body.split(':')
+    if len(values) != len(FIELDS):
+        raise ValueError('Malformed Panda record: %r' % url)
+    d = {}
+    for field, value in zip(FIELDS, values):
+        value = urllib.unquote(str(value)).decode('utf-8')
+        if field in INT_FIELDS:
+            if value:
+                value = int(value)
+            else:
+                value = None
+        d[field] = value
+    return d
+
+#: The cache used to decode every record in this process.
+records = RecordCache()
+
+def decode(url):
+    """Return the dict for a record of any version.
+
+    :raises ValueError: If the record can't be decoded.
+    :rtype: dict
+    """
+    return records.decode(url)
+
+def migrate_media_files():
+    """Reduce any MediaFile unique IDs that hold a whole record to the file's ID.
+
+    MediaFiles should only ever store the Panda file name (ID and
+    extension), but make sure that no record was stored in full, e.g. by
+    a storage engine that keeps the URL it was given.
+
+    :returns: The number of MediaFiles changed.
+    :rtype: int
+    """
+    from mediacore.model import MediaFile
+    from mediacore.model.meta import DBSession
+
+    files = DBSession.query(MediaFile)\
+        .filter(MediaFile.unique_id.startswith(PANDA_URL_PREFIX))
+    migrated = 0
+    for file in files:
+        try:
+            d = _decode(file.unique_id)
+        except (ValueError, KeyError), e:
+            log.warn('Could not decode the Panda record of media file %d: %s', file.id, e)
+            continue
+        file.unique_id = d['id'] + d['extname']
+        migrated += 1
+    DBSession.flush()
+    log.info('Reduced %d Panda records in media_files to file IDs.', migrated)
+    return migrated
@@ -14,11 +14,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import simplejson
 
-from pylons import request
+from pylons import config, request
 
-from mediacore.lib.decorators import autocommit, memoize
+from mediacore.lib.decorators import memoize
 from mediacore.lib.helpers import download_uri, url_for
 from mediacore.lib.storage import FileStorageEngine, LocalFileStorage, StorageURI, UnsuitableEngineError, CannotTranscode
 from mediacore.lib.filetypes import guess_container_format, guess_media_type, VIDEO
@@ -36,9 +35,53 @@ CLOUDFRONT_STREAMING_URI = u'cloudfront_streaming_uri'
 
 from mediacore_panda.forms.admin.storage import PandaForm
 from mediacore_panda.lib import PandaHelper
+from mediacore_panda.lib.breaker import CircuitBreaker
+from mediacore_panda.lib.broker import DEFAULT_SERVER_THREADS, broker, default_max_waiters
+from mediacore_panda.lib.cache import ResponseCache, SQLiteCacheBackend
+from mediacore_panda.lib.jobs import TRANSCODE, JobRunner, start_workers, wake_workers
+from mediacore_panda.lib.metrics import configure_sinks
+from mediacore_panda.lib.records import decode as decode_record
+from mediacore_panda.lib.tracing import tracer
+from mediacore_panda.lib.transport import ConnectionPool
+from mediacore_panda.model import PandaJob
 
 log = logging.getLogger(__name__)
 
+def configure_panda():
+    """Apply the settings that are shared by everything in this process.
+
+    These are the metrics sinks, the tracer and the status broker. It is
+    called once, when the app is loaded (see :func:`mediacore_panda.init_panda`).
+    """
+    configure_sinks(config.get('panda.metrics.sinks', ''))
+    tracer.sample_rate = float(config.get('panda.trace.sample_rate', 1))
+    tracer.max_payload = int(config.get('panda.trace.max_payload', 2000))
+    # The server's thread count is only known if it's also set for the app,
+    # e.g. in the [DEFAULT] section.
+    broker.max_waiters = int(config.get('panda.status.max_waiters', 0)) \
+        or default_max_waiters(int(config.get('threadpool_workers', DEFAULT_SERVER_THREADS)))
+
+def start_job_workers():
+    """Make sure this process is working through the queue of Panda jobs.
+
+    The number of worker threads is set by ``panda.job_workers``. Set it to
+    0 to leave the jobs to ``paster panda_worker`` instead. The workers
+    also refresh the mirrored state of videos being encoded every
+    ``panda.refresh_interval`` seconds (0 to not).
+
+    This is called once, when the web app is loaded, and never by the
+    paster commands (see :func:`mediacore_panda.init_panda`).
+    """
+    runner = JobRunner(refresh_interval=float(config.get('panda.refresh_interval', 60)))
+    start_workers(int(config.get('panda.job_workers', 1)), runner=runner)
+
+def local_file_path(media_file):
+    """Return the path of a file stored by :class:`LocalFileStorage`, or None."""
+    for uri in media_file.storage.get_uris(media_file):
+        if uri.scheme == 'file':
+            return uri.file_uri
+    return None
+
 class PandaStorage(FileStorageEngine):
 
     engine_type = u'PandaStorage'
@@ -67,13 +110,32 @@ class PandaStorage(FileStorageEngine):
         CLOUDFRONT_STREAMING_URI: u'',
     }
 
+    # URI templates for each combination of S3 and CloudFront settings,
+    # shared by every instance of the engine.
+    _uri_templates = {}
+
     @property
-    @memoize
     def base_urls(self):
-        s3_bucket = self._data[S3_BUCKET_NAME]
-        cloudfront_http = self._data[CLOUDFRONT_DOWNLOAD_URI]
-        cloudfront_rtmp = self._data[CLOUDFRONT_STREAMING_URI]
-        # TODO: Return a dict or something easier to parse elsewhere
+        return self._templates()[0]
+
+    def _templates(self):
+        """Return the base URLs and the URI templates for the current settings.
+
+        The base URLs are ``(scheme, url)`` pairs for S3 http, CloudFront
+        http and CloudFront rtmp, with ``(None, None)`` for those that
+        aren't set up. The templates are the pairs that :meth:`get_uris`
+        actually uses. Both are tuples, rebuilt only when the settings
+        change (see :meth:`clear_uri_templates`).
+        """
+        key = (self._data[S3_BUCKET_NAME],
+               self._data[CLOUDFRONT_DOWNLOAD_URI],
+               self._data[CLOUDFRONT_STREAMING_URI])
+        templates = self._uri_templates.get(key, None)
+        if templates is None:
+            templates = self._uri_templates[key] = self._build_templates(*key)
+        return templates
+
+    def _build_templates(self, s3_bucket, cloudfront_http, cloudfront_rtmp):
         urls = [('http', 'http://%s.s3.amazonaws.com/' % s3_bucket)]
         if cloudfront_http:
             urls.append(('http', 'http://%s/' % cloudfront_http.strip(' /')))
@@ -83,14 +145,49 @@ class PandaStorage(FileStorageEngine):
             urls.append(('rtmp', 'rtmp://%s/cfx/st/' % cloudfront_rtmp.strip(' /')))
         else:
             urls.append((None, None))
-        return urls
+
+        # Skip s3 http url if cloudfront http url is available
+        if urls[1][0]:
+            templates = urls[1:]
+        else:
+            templates = urls
+        templates = tuple((scheme, base_url) for scheme, base_url in templates if scheme)
+        return tuple(urls), templates
+
+    @classmethod
+    def clear_uri_templates(cls):
+        """Forget the URI templates, e.g. after the S3 or CloudFront settings are saved."""
+        cls._uri_templates.clear()
 
     @memoize
     def panda_helper(self):
+        shared_cache = None
+        if config.get('panda.shared_cache', None):
+            shared_cache = SQLiteCacheBackend(config['panda.shared_cache'])
         return PandaHelper(
             cloud_id = self._data[PANDA_CLOUD_ID],
             access_key = self._data[PANDA_ACCESS_KEY],
             secret_key = self._data[PANDA_SECRET_KEY],
+            max_workers = int(config.get('panda.max_workers', 0)),
+            timeout = float(config.get('panda.timeout', 0)) or None,
+            connection_pool = ConnectionPool(
+                max_per_host = int(config.get('panda.pool.max_per_host', 4)),
+                idle_timeout = float(config.get('panda.pool.idle_timeout', 30)),
+                max_requests = int(config.get('panda.pool.max_requests', 100)),
+                connect_timeout = float(config.get('panda.connect_timeout', 5)),
+                read_timeout = float(config.get('panda.read_timeout', 15)),
+            ),
+            shared_cache = shared_cache,
+            breaker = CircuitBreaker(
+                failure_threshold = int(config.get('panda.breaker.threshold', 5)),
+                reset_timeout = float(config.get('panda.breaker.reset_timeout', 30)),
+            ),
+            retries = int(config.get('panda.retries', 2)),
+            json_cache = ResponseCache(
+                stale_ttl = float(config.get('panda.cache.stale_ttl', 0)),
+            ),
+            api_host = config.get('panda.api_host', None),
+            api_port = int(config.get('panda.api_port', 0)) or None,
         )
 
     def parse(self, file=None, url=None):
@@ -108,19 +205,17 @@ class PandaStorage(FileStorageEngine):
         if not url or not url.startswith(PANDA_URL_PREFIX):
             raise UnsuitableEngineError()
 
-        offset = len(PANDA_URL_PREFIX)
-        # 'd' is the dict representing a Panda encoding or video
-        # with an extra key: 'display_name'
-        d = simplejson.loads(url[offset:])
+        # 'd' holds the fields of a Panda encoding or video that we need,
+        # plus 'display_name'. See mediacore_panda.lib.records.
+        try:
+            d = decode_record(url)
+        except (ValueError, KeyError), e:
+            log.warn('Could not decode Panda record %r: %s', url, e)
+            raise UnsuitableEngineError()
 
         # MediaCore uses extensions without prepended .
         ext = d['extname'].lstrip('.').lower()
 
-        # XXX: Panda doesn't actually populate these fields yet.
-        ba = d.get('audio_bitrate', None) or 0
-        bv = d.get('video_bitrate', None) or 0
-        bitrate = (ba + bv) or None
-
         return {
             'unique_id': d['id'] + d['extname'],
             'container': guess_container_format(ext),
@@ -129,8 +224,9 @@ class PandaStorage(FileStorageEngine):
             'height': d['height'],
             'width': d['width'],
             'size': d['file_size'],
-            'bitrate': bitrate,
-            'duration': d['duration'] / 1000.0,
+            # XXX: Panda doesn't actually populate the bitrates yet.
+            'bitrate': d['bitrate'] or None,
+            'duration': d['duration'] and d['duration'] / 1000.0,
             'thumbnail_url': "%s%s_1.jpg" % (self.base_urls[0][1], d['id']),
         }
 
@@ -152,12 +248,18 @@ class PandaStorage(FileStorageEngine):
 
         profile_names = self._data[PANDA_PROFILES]
 
+        # Files stored on this server are uploaded to Panda, which works even
+        # if Panda can't download them from us.
+        file_path = None
+        if isinstance(media_file.storage, LocalFileStorage):
+            file_path = local_file_path(media_file)
+        source_url = download_uri(media_file)
+
         if not profile_names \
         or media_file.type != VIDEO \
-        or not download_uri(media_file):
+        or not (file_path or source_url):
             raise CannotTranscode
 
-        panda_helper = self.panda_helper()
         state_update_url = url_for(
             controller='/panda/admin/media',
             action='panda_update',
@@ -165,27 +267,24 @@ class PandaStorage(FileStorageEngine):
             qualified=True
         )
 
-        # We can only tell panda to encode this video once the transaction has
-        # been committed, otherwise panda get's a 404 when they try to download
-        # the file from us.
-        def transcode():
-            try:
-                panda_helper.transcode_media_file(media_file, profile_names,
-                                                  state_update_url=state_update_url)
-            except PandaException, e:
-                log.exception(e)
-
-        # Ideally we have the @autocommit decorator call the transcode function
-        # after the transaction has been committed normally. This functionality
-        # wasn't added until after the release of v0.9.0 final, so we have an
-        # ugly hack to support that version.
+        # The submission to Panda is made by a background worker, so that the
+        # upload request needn't wait on it, and failures can be retried.
+        # The job is part of this transaction, so it can't be run before the
+        # file is committed (otherwise Panda would get a 404 when it tries
+        # to download the file from us).
+        PandaJob.enqueue(TRANSCODE, media_file,
+            source_url = source_url and str(source_url) or None,
+            file_path = file_path,
+            profile_names = profile_names,
+            state_update_url = state_update_url,
+        )
+
+        # Ideally we have the @autocommit decorator wake the workers after
+        # the transaction has been committed. This functionality wasn't
+        # added until after the release of v0.9.0 final, so on that version
+        # the job waits for the workers' next poll.
         if hasattr(request, 'commit_callbacks'):
-            # Use the autocommit decorator to save the changes to the db.
-            autocommitted_transcode = autocommit(transcode)
-            request.commit_callbacks.append(autocommitted_transcode)
-        else:
-            DBSession.commit()
-            transcode()
+            request.commit_callbacks.append(wake_workers)
 
     def get_uris(self, media_file):
         """Return a list of URIs from which the stored file can be accessed.
@@ -196,19 +295,24 @@ class PandaStorage(FileStorageEngine):
         :returns: All :class:`StorageURI` tuples for this file.
 
         """
-        base_urls = list(self.base_urls)
+        templates = self._templates()[1]
+        file_uri = media_file.unique_id
+        return [StorageURI(media_file, scheme, file_uri, base_url)
+                for scheme, base_url in templates]
 
-        # Skip s3 http url if cloudfront http url is available
-        if base_urls[1][0]:
-            base_urls = base_urls[1:]
+    def get_uris_for_files(self, media_files):
+        """Return the URIs for many files at once, e.g. for a listing or feed.
 
-        uris = []
-        file_uri = media_file.unique_id
-        for scheme, base_url in base_urls:
-            if not scheme:
-                continue
-            uri = StorageURI(media_file, scheme, file_uri, base_url)
-            uris.append(uri)
-        return uris
+        :type media_files: list of :class:`~mediacore.model.media.MediaFile`
+        :param media_files: Files stored by this engine.
+        :rtype: dict
+        :returns: A list of :class:`StorageURI` tuples for each file, keyed
+                  by the file's ID.
+
+        """
+        templates = self._templates()[1]
+        return dict((file.id, [StorageURI(file, scheme, file.unique_id, base_url)
+                               for scheme, base_url in templates])
+                    for file in media_files)
 
 FileStorageEngine.register(PandaStorage)
@@ -0,0 +1,180 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Debug logging of Panda requests and responses.
+
+Each line is tagged with a correlation ID, so that every Panda call made
+while handling one web request or background job can be picked out of the
+log. Payloads are only formatted if the line is actually logged, and are
+truncated to a configurable size.
+"""
+
+import logging
+import random
+import threading
+import uuid
+from pprint import pformat
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_MAX_PAYLOAD = 2000
+
+class Payload(object):
+    """Formats a request or response payload when it is logged, not before.
+
+    Only about ``max_length`` characters' worth of the data is formatted,
+    so logging a listing of thousands of videos costs no more than logging
+    one video.
+    """
+    def __init__(self, data, max_length):
+        self.data = data
+        self.max_length = max_length
+
+    def __str__(self):
+        if not self.max_length:
+            return pformat(self.data)
+        data, left = _shrink(self.data, self.max_length)
+        text = pformat(data)
+        if len(text) > self.max_length:
+            return '%s...' % text[:self.max_length]
+        return text
+
+class _Omitted(object):
+    # Stands in for the items left out of a shrunk list or dict.
+    def __init__(self, count):
+        self.count = count
+
+    def __repr__(self):
+        return '<%d more>' % self.count
+
+def _shrink(obj, budget):
+    # Returns a copy of obj with about as much in it as will fit in budget
+    # characters once formatted, and how much of the budget is left.
+    if isinstance(obj, dict):
+        shrunk = {}
+        for key, value in obj.iteritems():
+            if budget <= 0:
+                shrunk['...'] = _Omitted(len(obj) - len(shrunk))
+                break
+            shrunk[key], budget = _shrink(value, budget - len(repr(key)) - 4)
+        return shrunk, budget
+    if isinstance(obj, (list, tuple)):
+        shrunk = []
+        for value in obj:
+            if budget <= 0:
+                shrunk.append(_Omitted(len(obj) - len(shrunk)))
+                break
+            value, budget = _shrink(value, budget - 2)
+            shrunk.append(value)
+        return shrunk, budget
+    if isinstance(obj, basestring) and len(obj) > budget:
+        return obj[:max(budget, 0)] + '...', 0
+    return obj, budget - len(repr(obj))
+
+def _web_request():
+    # Returns the current pylons request, or None outside of a web request
+    # (e.g. in a paster command or a background thread).
+    try:
+        from pylons import request
+        request.environ
+        return request
+    except (ImportError, TypeError, AttributeError):
+        return None
+
+class Tracer(object):
+    """Logs Panda calls at debug level, for a sampled fraction of requests.
+
+    Sampling is decided once per correlation ID, so a sampled web request
+    or job has all of its Panda calls logged.
+
+    :param sample_rate: The fraction of requests, between 0 and 1, to log.
+    :param max_payload: The most characters of each payload to log, or 0
+                        for no limit.
+    """
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, max_payload=DEFAULT_MAX_PAYLOAD):
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        self._local = threading.local()
+
+    def begin(self, correlation_id=None):
+        """Start a new trace for the work this thread is about to do.
+
+        :returns: The correlation ID, which is generated if not given.
+        :rtype: str
+        """
+        if correlation_id is None:
+            correlation_id = uuid.uuid4().hex[:12]
+        self._local.trace = correlation_id, random.random() < self.sample_rate
+        return correlation_id
+
+    def end(self):
+        self._local.trace = None
+
+    def current(self):
+        """Return the ``(correlation_id, sampled)`` of this thread's trace.
+
+        Within a web request, the trace is kept in the WSGI environ, so it
+        lasts exactly as long as the request. Elsewhere, unless
+        :meth:`begin` was called, each call gets a trace of its own.
+        """
+        trace = getattr(self._local, 'trace', None)
+        if trace is not None:
+            return trace
+        request = _web_request()
+        if request is not None:
+            trace = request.environ.get('panda.trace', None)
+            if trace is None:
+                trace = request.environ['panda.trace'] = \
+                    (uuid.uuid4().hex[:12], random.random() < self.sample_rate)
+            return trace
+        return uuid.uuid4().hex[:12], random.random() < self.sample_rate
+
+    def bind(self, func):
+        """Wrap ``func`` so that it continues this thread's trace elsewhere."""
+        trace = self.current()
+        def bound(*args, **kwargs):
+            self._local.trace = trace
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.trace = None
+        return bound
+
+    def enabled(self):
+        return log.isEnabledFor(logging.DEBUG)
+
+    def trace(self, method, url, query_string_data, body_data, response_data):
+        """Log one Panda request and its response, if this trace is sampled."""
+        if not self.enabled():
+            return
+        correlation_id, sampled = self.current()
+        if not sampled:
+            return
+        request = _web_request()
+        source = request is not None and request.path_info or 'background'
+        log.debug('[%s] Sent Panda a %s request: %s from %s', correlation_id,
+                  method, url, source)
+        if query_string_data:
+            log.debug('[%s] Query String Data: %s', correlation_id,
+                      Payload(query_string_data, self.max_payload))
+        if body_data:
+            log.debug('[%s] Request Body Data: %s', correlation_id,
+                      Payload(body_data, self.max_payload))
+        log.debug('[%s] Received response: %s', correlation_id,
+                  Payload(response_data, self.max_payload))
+
+#: The tracer used by every Panda client in this process.
+tracer = Tracer()
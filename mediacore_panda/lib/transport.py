@@ -0,0 +1,176 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import httplib
+import socket
+import threading
+import time
+
+DEFAULT_MAX_PER_HOST = 4
+DEFAULT_IDLE_TIMEOUT = 30
+DEFAULT_MAX_REQUESTS = 100
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 15
+
+class PooledConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.requests = 0
+        self.last_used = time.time()
+
+class ConnectionPool(object):
+    """Reuses keep-alive HTTP connections across requests to the same host.
+
+    Connections are checked out for the duration of a single request, so
+    any number of threads may make requests at once. When a request is
+    complete its connection is kept for reuse, unless the server asked to
+    close it, it has served ``max_requests`` requests, or there are already
+    ``max_per_host`` idle connections to that host.
+
+    :attr:`stats` counts connections ``created``, ``reused`` and
+    ``discarded``, as well as the total number of ``requests``.
+
+    ``connect_timeout`` limits how long to wait for a connection to open,
+    and ``read_timeout`` how long to wait for each read from it, after
+    which :exc:`socket.timeout` is raised. None means wait forever.
+    """
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_requests=DEFAULT_MAX_REQUESTS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.stats = dict(created=0, reused=0, discarded=0, requests=0)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @property
+    def reuse_rate(self):
+        """The fraction of requests that were sent over a reused connection."""
+        if not self.stats['requests']:
+            return 0.0
+        return float(self.stats['reused']) / self.stats['requests']
+
+    def _acquire(self, host, port, retry=False):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((host, port), [])
+            if not retry:
+                self.stats['requests'] += 1
+            else:
+                idle = []
+            while idle:
+                pooled = idle.pop()
+                if now - pooled.last_used < self.idle_timeout:
+                    self.stats['reused'] += 1
+                    return pooled
+                self.stats['discarded'] += 1
+                pooled.conn.close()
+            self.stats['created'] += 1
+        finally:
+            self._lock.release()
+
+        if port == 443:
+            conn = httplib.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.connect_timeout)
+        return PooledConnection(conn)
+
+    def _release(self, host, port, pooled, reusable):
+        pooled.requests += 1
+        pooled.last_used = time.time()
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((host, port), [])
+            if reusable and pooled.requests < self.max_requests \
+            and len(idle) < self.max_per_host:
+                idle.append(pooled)
+                return
+            self.stats['discarded'] += 1
+        finally:
+            self._lock.release()
+        pooled.conn.close()
+
+    def request(self, host, port, method, url, body=None, headers={}):
+        """Send an HTTP request and return the response status and body.
+
+        If a reused connection turns out to have been closed by the server
+        while it sat idle, the request is retried once on a new connection.
+        Timeouts are not retried.
+
+        The body may be a file-like object, which is sent one :meth:`read`
+        at a time; give its Content-Length in ``headers``. It is only
+        retried if it can be rewound with ``seek(0)``.
+
+        :rtype: tuple of int and str
+        """
+        pooled = self._acquire(host, port)
+        try:
+            status, data, reusable = self._send(pooled, method, url, body, headers)
+        except socket.timeout:
+            pooled.conn.close()
+            raise
+        except (httplib.BadStatusLine, socket.error), e:
+            pooled.conn.close()
+            if not pooled.requests or not _rewind(body):
+                raise
+            pooled = self._acquire(host, port, retry=True)
+            try:
+                status, data, reusable = self._send(pooled, method, url, body, headers)
+            except:
+                pooled.conn.close()
+                raise
+        except:
+            pooled.conn.close()
+            raise
+
+        self._release(host, port, pooled, reusable)
+        return status, data
+
+    def _send(self, pooled, method, url, body, headers):
+        # Returns the response status and body, and whether the connection
+        # may be reused.
+        if pooled.conn.sock is None:
+            pooled.conn.connect()
+            pooled.conn.sock.settimeout(self.read_timeout)
+        pooled.conn.request(method, url, body, headers)
+        response = pooled.conn.getresponse()
+        return response.status, response.read(), not response.will_close
+
+    def close(self):
+        """Close every idle connection."""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.itervalues():
+            for pooled in connections:
+                pooled.conn.close()
+
+def _rewind(body):
+    # Returns True if the body can be sent again.
+    if not hasattr(body, 'read'):
+        return True
+    try:
+        body.seek(0)
+        return True
+    except (AttributeError, IOError):
+        return False
@@ -0,0 +1,159 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Streams a file to Panda as a multipart/form-data request body.
+
+The file is read one chunk at a time as the request is sent, so files of
+any size can be uploaded with a fixed amount of memory.
+"""
+
+import logging
+import os
+import time
+import uuid
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+def file_size(file):
+    """Return the number of bytes left to read in a file-like object, or None."""
+    try:
+        return os.fstat(file.fileno()).st_size - file.tell()
+    except (AttributeError, IOError, OSError):
+        pass
+    try:
+        start = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell() - start
+        file.seek(start)
+        return size
+    except (AttributeError, IOError, OSError):
+        return None
+
+class MultipartStream(object):
+    """A multipart/form-data body that reads its file as it is sent.
+
+    It is a file-like object, which :mod:`httplib` sends one :meth:`read`
+    at a time. Pass :attr:`content_type` and :attr:`length` as the
+    Content-Type and Content-Length headers.
+
+    :param fields: ``(name, value)`` pairs of the form fields to send
+                   before the file.
+    :param file_field: The name of the file's form field.
+    :param filename: The name to give the file.
+    :param file: The file-like object to read the file from. Reading
+                 starts at its current position.
+    :param size: The number of bytes to send from ``file``. Required if it
+                 can't be worked out from the file.
+    :param progress: Called with the bytes of the file sent so far and
+                     the total, after each chunk.
+    """
+    def __init__(self, fields, file_field, filename, file, size=None,
+                 file_content_type='application/octet-stream',
+                 chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+        if size is None:
+            size = file_size(file)
+        if size is None:
+            raise ValueError('The size of the file to upload must be given.')
+        self.file = file
+        self.size = size
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+
+        head = []
+        for name, value in fields:
+            head.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                        % (self.boundary, name, _encode(value)))
+        head.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                    'Content-Type: %s\r\n\r\n'
+                    % (self.boundary, file_field, _encode(filename).replace('"', ''),
+                       file_content_type))
+        self.head = ''.join(head)
+        self.tail = '\r\n--%s--\r\n' % self.boundary
+        self.length = len(self.head) + size + len(self.tail)
+
+        try:
+            self._start = file.tell()
+        except (AttributeError, IOError):
+            self._start = None
+        self._reset()
+
+    def _reset(self):
+        self.sent = 0           # bytes of the file sent so far
+        self.started = time.time()
+        self._parts = [self.head, None, self.tail]
+
+    def seek(self, offset, whence=0):
+        """Go back to the start, so the request can be sent again.
+
+        Only ``seek(0)`` is supported, and only if the file is seekable.
+        """
+        if offset != 0 or whence != 0 or self._start is None:
+            raise IOError('Can only rewind an upload to the start.')
+        self.file.seek(self._start)
+        self._reset()
+
+    def read(self, size=-1):
+        # Returns at most one chunk of the file at a time, whatever the size
+        # asked for, so that memory use doesn't depend on the caller.
+        while self._parts:
+            part = self._parts[0]
+            if part is not None:
+                del self._parts[0]
+                if part:
+                    return part
+                continue
+            remaining = self.size - self.sent
+            if remaining <= 0:
+                del self._parts[0]
+                continue
+            chunk = self.file.read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise IOError('The file ended after %d of %d bytes.' % (self.sent, self.size))
+            self.sent += len(chunk)
+            if self.progress is not None:
+                self.progress(self.sent, self.size)
+            return chunk
+        return ''
+
+    @property
+    def throughput(self):
+        """Bytes of the file sent per second, so far."""
+        return self.sent / max(time.time() - self.started, 0.001)
+
+class LogProgress(object):
+    """Logs an upload's progress and throughput every ``step`` percent."""
+    def __init__(self, name, step=10):
+        self.name = name
+        self.step = step
+        self.started = time.time()
+        self._next = step
+
+    def __call__(self, sent, total):
+        percent = sent * 100 / total if total else 100
+        if percent < self._next:
+            return
+        self._next = (percent / self.step + 1) * self.step
+        elapsed = max(time.time() - self.started, 0.001)
+        log.info('Uploading %s to Panda: %d%% of %d bytes, %.0f KB/s',
+                 self.name, percent, total, sent / 1024.0 / elapsed)
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
@@ -0,0 +1,362 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import simplejson
+from datetime import datetime
+
+from sqlalchemy import Column, ForeignKey, Index, Table, UniqueConstraint, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import backref, mapper, relation
+from sqlalchemy.types import DateTime, Integer, Unicode, UnicodeText
+
+from mediacore.model.meta import DBSession, metadata
+from mediacore.model.media import MediaFile, MediaFilesMeta
+
+log = logging.getLogger(__name__)
+
+# The prefix of the MediaFilesMeta keys that used to record associations.
+META_VIDEO_PREFIX = u'panda_video_'
+
+# The PandaVideo.state of a video whose encodings have all been turned into
+# MediaFiles. Such videos are no longer listed as associated.
+FINALIZED = u'finalized'
+
+# The PandaVideo.state of a video that Panda no longer has, e.g. because it
+# was deleted from the cloud. The reconciler stops checking such videos.
+GONE = u'gone'
+
+# PandaJob states
+PENDING = u'pending'
+RUNNING = u'running'
+FAILED = u'failed'
+DONE = u'done'
+
+panda_videos = Table('panda_videos', metadata,
+    Column('id', Integer, autoincrement=True, primary_key=True),
+    Column('media_file_id', Integer, ForeignKey('media_files.id',
+        onupdate='CASCADE', ondelete='CASCADE'), nullable=False, index=True),
+    Column('video_id', Unicode(32), nullable=False, unique=True),
+    Column('state', Unicode(32)),
+    Column('created_on', DateTime, default=datetime.now, nullable=False),
+    Column('modified_on', DateTime, default=datetime.now, onupdate=datetime.now, nullable=False),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+class PandaVideo(object):
+    """The association of a MediaCore MediaFile with a Panda video.
+
+    A row is created when a MediaFile is submitted to Panda for
+    transcoding, and is indexed by both the MediaFile ID and the Panda
+    video ID, so that webhooks can find their MediaFile directly.
+    """
+    query = DBSession.query_property()
+
+    def __repr__(self):
+        return '<PandaVideo: %r %r>' % (self.media_file_id, self.video_id)
+
+    @classmethod
+    def claim(cls, video_id):
+        """Mark the given video as finalized, unless that's already been done.
+
+        This is a single conditional UPDATE, so if several requests try to
+        finalize the same video at once, exactly one of them succeeds; the
+        others wait on the row lock and then see that it has been claimed.
+
+        :returns: True if this call claimed the video.
+        :rtype: bool
+        """
+        DBSession.flush()
+        result = DBSession.execute(panda_videos.update()\
+            .where(and_(panda_videos.c.video_id == video_id,
+                        or_(panda_videos.c.state == None,
+                            panda_videos.c.state != FINALIZED)))\
+            .values(state=FINALIZED, modified_on=datetime.now()))
+        return result.rowcount == 1
+
+mapper(PandaVideo, panda_videos, properties={
+    'media_file': relation(MediaFile,
+        backref=backref('panda_videos', cascade='all, delete-orphan', passive_deletes=True)),
+})
+
+panda_video_states = Table('panda_video_states', metadata,
+    Column('video_id', Unicode(32), primary_key=True),
+    Column('status', Unicode(16)),
+    Column('extname', Unicode(16)),
+    Column('file_size', Integer),
+    Column('width', Integer),
+    Column('height', Integer),
+    Column('duration', Integer),
+    Column('updated_at', Unicode(32)),
+    Column('refreshed_on', DateTime, default=datetime.now, onupdate=datetime.now, nullable=False),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+panda_encoding_states = Table('panda_encoding_states', metadata,
+    Column('encoding_id', Unicode(32), primary_key=True),
+    Column('video_id', Unicode(32), nullable=False, index=True),
+    Column('profile_id', Unicode(32)),
+    Column('status', Unicode(16)),
+    Column('encoding_progress', Integer),
+    Column('started_encoding_at', Unicode(32)),
+    Column('extname', Unicode(16)),
+    Column('file_size', Integer),
+    Column('width', Integer),
+    Column('height', Integer),
+    Column('duration', Integer),
+    Column('updated_at', Unicode(32)),
+    Column('refreshed_on', DateTime, default=datetime.now, onupdate=datetime.now, nullable=False),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+class _PandaState(object):
+    # The Panda dict keys that are mirrored locally, besides the ID.
+    fields = ()
+    id_attr = None
+
+    def update_from(self, d):
+        """Copy the mirrored fields from a Panda API dict."""
+        setattr(self, self.id_attr, d['id'])
+        for field in self.fields:
+            setattr(self, field, d.get(field, None))
+
+    def as_dict(self):
+        """Return the mirrored fields in the same shape as the Panda API."""
+        d = dict((field, getattr(self, field)) for field in self.fields)
+        d['id'] = getattr(self, self.id_attr)
+        return d
+
+class PandaVideoState(_PandaState):
+    """The last known state of a Panda video, mirrored locally."""
+    query = DBSession.query_property()
+    id_attr = 'video_id'
+    fields = ('status', 'extname', 'file_size', 'width', 'height',
+              'duration', 'updated_at')
+
+    def __repr__(self):
+        return '<PandaVideoState: %r %r>' % (self.video_id, self.status)
+
+class PandaEncodingState(_PandaState):
+    """The last known state of a Panda encoding, mirrored locally."""
+    query = DBSession.query_property()
+    id_attr = 'encoding_id'
+    fields = ('video_id', 'profile_id', 'status', 'encoding_progress',
+              'started_encoding_at', 'extname', 'file_size', 'width',
+              'height', 'duration', 'updated_at')
+
+    def __repr__(self):
+        return '<PandaEncodingState: %r %r>' % (self.encoding_id, self.status)
+
+panda_events = Table('panda_events', metadata,
+    Column('id', Integer, autoincrement=True, primary_key=True),
+    Column('video_id', Unicode(32), nullable=False),
+    Column('encoding_id', Unicode(32), nullable=False),
+    Column('status', Unicode(16), nullable=False),
+    Column('received_on', DateTime, default=datetime.now, nullable=False),
+    UniqueConstraint('video_id', 'encoding_id', 'status'),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+# Dialects that can skip a duplicate insert without raising an error,
+# which would otherwise need a savepoint to recover from.
+_INSERT_IGNORE = {
+    'mysql': 'IGNORE',
+    'sqlite': 'OR IGNORE',
+}
+
+class PandaEvent(object):
+    """A Panda notification that has been processed.
+
+    Every notification with a status is recorded. The status of a progress
+    notification includes its progress, e.g. ``processing:40``, so that
+    only repeats of the same progress are duplicates.
+    """
+    query = DBSession.query_property()
+
+    def __repr__(self):
+        return '<PandaEvent: %r %r %r>' % (self.video_id, self.encoding_id, self.status)
+
+    @classmethod
+    def record(cls, video_id, encoding_id, status):
+        """Record a notification as processed, unless it already was.
+
+        The row is inserted right away, so that when the same notification
+        is delivered several times at once the unique constraint lets only
+        one delivery through: the others wait for it to commit and then
+        fail to insert. If the transaction is rolled back, the notification
+        can be processed again.
+
+        :returns: True if this call recorded it, False for a duplicate.
+        :rtype: bool
+        """
+        values = dict(video_id=video_id, encoding_id=encoding_id or u'',
+                      status=status, received_on=datetime.now())
+        prefix = _INSERT_IGNORE.get(DBSession.bind.dialect.name, None)
+        if prefix is not None:
+            result = DBSession.execute(panda_events.insert(prefixes=[prefix]).values(**values))
+            return result.rowcount == 1
+
+        # Elsewhere the failed insert must be rolled back on its own, so
+        # that the rest of the transaction can carry on.
+        savepoint = DBSession.begin_nested()
+        try:
+            DBSession.execute(panda_events.insert().values(**values))
+        except IntegrityError:
+            savepoint.rollback()
+            return False
+        savepoint.commit()
+        return True
+
+    @classmethod
+    def forget_progress(cls, video_id):
+        """Delete a video's progress events, which aren't needed once it's finalized."""
+        DBSession.execute(panda_events.delete()\
+            .where(and_(panda_events.c.video_id == video_id,
+                        panda_events.c.status.startswith(u'processing'))))
+
+panda_jobs = Table('panda_jobs', metadata,
+    Column('id', Integer, autoincrement=True, primary_key=True),
+    Column('kind', Unicode(32), nullable=False),
+    Column('media_file_id', Integer, ForeignKey('media_files.id',
+        onupdate='CASCADE', ondelete='CASCADE'), index=True),
+    Column('state', Unicode(16), default=PENDING, nullable=False),
+    Column('data', UnicodeText),
+    Column('attempts', Integer, default=0, nullable=False),
+    Column('last_error', UnicodeText),
+    Column('run_after', DateTime, default=datetime.now, nullable=False),
+    Column('created_on', DateTime, default=datetime.now, nullable=False),
+    Column('modified_on', DateTime, default=datetime.now, onupdate=datetime.now, nullable=False),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+Index('panda_jobs_state_run_after', panda_jobs.c.state, panda_jobs.c.run_after)
+
+class PandaJob(object):
+    """A unit of Panda work to be done outside of the web request.
+
+    Jobs are added to the same transaction as the change that prompted
+    them, so they are committed (or rolled back) along with it, and are
+    then run by :mod:`mediacore_panda.lib.jobs` workers.
+    """
+    query = DBSession.query_property()
+
+    def __repr__(self):
+        return '<PandaJob: %r %r %r>' % (self.id, self.kind, self.state)
+
+    def _get_data(self):
+        return simplejson.loads(self._data or '{}')
+    def _set_data(self, data):
+        self._data = simplejson.dumps(data)
+    data = property(_get_data, _set_data)
+
+    @classmethod
+    def enqueue(cls, kind, media_file=None, **data):
+        job = cls()
+        job.kind = kind
+        job.media_file = media_file
+        job.state = PENDING
+        job.attempts = 0
+        job.run_after = datetime.now()
+        job.data = data
+        DBSession.add(job)
+        return job
+
+    @classmethod
+    def claim(cls, job_id):
+        """Mark a pending job as running, unless another worker got it first.
+
+        :returns: True if this call claimed the job.
+        :rtype: bool
+        """
+        result = DBSession.execute(panda_jobs.update()\
+            .where(and_(panda_jobs.c.id == job_id, panda_jobs.c.state == PENDING))\
+            .values(state=RUNNING, modified_on=datetime.now()))
+        return result.rowcount == 1
+
+    @classmethod
+    def touch(cls, job_id):
+        """Show that a running job is still alive, so it isn't requeued as stale.
+
+        This is committed right away, on a connection of its own, leaving
+        the caller's transaction alone.
+        """
+        DBSession.bind.execute(panda_jobs.update()\
+            .where(and_(panda_jobs.c.id == job_id, panda_jobs.c.state == RUNNING))\
+            .values(modified_on=datetime.now()))
+
+    def retry(self):
+        """Queue a failed job to run again as soon as possible."""
+        self.state = PENDING
+        self.attempts = 0
+        self.run_after = datetime.now()
+
+    def as_dict(self):
+        return dict(
+            id = self.id,
+            kind = self.kind,
+            media_file_id = self.media_file_id,
+            state = self.state,
+            attempts = self.attempts,
+            last_error = self.last_error,
+            run_after = self.run_after.isoformat(),
+            created_on = self.created_on.isoformat(),
+        )
+
+mapper(PandaVideoState, panda_video_states)
+mapper(PandaEncodingState, panda_encoding_states)
+mapper(PandaEvent, panda_events)
+mapper(PandaJob, panda_jobs, properties={
+    '_data': panda_jobs.c.data,
+    'media_file': relation(MediaFile,
+        backref=backref('panda_jobs', cascade='all, delete-orphan', passive_deletes=True)),
+})
+
+tables = [panda_videos, panda_video_states, panda_encoding_states, panda_events, panda_jobs]
+
+def create_tables():
+    """Create any of this plugin's tables that don't exist yet."""
+    metadata.create_all(bind=DBSession.bind, tables=tables, checkfirst=True)
+
+def migrate_video_meta():
+    """Move ``panda_video_<id>`` MediaFilesMeta rows into the panda_videos table.
+
+    :returns: The number of associations moved.
+    :rtype: int
+    """
+    existing = set(video_id for video_id, in DBSession.query(PandaVideo.video_id))
+    metas = DBSession.query(MediaFilesMeta)\
+        .filter(MediaFilesMeta.key.startswith(META_VIDEO_PREFIX))
+    moved = 0
+    for meta in metas:
+        # LIKE treats the underscores in the prefix as wildcards.
+        if not meta.key.startswith(META_VIDEO_PREFIX):
+            continue
+        video_id = meta.key[len(META_VIDEO_PREFIX):]
+        if video_id not in existing:
+            video = PandaVideo()
+            video.media_file_id = meta.media_files_id
+            video.video_id = video_id
+            video.state = meta.value
+            DBSession.add(video)
+            existing.add(video_id)
+            moved += 1
+        DBSession.delete(meta)
+    DBSession.flush()
+    log.info('Moved %d Panda video associations out of media_files_meta.', moved)
+    return moved
@@ -0,0 +1,54 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests of the non-blocking Panda client and helper.
+"""
+
+import time
+import unittest
+
+from mediacore_panda.lib import PandaUnavailable, ProfileIndex
+from mediacore_panda.lib.asynchronous import AsyncPandaClient, AsyncPandaHelper
+from mediacore_panda.lib.emulator import EmulatedConnectionPool, PandaEmulator
+from mediacore_panda.lib.pool import Future, WorkerPool
+
+TIMEOUT = 0.2
+
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = PandaEmulator()
+        self.pool = WorkerPool(4)
+
+    def test_profile_index(self):
+        client = AsyncPandaClient(u'emulated', u'access', u'secret', self.pool,
+            connection_pool=EmulatedConnectionPool(self.emulator))
+        index = client.get_profile_index().result(5)
+        self.assertTrue(isinstance(index, ProfileIndex))
+        self.assertEqual(sorted(index.name_to_id),
+                         sorted(p['name'] for p in self.emulator.profiles.itervalues()))
+        # The index is reused while the profile list is cached.
+        self.assertTrue(client.get_profile_index().result(5) is index)
+
+    def test_timeout_is_for_the_whole_batch(self):
+        helper = AsyncPandaHelper(u'emulated', u'access', u'secret', self.pool,
+            timeout=TIMEOUT, connection_pool=EmulatedConnectionPool(self.emulator))
+        # Fetches that never finish.
+        futures = [Future() for i in range(4)]
+        started = time.time()
+        self.assertRaises(PandaUnavailable, helper.apply_video_status, None, futures)
+        self.assertTrue(time.time() - started < TIMEOUT * 2)
+
+if __name__ == '__main__':
+    unittest.main()
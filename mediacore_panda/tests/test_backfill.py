@@ -0,0 +1,104 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests that a backfill never encodes a video with the same profile twice.
+"""
+
+import unittest
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda import lib
+from mediacore_panda.lib import PandaHelper
+from mediacore_panda.lib.backfill import Backfill, Checkpoint
+from mediacore_panda.lib.emulator import EmulatedConnectionPool, PandaEmulator
+from mediacore_panda.model import panda_videos
+from mediacore_panda.tests import DatabaseTestCase
+
+# Videos to add a profile to, and how many of them already have it.
+VIDEOS = 12
+ALREADY_DONE = 5
+
+class Storage(object):
+    def __init__(self, helper):
+        self.helper = helper
+        self._data = {}
+
+    def panda_helper(self):
+        return self.helper
+
+class AddProfileTest(DatabaseTestCase):
+    # The media_files rows that panda_videos refer to are not created.
+    sqlite_only = True
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.emulator = PandaEmulator()
+        self.helper = PandaHelper(u'emulated', u'access', u'secret', retries=0,
+            connection_pool=EmulatedConnectionPool(self.emulator))
+        profiles = self.helper.client.get_profiles()
+        self.profile_id = profiles[1]['id']
+        self.profile_name = profiles[1]['name']
+        for i in range(VIDEOS):
+            profile_ids = [profiles[0]['id']]
+            if i < ALREADY_DONE:
+                profile_ids.append(self.profile_id)
+            video = self.helper.client.transcode_file('http://example.com/%d.mp4' % i,
+                                                      profile_ids)
+            DBSession.execute(panda_videos.insert().values(
+                media_file_id=i + 1, video_id=video['id']))
+        DBSession.commit()
+
+    def backfill(self, checkpoint=None):
+        backfill = Backfill(Storage(self.helper), checkpoint or Checkpoint(None),
+                            concurrency=4, rate=1000)
+        backfill.add_profile(self.profile_name)
+        return backfill.checkpoint
+
+    def encodings_per_video(self):
+        counts = {}
+        for e in self.emulator.encodings.itervalues():
+            if e['profile_id'] == self.profile_id:
+                counts[e['video_id']] = counts.get(e['video_id'], 0) + 1
+        return counts
+
+    def assertEncodedOnce(self):
+        self.assertEqual(sorted(self.encodings_per_video().values()), [1] * VIDEOS)
+
+    def test_add_profile(self):
+        checkpoint = self.backfill()
+        self.assertEqual(checkpoint.submitted, VIDEOS - ALREADY_DONE)
+        self.assertEqual(checkpoint.skipped, ALREADY_DONE)
+        self.assertEncodedOnce()
+
+    def test_add_profile_again(self):
+        self.backfill()
+        checkpoint = self.backfill()
+        self.assertEqual(checkpoint.submitted, 0)
+        self.assertEncodedOnce()
+
+    def test_listing_too_long_to_page_through(self):
+        page_size, max_pages = lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES
+        lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES = 2, 1
+        try:
+            checkpoint = self.backfill()
+        finally:
+            lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES = page_size, max_pages
+        self.assertEqual(checkpoint.submitted, VIDEOS - ALREADY_DONE)
+        self.assertEqual(checkpoint.skipped, ALREADY_DONE)
+        self.assertEncodedOnce()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests that the circuit breaker hears about every way Panda can fail.
+"""
+
+import unittest
+
+from mediacore_panda.lib import PandaClient, PandaException, PandaUnavailable
+from mediacore_panda.lib.breaker import CLOSED, OPEN, CircuitBreaker
+from mediacore_panda.lib.emulator import (ERROR, MALFORMED,
+    EmulatedConnectionPool, PandaEmulator)
+
+FAILURE_THRESHOLD = 3
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = PandaEmulator()
+        self.breaker = CircuitBreaker(failure_threshold=FAILURE_THRESHOLD)
+
+    def client(self, retries=0):
+        return PandaClient(u'emulated', u'access', u'secret', retries=retries,
+            breaker=self.breaker,
+            connection_pool=EmulatedConnectionPool(self.emulator))
+
+    def assertOpensBreaker(self, kind):
+        self.emulator.inject(kind, path='/presets')
+        client = self.client()
+        for i in range(FAILURE_THRESHOLD):
+            self.assertRaises(PandaUnavailable, client.get_presets)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def assertRetried(self, kind):
+        self.emulator.inject(kind, path='/presets', times=1)
+        presets = self.client(retries=1).get_presets()
+        self.assertEqual(len(presets), len(self.emulator.presets))
+        self.assertEqual(self.emulator.requests, 2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_server_errors_open_the_breaker(self):
+        self.assertOpensBreaker(ERROR)
+
+    def test_malformed_responses_open_the_breaker(self):
+        self.assertOpensBreaker(MALFORMED)
+
+    def test_server_errors_are_retried(self):
+        self.assertRetried(ERROR)
+
+    def test_malformed_responses_are_retried(self):
+        self.assertRetried(MALFORMED)
+
+    def test_client_errors_are_not_failures(self):
+        # Panda answered, so it's up, even if the request was wrong.
+        client = self.client(retries=1)
+        for i in range(FAILURE_THRESHOLD):
+            try:
+                client.get_video('missing')
+            except PandaUnavailable:
+                self.fail('A missing video made Panda unavailable.')
+            except PandaException:
+                pass
+        self.assertEqual(self.emulator.requests, FAILURE_THRESHOLD)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.failures, 0)
+
+if __name__ == '__main__':
+    unittest.main()
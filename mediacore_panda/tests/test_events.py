@@ -0,0 +1,91 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests that a Panda notification delivered several times, even at the same
+time, is only processed once.
+"""
+
+import threading
+import time
+import unittest
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda.model import PandaEvent
+from mediacore_panda.tests import DatabaseTestCase
+
+# Deliveries of the same notification to make at once.
+DELIVERIES = 8
+
+class PandaEventTest(DatabaseTestCase):
+    def deliver(self, count, video_id, encoding_id, status, hold=0.1):
+        # Records the same event from count threads at once, each in its
+        # own session, and returns how many of them recorded it.
+        def delivery():
+            recorded = PandaEvent.record(video_id, encoding_id, status)
+            # Hold the transaction open, as the rest of the
+            # notification's processing would.
+            time.sleep(hold)
+            return recorded
+        return self.in_parallel(count, delivery).count(True)
+
+    def test_parallel_deliveries_are_recorded_once(self):
+        self.assertEqual(self.deliver(DELIVERIES, u'v1', u'e1', u'success'), 1)
+        self.assertEqual(PandaEvent.query.count(), 1)
+
+    def test_parallel_deliveries_of_different_events(self):
+        recorded = []
+        def delivery(encoding_id):
+            recorded.append(self.deliver(DELIVERIES, u'v1', encoding_id, u'success'))
+        threads = [threading.Thread(target=delivery, args=(u'e%d' % i,))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(recorded, [1, 1, 1])
+
+    def test_redelivery_after_commit_is_a_duplicate(self):
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'success'))
+        DBSession.commit()
+        self.assertFalse(PandaEvent.record(u'v1', u'e1', u'success'))
+        # The transaction is still usable after a duplicate.
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'fail'))
+        DBSession.commit()
+        self.assertEqual(PandaEvent.query.count(), 2)
+
+    def test_rolled_back_delivery_can_be_retried(self):
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'success'))
+        DBSession.rollback()
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'success'))
+        DBSession.commit()
+
+    def test_progress_is_part_of_the_event(self):
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'processing:10'))
+        self.assertTrue(PandaEvent.record(u'v1', u'e1', u'processing:20'))
+        self.assertFalse(PandaEvent.record(u'v1', u'e1', u'processing:20'))
+        DBSession.commit()
+
+    def test_forget_progress(self):
+        PandaEvent.record(u'v1', u'e1', u'processing:10')
+        PandaEvent.record(u'v1', u'e1', u'success')
+        PandaEvent.record(u'v2', u'e2', u'processing:10')
+        PandaEvent.forget_progress(u'v1')
+        DBSession.commit()
+        self.assertEqual(sorted((e.video_id, e.status) for e in PandaEvent.query),
+                         [(u'v1', u'success'), (u'v2', u'processing:10')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests that Panda calls are counted towards the page that made them.
+"""
+
+import unittest
+
+from mediacore_panda.lib.metrics import measure_page, metrics
+
+class PageTest(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.end_page()
+
+    def call(self):
+        metrics.record_request('GET', '/videos.json', 0.01)
+
+    def test_page(self):
+        metrics.begin_page('page')
+        self.call()
+        self.call()
+        self.assertEqual(metrics.end_page(), 2)
+        self.assertEqual(metrics.end_page(), 0)
+
+    def test_failed_page_is_ended(self):
+        def fail():
+            self.call()
+            raise ValueError()
+        self.assertRaises(ValueError, measure_page('failed')(fail))
+        # The next page is counted on its own.
+        measure_page('next')(self.call)()
+        self.assertEqual(metrics.pages['failed'].count, 1)
+        self.assertEqual(metrics.pages['next'].count, 1)
+
+    def test_nested_pages_count_once(self):
+        inner = measure_page('inner')(self.call)
+        def outer():
+            inner()
+            inner()
+        measure_page('outer')(outer)()
+        self.assertEqual(metrics.pages.keys(), ['outer'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests that Panda notifications finalize a video exactly once, however many
+times and however concurrently they are delivered.
+"""
+
+import time
+import unittest
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda.model import FINALIZED, PandaVideo
+from mediacore_panda.tests import Media, MediaFile, PandaTestCase
+
+# Deliveries of the same notification to make at once.
+DELIVERIES = 8
+
+class ClaimTest(PandaTestCase):
+    def test_claim_once(self):
+        media_file, video_id = self.submit()
+        self.assertTrue(PandaVideo.claim(video_id))
+        self.assertFalse(PandaVideo.claim(video_id))
+        DBSession.commit()
+        self.assertEqual(self.video_state(video_id), FINALIZED)
+
+    def test_parallel_claims(self):
+        media_file, video_id = self.submit()
+        def claim():
+            claimed = PandaVideo.claim(video_id)
+            time.sleep(0.05)
+            return claimed
+        self.assertEqual(self.in_parallel(DELIVERIES, claim).count(True), 1)
+
+    def test_unknown_video(self):
+        self.assertFalse(PandaVideo.claim(u'unknown'))
+
+class NotificationTest(PandaTestCase):
+    def test_finalized_by_last_notification(self):
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        self.assertEqual(len(notifications), len(self.profile_ids))
+        self.assertEqual(self.deliver_all(media_file, notifications),
+                         [False] * (len(notifications) - 1) + [True])
+        self.assertEqual(self.video_state(video_id), FINALIZED)
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_repeated_notifications(self):
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        self.deliver_all(media_file, notifications)
+        self.assertEqual(self.deliver_all(media_file, notifications),
+                         [False] * len(notifications))
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_parallel_notifications(self):
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        self.deliver_all(media_file, notifications[:-1])
+        finalized = self.in_parallel(DELIVERIES, self.deliver, media_file, notifications[-1])
+        self.assertEqual(finalized.count(True), 1)
+        self.assertEqual(self.video_state(video_id), FINALIZED)
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_parallel_notifications_of_every_encoding(self):
+        # Every encoding's notification is delivered several times at once.
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        finalized = []
+        for params in notifications:
+            finalized.extend(self.in_parallel(DELIVERIES, self.deliver, media_file, params))
+        self.assertEqual(finalized.count(True), 1)
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_failed_encoding_is_not_finalized(self):
+        self.emulator.fail_rate = 1
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        self.assertEqual(self.deliver_all(media_file, notifications),
+                         [False] * len(notifications))
+        self.assertNotEqual(self.video_state(video_id), FINALIZED)
+        self.assertEqual(self.added, [])
+
+    def submit_with_failure(self):
+        # Submits a video whose first encoding fails, and delivers the
+        # notifications of all its encodings.
+        self.emulator.fail_rate = 1
+        media_file, video_id = self.submit()
+        self.emulator.fail_rate = 0
+        encodings = sorted(self.emulator.encodings.values(), key=lambda e: e['id'])
+        for encoding in encodings[1:]:
+            encoding['_fails'] = False
+        self.assertEqual(self.deliver_all(media_file, self.advance(20)),
+                         [False] * len(encodings))
+        return media_file, video_id, encodings[0]['id']
+
+    def test_retried_encoding(self):
+        media_file, video_id, failed_id = self.submit_with_failure()
+        self.helper.retry_transcode(media_file, failed_id)
+        DBSession.commit()
+        self.assertEqual(self.deliver_all(media_file, self.advance(20)), [True])
+        self.assertEqual(self.video_state(video_id), FINALIZED)
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_encoding_retried_elsewhere(self):
+        # The mirror still holds the failed encoding, but Panda doesn't.
+        media_file, video_id, failed_id = self.submit_with_failure()
+        profile_id = self.emulator.encodings[failed_id]['profile_id']
+        self.helper.client.delete_encoding(failed_id)
+        self.helper.client.add_transcode_profile(video_id, profile_id)
+        self.assertEqual(self.deliver_all(media_file, self.advance(20)), [True])
+        self.assertEqual(len(self.added), 1 + len(self.profile_ids))
+
+    def test_unassociated_video(self):
+        media_file, video_id = self.submit()
+        notifications = self.advance(20)
+        self.assertEqual(self.deliver_all(MediaFile(2, Media()), notifications),
+                         [False] * len(notifications))
+        self.assertEqual(self.added, [])
+
+if __name__ == '__main__':
+    unittest.main()
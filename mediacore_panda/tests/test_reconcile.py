@@ -0,0 +1,98 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests of reconciliation with Panda for sites its notifications can't reach.
+"""
+
+import unittest
+
+from mediacore.model.meta import DBSession
+
+from mediacore_panda import lib
+from mediacore_panda.lib.reconcile import Reconciler
+from mediacore_panda.model import GONE, panda_videos
+from mediacore_panda.tests import PandaTestCase
+
+VIDEOS = 6
+ENCODING_TIME = 100
+
+class Association(object):
+    # Stands in for a PandaVideo, whose MediaFile isn't in the database.
+    def __init__(self, media_file, video_id):
+        self.media_file = media_file
+        self.video_id = video_id
+        self.state = None
+
+class ReconcileTest(PandaTestCase):
+    def setUp(self):
+        PandaTestCase.setUp(self)
+        # Long enough for every video to be submitted before any finishes.
+        self.emulator.encoding_time = ENCODING_TIME
+        self.associations = [Association(*self.submit(i + 1)) for i in range(VIDEOS)]
+
+    def reconcile(self, associations):
+        requests = self.emulator.requests
+        videos, video_encodings, finalized, gone = \
+            self.helper.reconcile_videos(associations)
+        DBSession.commit()
+        return finalized, gone, self.emulator.requests - requests
+
+    def test_one_listing_per_run(self):
+        finalized, gone, requests = self.reconcile(self.associations)
+        self.assertEqual((finalized, gone, requests), ([], [], 2))
+        self.advance(ENCODING_TIME * 2)
+        finalized, gone, requests = self.reconcile(self.associations)
+        self.assertEqual(sorted(finalized), sorted(a.video_id for a in self.associations))
+        self.assertEqual(len(self.added), VIDEOS * (1 + len(self.profile_ids)))
+        # One listing of the videos and one of the encodings. The profiles
+        # that name the new MediaFiles are already cached.
+        self.assertEqual(requests, 2)
+
+    def test_deleted_video_is_gone(self):
+        deleted = self.associations[0]
+        self.helper.client.delete_video(deleted.video_id)
+        finalized, gone, requests = self.reconcile(self.associations)
+        self.assertEqual((gone, requests), ([deleted.video_id], 2))
+        self.assertEqual(deleted.state, GONE)
+
+    def test_listings_too_long_to_page_through(self):
+        deleted = self.associations[0]
+        self.helper.client.delete_video(deleted.video_id)
+        self.advance(ENCODING_TIME * 2)
+        page_size, max_pages = lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES
+        lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES = 2, 1
+        try:
+            finalized, gone, requests = self.reconcile(self.associations)
+        finally:
+            lib.LISTING_PAGE_SIZE, lib.LISTING_MAX_PAGES = page_size, max_pages
+        self.assertEqual(gone, [deleted.video_id])
+        self.assertEqual(sorted(finalized),
+                         sorted(a.video_id for a in self.associations[1:]))
+
+class ReconcilerTest(PandaTestCase):
+    def test_gone_videos_are_not_checked_again(self):
+        DBSession.execute(panda_videos.insert().values(
+            media_file_id=1, video_id=u'deleted'))
+        DBSession.commit()
+        reconciler = Reconciler(min_interval=0)
+        self.assertEqual(reconciler.run(self.helper), (1, 0))
+        self.assertEqual(self.video_state(u'deleted'), GONE)
+        requests = self.emulator.requests
+        self.assertEqual(reconciler.run(self.helper), (0, 0))
+        self.assertEqual(Reconciler().run(self.helper), (0, 0))
+        self.assertEqual(self.emulator.requests, requests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+# This file is a part of MediaCore-Panda, Copyright 2011 Simple Station Inc.
+#
+# MediaCore is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# MediaCore is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests of the records that describe finished Panda files.
+"""
+
+import unittest
+
+from mediacore_panda.lib.records import RecordCache, encode
+
+def record(id, display_name=u'(original) Intro.mp4'):
+    return encode(dict(id=id, extname='.mp4', width=640, height=480,
+                       file_size=1024, duration=60000, display_name=display_name))
+
+class RecordCacheTest(unittest.TestCase):
+    def test_decode(self):
+        d = RecordCache().decode(record('abc123'))
+        self.assertEqual((d['id'], d['extname'], d['width'], d['display_name']),
+                         (u'abc123', u'.mp4', 640, u'(original) Intro.mp4'))
+
+    def test_hit(self):
+        cache = RecordCache()
+        url = record('abc123')
+        self.assertTrue(cache.decode(url) is cache.decode(url))
+
+    def test_keyed_by_file(self):
+        cache = RecordCache()
+        cache.decode(record('abc123'))
+        d = cache.decode(record('abc123', display_name=u'Renamed.mp4'))
+        self.assertEqual(d['display_name'], u'Renamed.mp4')
+        self.assertEqual(len(cache), 1)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = RecordCache(size=2)
+        a = cache.decode(record('a'))
+        b = cache.decode(record('b'))
+        self.assertTrue(cache.decode(record('a')) is a)
+        cache.decode(record('c'))
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.decode(record('a')) is a)
+        self.assertFalse(cache.decode(record('b')) is b)
+
+    def test_version_1(self):
+        d = RecordCache().decode('panda:{"id": "abc123", "extname": ".mp4"}')
+        self.assertEqual(d['id'] + d['extname'], u'abc123.mp4')
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, RecordCache().decode, 'panda:2:abc123:.mp4')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,6 +31,14 @@ setup(
     entry_points = '''
         [mediacore.plugin]
         panda=mediacore_panda
+
+        [paste.global_paster_command]
+        panda_setup=mediacore_panda.commands:SetupCommand
+        panda_worker=mediacore_panda.commands:WorkerCommand
+        panda_backfill=mediacore_panda.commands:BackfillCommand
+        panda_emulator=mediacore_panda.commands:EmulatorCommand
+        panda_benchmark=mediacore_panda.commands:BenchmarkCommand
+        panda_reconcile=mediacore_panda.commands:ReconcileCommand
     ''',
     message_extractors = {'mediacore_panda': [
         ('**.py', 'python', None),